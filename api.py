@@ -1,10 +1,22 @@
+import json
 import os
 import logging
-from flask import Flask, request, jsonify, make_response
-from predictor import get_crop_recommendations, get_plant_time_recommendations
-from soil_service import LocationNotSupportedError
-from errors import UnsupportedCropError, FileReadError
+from flask import Flask, Response, request, jsonify, make_response, g, stream_with_context
+from predictor import get_crop_recommendations, get_batch_crop_recommendations, get_plant_time_recommendations, get_planting_calendar
+from soil_service import LocationNotSupportedError, soilgrids
+from weather_service import get_upstream_stats as get_openmeteo_stats
+from errors import UnsupportedCropError, FileReadError, UpstreamTimeoutError, UpstreamUnavailableError, InvalidRegionError
 from utils import get_all_crops
+from crop_catalog import catalog, normalize_crop_name
+from result_cache import cache as result_cache
+from coverage_index import index as coverage_index
+from recommendation_layer import layer as recommendation_layer
+import region_export
+from model_registry import registry
+from soil_cache import cache as soil_cache
+from tif_reader import sampler
+from upstream_cache import cache as upstream_cache
+import metrics
 
 from flask_cors import CORS
 app = Flask(__name__)
@@ -14,6 +26,30 @@ app.config['CORS_HEADERS'] = 'Content-Type'
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 
+# Report the caches' hit ratios on /metrics
+metrics.register_cache('soil', soil_cache.stats)
+metrics.register_cache('result', result_cache.stats)
+metrics.register_cache('raster_blocks', sampler.stats)
+metrics.register_cache('recommendation_layer', recommendation_layer.stats)
+metrics.register_cache('upstream', upstream_cache.stats)
+metrics.register_upstream('soilgrids', soilgrids.stats)
+metrics.register_upstream('openmeteo', get_openmeteo_stats)
+
+@app.before_request
+def start_timing():
+    g.metrics_start = metrics.start_request()
+
+@app.after_request
+def add_server_timing(response):
+    server_timing = metrics.finish_request(request.endpoint or 'unknown', g.get('metrics_start'))
+    if server_timing is not None:
+        response.headers['Server-Timing'] = server_timing
+    return response
+
+# Maximum number of locations accepted by the batch endpoint
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 5000))
+
+
 @app.route('/crop-recommendations', methods=['POST'])
 def recommend_crops():
     # Get the input data from the request
@@ -34,17 +70,113 @@ def recommend_crops():
         logging.error(f'Invalid latitude or longitude: {latitude}, {longitude}')
         return make_response(jsonify({'error': 'Bad Request, invalid latitude or longitude'}), 400)
 
+    # Locations outside the supported areas are rejected before any data source is called
+    if not coverage_index.contains(longitude, latitude):
+        logging.error(f'Location with latitude {latitude} and longitude {longitude} is not supported')
+        return _location_not_supported_response()
+
+    # Answer from the precomputed recommendations unless fresh ones are asked for
+    fresh = data.get('fresh') is True
+    if not fresh:
+        response = recommendation_layer.lookup(longitude, latitude)
+        if response is not None:
+            logging.info(f'Sending {len(response)} precomputed crop recommendations for location {latitude}, {longitude}')
+            return make_response(jsonify(response), 200)
+
     try:
-        # Get crop recommendations
-        response = get_crop_recommendations(longitude, latitude)
+        key = result_cache.key('crop-recommendations', longitude, latitude)
+        if fresh:
+            response = get_crop_recommendations(longitude, latitude)
+            result_cache.put(key, response)
+        else:
+            # Get crop recommendations, shared by nearby requests made on the same day
+            response = result_cache.get_or_compute(key, lambda: get_crop_recommendations(longitude, latitude))
     except LocationNotSupportedError:
         logging.error(f'Location with latitude {latitude} and longitude {longitude} is not supported')
-        return make_response(jsonify({'error': 'Location not supported. Sending error due to invalid location.'}), 404)
+        return _location_not_supported_response()
+    except UpstreamTimeoutError as e:
+        logging.error(f'Crop recommendation for location {latitude}, {longitude} timed out: {e}')
+        return make_response(jsonify({'error': 'A data source took too long to respond, please try again'}), 504)
+    except UpstreamUnavailableError as e:
+        logging.error(f'Crop recommendation for location {latitude}, {longitude} failed: {e}')
+        return _unavailable_response(e)
 
-    logging.info(f'Sending crop recommendation response for location{latitude}, {longitude}: {response}')
+    logging.info(f'Sending {len(response)} crop recommendations for location {latitude}, {longitude}')
     return make_response(response, 200)
 
 
+@app.route('/crop-recommendations/batch', methods=['POST'])
+def recommend_crops_batch():
+    # Get the input data from the request
+    data = request.get_json()
+
+    if 'locations' not in data or not isinstance(data['locations'], list):
+        logging.error('Bad Request for batch crop recommendation, missing field: locations')
+        return make_response(jsonify({'error': 'Bad Request, missing field: locations'}), 400)
+
+    locations = data['locations']
+    if len(locations) > MAX_BATCH_SIZE:
+        logging.error(f'Bad Request for batch crop recommendation, {len(locations)} locations exceeds the limit of {MAX_BATCH_SIZE}')
+        return make_response(jsonify({'error': f'Bad Request, at most {MAX_BATCH_SIZE} locations are allowed'}), 400)
+
+    logging.info(f'Received batch crop recommendation request for {len(locations)} locations')
+
+    # Validate each location, invalid ones get a per-location error. Valid ones are answered
+    # from the precomputed recommendations when possible, unless fresh ones are asked for
+    fresh = data.get('fresh') is True
+    results = [None] * len(locations)
+    valid_indexes = []
+    valid_locations = []
+    for i, location in enumerate(locations):
+        if not isinstance(location, dict) or 'latitude' not in location or 'longitude' not in location:
+            results[i] = {'error': 'Bad Request, missing field: latitude or longitude'}
+            continue
+        latitude = location['latitude']
+        longitude = location['longitude']
+        if not isinstance(latitude, (int, float)) or not isinstance(longitude, (int, float)) \
+                or not (-90 <= latitude <= 90) or not (-180 <= longitude <= 180):
+            results[i] = {'error': 'Bad Request, invalid latitude or longitude'}
+            continue
+        precomputed = None if fresh else recommendation_layer.lookup(longitude, latitude)
+        if precomputed is not None:
+            results[i] = {'recommendations': precomputed}
+            continue
+        valid_indexes.append(i)
+        valid_locations.append((longitude, latitude))
+
+    for i, result in zip(valid_indexes, get_batch_crop_recommendations(valid_locations)):
+        results[i] = result
+
+    for location, result in zip(locations, results):
+        if isinstance(location, dict):
+            result['latitude'] = location.get('latitude')
+            result['longitude'] = location.get('longitude')
+
+    logging.info(f'Sending batch crop recommendation response for {len(locations)} locations')
+    return make_response(jsonify(results), 200)
+
+
+@app.route('/recommendations/export', methods=['POST'])
+def export_recommendations():
+    # Get the input data from the request, every field is optional
+    data = request.get_json(silent=True) or {}
+
+    try:
+        region, step = region_export.parse_region(data)
+        digest = region_export.query_digest(data)
+        first_cell = region_export.decode_resume_token(data['resume_token'], digest) if 'resume_token' in data else 0
+    except InvalidRegionError as e:
+        logging.error(f'Bad Request for recommendation export: {e}')
+        return make_response(jsonify({'error': f'Bad Request, {e}'}), 400)
+
+    logging.info(f'Starting recommendation export with step {step} from cell {first_cell}')
+
+    # One JSON document per line, produced chunk by chunk as the client reads them
+    records = region_export.export_recommendations(region, step, digest, first_cell)
+    lines = (app.json.dumps(record) + '\n' for record in records)
+    return Response(stream_with_context(lines), mimetype='application/x-ndjson')
+
+
 @app.route('/plant-time-recommendations', methods=['POST'])
 def recommend_plant_time():
     # Get the input data from the request
@@ -65,28 +197,120 @@ def recommend_plant_time():
         logging.error(f'Invalid latitude or longitude: {latitude}, {longitude}. Sending error due to invalid location.')
         return make_response(jsonify({'error': 'Bad Request, invalid latitude or longitude'}), 400)
 
+    # Locations outside the supported areas are rejected before any data source is called
+    if not coverage_index.contains(longitude, latitude):
+        logging.error(f'Location with latitude {latitude} and longitude {longitude} is not supported')
+        return _location_not_supported_response()
+
     try:
-        # Get the planting recommendations
-        response = get_plant_time_recommendations(longitude=longitude, latitude=latitude, crop_name=data['crop'])
+        # Get the planting recommendations, shared by nearby requests made on the same day
+        response = result_cache.get_or_compute(
+            result_cache.key('plant-time-recommendations', longitude, latitude, normalize_crop_name(data['crop'])),
+            lambda: get_plant_time_recommendations(longitude=longitude, latitude=latitude, crop_name=data['crop'])
+        )
     except UnsupportedCropError as e:
         supported_crops = get_all_crops()
         logging.error(f'Crop {data["crop"]} is not supported. Sending error due to unsupported crop.')
         return make_response(jsonify({'error': str(e), 'supported_crops': supported_crops}), 404)
+    except UpstreamTimeoutError as e:
+        logging.error(f'Plant time recommendation for location {latitude}, {longitude} timed out: {e}')
+        return make_response(jsonify({'error': 'A data source took too long to respond, please try again'}), 504)
+    except UpstreamUnavailableError as e:
+        logging.error(f'Plant time recommendation for location {latitude}, {longitude} failed: {e}')
+        return _unavailable_response(e)
+
+    logging.info(f'Sending {len(response)} plant time recommendations for location {latitude}, {longitude}')
+    return make_response(jsonify(response), 200)
+
+@app.route('/planting-calendar', methods=['POST'])
+def recommend_planting_calendar():
+    # Get the input data from the request
+    data = request.get_json()
+
+    # Check if all required fields are in the data, crops is optional and defaults to all crops
+    required_fields = ['latitude', 'longitude']
+    for field in required_fields:
+        if field not in data:
+            logging.error(f'Bad Request for planting calendar, missing field: {field}')
+            return make_response(jsonify({'error': f'Bad Request, missing field: {field}'}), 400)
+
+    crops = data.get('crops')
+    if crops is not None and (not isinstance(crops, list) or not all(isinstance(crop, str) for crop in crops)):
+        logging.error('Bad Request for planting calendar, crops is not a list of crop names')
+        return make_response(jsonify({'error': 'Bad Request, crops must be a list of crop names'}), 400)
+
+    # Validate latitude and longitude
+    latitude = data['latitude']
+    longitude = data['longitude']
+    logging.info(f'Received planting calendar request for location: {latitude}, {longitude}')
+    if not (-90 <= latitude <= 90) or not (-180 <= longitude <= 180):
+        logging.error(f'Invalid latitude or longitude: {latitude}, {longitude}. Sending error due to invalid location.')
+        return make_response(jsonify({'error': 'Bad Request, invalid latitude or longitude'}), 400)
+
+    # Locations outside the supported areas are rejected before any data source is called
+    if not coverage_index.contains(longitude, latitude):
+        logging.error(f'Location with latitude {latitude} and longitude {longitude} is not supported')
+        return _location_not_supported_response()
+
+    # No crops, no calendar: nothing needs to be fetched or cached
+    if crops == []:
+        return make_response(jsonify({}), 200)
+
+    try:
+        # Get the calendar, shared by nearby requests made on the same day for the same crops. The
+        # response is keyed by the crop names as sent, so the cache key uses them unchanged too.
+        crop_key = json.dumps(crops, separators=(',', ':')) if crops is not None else '*'
+        response = result_cache.get_or_compute(
+            result_cache.key('planting-calendar', longitude, latitude, crop_key),
+            lambda: get_planting_calendar(longitude=longitude, latitude=latitude, crop_names=crops)
+        )
+    except UnsupportedCropError as e:
+        supported_crops = get_all_crops()
+        logging.error(f'A crop in {crops} is not supported. Sending error due to unsupported crop.')
+        return make_response(jsonify({'error': str(e), 'supported_crops': supported_crops}), 404)
+    except UpstreamTimeoutError as e:
+        logging.error(f'Planting calendar for location {latitude}, {longitude} timed out: {e}')
+        return make_response(jsonify({'error': 'A data source took too long to respond, please try again'}), 504)
+    except UpstreamUnavailableError as e:
+        logging.error(f'Planting calendar for location {latitude}, {longitude} failed: {e}')
+        return _unavailable_response(e)
 
-    logging.info(f'Sending Plant time recommendations for location {latitude}, {longitude}: {response}')
+    logging.info(f'Sending the planting calendar of {len(response)} crops for location {latitude}, {longitude}')
     return make_response(jsonify(response), 200)
 
 @app.route('/crops', methods=['GET'])
 def get_crops():
     logging.info('Received request for all crops')
     try:
-        crops = get_all_crops()
+        payload, etag = catalog.get_payload()
     except FileReadError:
         logging.error('Failed to read the crops data. Sending error due to file read error.')
         return make_response(jsonify({'error': 'Failed to read the crops data'}), 500)
-    logging.info(f'Sending all crops: {crops}')
-    return make_response(jsonify(crops), 200)
+
+    # The list only changes when the file does, so clients can revalidate with the ETag
+    if etag in request.if_none_match:
+        logging.info('Crops not modified')
+        return make_response('', 304, {'ETag': f'"{etag}"'})
+
+    logging.info('Sending all crops')
+    return make_response(payload, 200, {'Content-Type': 'application/json', 'ETag': f'"{etag}"'})
+
+def _location_not_supported_response():
+    return make_response(jsonify({'error': 'Location not supported. Sending error due to invalid location.'}), 404)
+
+def _unavailable_response(error):
+    # Tell clients when the data source will be tried again
+    retry_after = str(max(1, round(error.retry_after)))
+    return make_response(jsonify({'error': 'A data source is unavailable, please try again later'}), 503,
+                         {'Retry-After': retry_after})
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return make_response(metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4'})
 
 if __name__ == '__main__':
+    # Load the model up front so the first request does not pay for it. The production
+    # entry point (wsgi.py) does the same before forking the workers.
+    registry.warm_up()
     port = int(os.environ.get('PORT', 8080))
     app.run(host='0.0.0.0', port=port)
\ No newline at end of file
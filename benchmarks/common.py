@@ -0,0 +1,78 @@
+"""
+Helpers shared by the benchmarks: latency summaries, peak memory and the results files.
+
+Results are stored as benchmarks/results/<benchmark>-<commit>.json, so runs on different
+commits can be compared with python -m benchmarks.compare.
+"""
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), 'results')
+
+
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def summarize(latencies, elapsed=None):
+    """
+    Summarize per-call latencies.
+
+    Parameters:
+    - latencies (list): Latency of each call, in seconds.
+    - elapsed (float): Wall time of the whole run in seconds, defaults to the sum of the
+      latencies (calls made one after the other).
+
+    Returns:
+    - dict: The number of calls, throughput in calls per second and the mean, p50, p95 and
+      p99 latencies in milliseconds.
+    """
+    latencies = np.asarray(latencies, dtype=np.float64)
+    if elapsed is None:
+        elapsed = latencies.sum()
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000 if len(latencies) else (np.nan,) * 3
+    return {
+        'calls': len(latencies),
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'mean_ms': float(latencies.mean() * 1000) if len(latencies) else np.nan,
+        'p50_ms': float(p50),
+        'p95_ms': float(p95),
+        'p99_ms': float(p99),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def save_results(benchmark, results):
+    """Store a benchmark's results for the current commit and return the file path."""
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    commit = current_commit()
+    path = os.path.join(RESULTS_DIR, f'{benchmark}-{commit}.json')
+    with open(path, 'w') as f:
+        json.dump({'benchmark': benchmark, 'commit': commit, 'recorded_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                   **results}, f, indent=2)
+    return path
+
+
+def print_table(rows):
+    """Print latency summaries, one row per case."""
+    width = max(map(len, rows), default=0) + 2
+    print(f"{'case':<{width}}{'calls':>8}{'calls/s':>12}{'p50':>12}{'p95':>12}{'p99':>12}")
+    for name, summary in rows.items():
+        print(f"{name:<{width}}{summary['calls']:>8}{summary['throughput']:>12.1f}{summary['p50_ms']:>9.3f} ms"
+              f"{summary['p95_ms']:>9.3f} ms{summary['p99_ms']:>9.3f} ms")
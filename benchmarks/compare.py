@@ -0,0 +1,55 @@
+"""
+Compare the saved results of a benchmark between two commits.
+
+Every number in the two results files is listed side by side with the relative change:
+
+    python -m benchmarks.compare load_test <base commit> [<head commit>]
+
+The head commit defaults to the current one. Paths to results files can be given instead
+of commits.
+"""
+import argparse
+import json
+import os
+
+from benchmarks.common import RESULTS_DIR, current_commit
+
+
+def load(benchmark, commit):
+    path = commit if os.path.isfile(commit) else os.path.join(RESULTS_DIR, f'{benchmark}-{commit}.json')
+    with open(path) as f:
+        return json.load(f)
+
+
+def flatten(results, prefix=''):
+    """Get the numbers of a results file by their dotted path, e.g. results.all.p95_ms."""
+    values = {}
+    for key, value in results.items():
+        name = f'{prefix}{key}'
+        if isinstance(value, dict):
+            values.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[name] = value
+    return values
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', help='Benchmark name, e.g. load_test, request_path or import_time')
+    parser.add_argument('base', help='Base commit or results file')
+    parser.add_argument('head', nargs='?', help='Head commit or results file, defaults to the current commit')
+    args = parser.parse_args()
+
+    base = flatten(load(args.benchmark, args.base))
+    head = flatten(load(args.benchmark, args.head or current_commit()))
+
+    names = [name for name in base if name in head and not name.startswith('config.')]
+    width = max(map(len, names), default=0) + 2
+    print(f"{'metric':<{width}}{'base':>14}{'head':>14}{'change':>10}")
+    for name in names:
+        change = (head[name] - base[name]) / base[name] * 100 if base[name] else float('nan')
+        print(f'{name:<{width}}{base[name]:>14.3f}{head[name]:>14.3f}{change:>9.1f}%')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,319 @@
+"""
+Stand-in data for the benchmarks: synthetic soil rasters, SoilGrids responses and Open-Meteo
+archive responses in the FlatBuffers format the API client decodes.
+
+Responses recorded from the real services can be replayed instead of the synthetic ones.
+Record them once (this needs network access) with:
+
+    python -m benchmarks.fixtures --record benchmarks/fixtures
+"""
+import argparse
+import json
+import os
+from datetime import date, datetime, time, timedelta
+from urllib.parse import urlencode
+from zoneinfo import ZoneInfo
+
+import numpy as np
+
+# Bounding box of Kenya as (west, south, east, north)
+KENYA_BOUNDS = (33.9, -4.72, 41.9, 5.03)
+
+# Lake Turkana, left empty in the synthetic rasters like water is in the real ones
+LAKE = (36.1, 3.6, 0.3)
+
+RASTER_FILES = {
+    'phosphorus': 'kenya_phosphorus.tif',
+    'potassium': 'kenya_potassium.tif',
+    'nitrogen': 'kenya_nitrogen.tif',
+    'phh2o': 'kenya_phh2o.tif',
+}
+
+# Value range of each raster, in the units soil_service reads them in
+RASTER_RANGES = {
+    'phosphorus': (500, 8000),
+    'potassium': (20, 200),
+    'nitrogen': (20, 140),
+    'phh2o': (45, 80),
+}
+
+# The depth intervals of a SoilGrids response
+DEPTHS = [('0-5cm', 0, 5), ('5-15cm', 5, 15), ('15-30cm', 15, 30), ('30-60cm', 30, 60),
+          ('60-100cm', 60, 100), ('100-200cm', 100, 200)]
+
+SOILGRIDS_FIXTURE = 'soilgrids.json'
+OPENMETEO_FIXTURE = 'openmeteo.bin'
+
+# Open-Meteo variable names as (variable, unit, altitude, aggregation) codes of openmeteo_sdk
+OPENMETEO_SERIES = {
+    'relative_humidity_2m': (29, 35, 2, 0),
+    'temperature_2m_mean': (47, 1, 2, 3),
+    'rain_sum': (28, 32, 0, 10),
+}
+
+
+def make_soil_rasters(directory, resolution=0.01, seed=0):
+    """
+    Write synthetic versions of the four Kenya soil rasters.
+
+    The values vary smoothly over the country, within the range of the real data, and the
+    files are tiled float32 GeoTIFFs with NaN nodata like the ones get_tifs.py builds.
+
+    Returns:
+    - dict: The path of each raster, by soil property.
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    west, south, east, north = KENYA_BOUNDS
+    width = round((east - west) / resolution)
+    height = round((north - south) / resolution)
+    longitudes = west + (np.arange(width) + 0.5) * resolution
+    latitudes = north - (np.arange(height) + 0.5) * resolution
+    lon_grid, lat_grid = np.meshgrid(longitudes, latitudes)
+    lake = np.hypot(lon_grid - LAKE[0], lat_grid - LAKE[1]) < LAKE[2]
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = {}
+    for i, (name, file_name) in enumerate(RASTER_FILES.items()):
+        low, high = RASTER_RANGES[name]
+        pattern = np.sin(lon_grid * (1.3 + i) + i) * np.cos(lat_grid * (0.9 + i / 2))
+        noise = rng.normal(0, 0.05, pattern.shape)
+        values = low + (high - low) * np.clip((pattern + 1) / 2 + noise, 0, 1)
+        values = np.where(lake, np.nan, values).astype(np.float32)
+
+        paths[name] = os.path.join(directory, file_name)
+        with rasterio.open(paths[name], 'w', driver='GTiff', width=width, height=height, count=1,
+                           dtype='float32', crs='EPSG:4326', nodata=np.nan,
+                           transform=from_origin(west, north, resolution, resolution),
+                           tiled=True, blockxsize=256, blockysize=256, compress='deflate') as dst:
+            dst.write(values, 1)
+    return paths
+
+
+def random_locations(count, seed=0):
+    """Get (longitude, latitude) pairs spread over the Kenya bounding box."""
+    west, south, east, north = KENYA_BOUNDS
+    rng = np.random.default_rng(seed)
+    longitudes = rng.uniform(west, east, count).round(5)
+    latitudes = rng.uniform(south, north, count).round(5)
+    return list(zip(longitudes.tolist(), latitudes.tolist()))
+
+
+def soilgrids_response(longitude, latitude):
+    """Build a SoilGrids properties query response with nitrogen and pH for a location."""
+    def layer(name, unit, base, spread):
+        means = [round(base + spread * np.sin(longitude * (depth + 1) + latitude)) for depth in range(6)]
+        depths = [{'label': label, 'range': {'top_depth': top, 'bottom_depth': bottom, 'unit_depth': 'cm'},
+                   'values': {'mean': mean}}
+                  for (label, top, bottom), mean in zip(DEPTHS, means)]
+        return {'name': name, 'unit_measure': {'mapped_units': unit}, 'depths': depths}
+
+    return {
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [longitude, latitude]},
+        'properties': {'layers': [layer('nitrogen', 'cg/kg', 80, 40), layer('phh2o', 'pH*10', 62, 12)]},
+    }
+
+
+def openmeteo_response(params, recorded=None):
+    """
+    Build an Open-Meteo archive response for the given query parameters.
+
+    The series cover the requested dates in the requested timezone. Their values come from
+    a recorded response when one is given, repeated to the requested length, and are
+    synthetic otherwise.
+
+    Parameters:
+    - params (dict): The query parameters, with lists for repeated parameters.
+    - recorded (dict): Recorded series by (variable, aggregation), see decode_openmeteo_response.
+
+    Returns:
+    - bytes: The size-prefixed FlatBuffers message.
+    """
+    latitude = float(params['latitude'][0])
+    longitude = float(params['longitude'][0])
+    timezone = ZoneInfo(params.get('timezone', ['GMT'])[0])
+    start_date = date.fromisoformat(params['start_date'][0])
+    end_date = date.fromisoformat(params['end_date'][0])
+
+    start = int(datetime.combine(start_date, time(), tzinfo=timezone).timestamp())
+    end = int(datetime.combine(end_date + timedelta(days=1), time(), tzinfo=timezone).timestamp())
+    utc_offset = int(datetime.combine(start_date, time(), tzinfo=timezone).utcoffset().total_seconds())
+    seed = latitude * 7.1 + longitude * 3.3
+
+    sections = {}
+    for section, interval in [('hourly', 3600), ('daily', 86400)]:
+        names = [name for value in params.get(section, []) for name in value.split(',')]
+        if not names:
+            continue
+        unknown = [name for name in names if name not in OPENMETEO_SERIES]
+        if unknown:
+            raise ValueError(f'Cannot initialize WeatherVariable from invalid String value {unknown[0]}')
+        timestamps = np.arange(start, end, interval, dtype=np.int64) if section == 'hourly' else \
+            start + 86400 * np.arange((end_date - start_date).days + 1, dtype=np.int64)
+        series = []
+        for name in names:
+            variable, unit, altitude, aggregation = OPENMETEO_SERIES[name]
+            if recorded is not None and (variable, aggregation) in recorded:
+                values = np.resize(recorded[(variable, aggregation)], len(timestamps))
+            else:
+                values = _synthetic_series(name, timestamps, seed)
+            series.append((variable, unit, altitude, aggregation, values))
+        sections[section] = (start, end, interval, series)
+
+    return encode_openmeteo_response(latitude, longitude, utc_offset, params.get('timezone', ['GMT'])[0], sections)
+
+
+def _synthetic_series(name, timestamps, seed):
+    day_of_year = (timestamps / 86400) % 365.25
+    season = 2 * np.pi * day_of_year / 365.25
+    # Deterministic noise in [0, 1), so a day has the same weather in every response
+    noise = np.modf(np.abs(np.sin(timestamps * 12.9898e-5 + seed) * 43758.5453))[0]
+
+    if name == 'relative_humidity_2m':
+        values = 65 + 15 * np.sin(2 * season) + 10 * np.sin(2 * np.pi * timestamps / 86400) + 10 * (noise - 0.5)
+        values = np.clip(values, 0, 100)
+    elif name == 'temperature_2m_mean':
+        values = 22 + 3 * np.sin(season) + 2 * (noise - 0.5)
+    else:
+        # The long rains around April and the short rains around November
+        intensity = 6 * np.exp(-((day_of_year - 105) / 30) ** 2) + 4 * np.exp(-((day_of_year - 310) / 25) ** 2) + 0.5
+        values = np.where(noise > 0.55, intensity * (noise - 0.55) / 0.45 * 3, 0)
+    return values.astype(np.float32)
+
+
+def encode_openmeteo_response(latitude, longitude, utc_offset, timezone, sections):
+    """
+    Encode a WeatherApiResponse message.
+
+    Parameters:
+    - sections (dict): 'hourly' and/or 'daily' as (start, end, interval, series), where each
+      series is (variable, unit, altitude, aggregation, values).
+    """
+    import flatbuffers
+
+    builder = flatbuffers.Builder(1024)
+
+    section_offsets = {}
+    for section, (start, end, interval, series) in sections.items():
+        variable_offsets = []
+        for variable, unit, altitude, aggregation, values in series:
+            values_offset = builder.CreateNumpyVector(np.asarray(values, dtype=np.float32))
+            # VariableWithValues
+            builder.StartObject(14)
+            builder.PrependUint8Slot(0, variable, 0)
+            builder.PrependUint8Slot(1, unit, 0)
+            builder.PrependUOffsetTRelativeSlot(3, values_offset, 0)
+            builder.PrependInt16Slot(5, altitude, 0)
+            builder.PrependUint8Slot(6, aggregation, 0)
+            variable_offsets.append(builder.EndObject())
+
+        builder.StartVector(4, len(variable_offsets), 4)
+        for offset in reversed(variable_offsets):
+            builder.PrependUOffsetTRelative(offset)
+        variables_offset = builder.EndVector()
+
+        # VariablesWithTime
+        builder.StartObject(4)
+        builder.PrependInt64Slot(0, start, 0)
+        builder.PrependInt64Slot(1, end, 0)
+        builder.PrependInt32Slot(2, interval, 0)
+        builder.PrependUOffsetTRelativeSlot(3, variables_offset, 0)
+        section_offsets[section] = builder.EndObject()
+
+    timezone_offset = builder.CreateString(timezone)
+
+    # WeatherApiResponse
+    builder.StartObject(15)
+    builder.PrependFloat32Slot(0, latitude, 0.0)
+    builder.PrependFloat32Slot(1, longitude, 0.0)
+    builder.PrependInt32Slot(6, utc_offset, 0)
+    builder.PrependUOffsetTRelativeSlot(7, timezone_offset, 0)
+    if 'daily' in section_offsets:
+        builder.PrependUOffsetTRelativeSlot(10, section_offsets['daily'], 0)
+    if 'hourly' in section_offsets:
+        builder.PrependUOffsetTRelativeSlot(11, section_offsets['hourly'], 0)
+    builder.FinishSizePrefixed(builder.EndObject())
+    return bytes(builder.Output())
+
+
+def decode_openmeteo_response(data):
+    """Get the series of a recorded Open-Meteo response, by (variable, aggregation)."""
+    from openmeteo_sdk.WeatherApiResponse import WeatherApiResponse
+
+    response = WeatherApiResponse.GetRootAs(data, 4)
+    series = {}
+    for section in [response.Hourly(), response.Daily()]:
+        if section is None:
+            continue
+        for i in range(section.VariablesLength()):
+            variable = section.Variables(i)
+            series[(variable.Variable(), variable.Aggregation())] = variable.ValuesAsNumpy().copy()
+    return series
+
+
+def load_fixtures(directory):
+    """
+    Load recorded responses from a directory.
+
+    Returns:
+    - tuple: The recorded SoilGrids response and the recorded Open-Meteo series, each None
+      if it has not been recorded.
+    """
+    soilgrids = openmeteo = None
+    if directory is not None:
+        soilgrids_path = os.path.join(directory, SOILGRIDS_FIXTURE)
+        if os.path.exists(soilgrids_path):
+            with open(soilgrids_path) as f:
+                soilgrids = json.load(f)
+        openmeteo_path = os.path.join(directory, OPENMETEO_FIXTURE)
+        if os.path.exists(openmeteo_path):
+            with open(openmeteo_path, 'rb') as f:
+                openmeteo = decode_openmeteo_response(f.read())
+    return soilgrids, openmeteo
+
+
+def record(directory, longitude=36.82, latitude=-1.29):
+    """Record one SoilGrids and one Open-Meteo archive response for a location (Nairobi by default)."""
+    import requests
+
+    from soil_service import SOILGRIDS_URL
+    from weather_service import ARCHIVE_URL, WEATHER_TIMEZONE
+
+    os.makedirs(directory, exist_ok=True)
+
+    response = requests.get(f'{SOILGRIDS_URL}?lon={longitude}&lat={latitude}&property=nitrogen&property=phh2o'
+                            f'&value=mean', timeout=60)
+    response.raise_for_status()
+    with open(os.path.join(directory, SOILGRIDS_FIXTURE), 'w') as f:
+        json.dump(response.json(), f)
+
+    end_date = date.today().replace(month=1, day=1)
+    params = {
+        'latitude': latitude,
+        'longitude': longitude,
+        'start_date': end_date.replace(year=end_date.year - 3).isoformat(),
+        'end_date': end_date.isoformat(),
+        'hourly': 'relative_humidity_2m',
+        'daily': 'temperature_2m_mean,rain_sum',
+        'timezone': WEATHER_TIMEZONE,
+        'format': 'flatbuffers',
+    }
+    response = requests.get(f'{ARCHIVE_URL}?{urlencode(params)}', timeout=60)
+    response.raise_for_status()
+    with open(os.path.join(directory, OPENMETEO_FIXTURE), 'wb') as f:
+        f.write(response.content)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--record', metavar='DIR', required=True, help='Directory to store the recorded responses in')
+    args = parser.parse_args()
+    record(args.record)
+    print(f'Recorded responses to {args.record}')
+
+
+if __name__ == '__main__':
+    main()
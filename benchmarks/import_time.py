@@ -0,0 +1,70 @@
+"""
+Start-up benchmark for the API, based on python -X importtime.
+
+Imports a module (api by default) in a fresh interpreter a few times, reports the best
+total import time and the module's heaviest direct imports, and optionally fails when the
+import takes longer than a budget, so start-up regressions are caught.
+
+Run from the repository root:
+
+    python -m benchmarks.import_time [--module api] [--max-ms 800] [--save]
+"""
+import argparse
+import subprocess
+import sys
+
+from benchmarks.common import save_results
+
+
+def measure(module):
+    # Each line of -X importtime output is "import time: self | cumulative | name"
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, check=True).stderr
+
+    # Imports are listed children first, so the module's own imports are the ones between the
+    # previous top-level import and the module
+    imports = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # The name is indented by two spaces per nesting level, plus one
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        name = name.strip()
+        if depth == 0:
+            if name == module:
+                return int(cumulative) / 1000, imports
+            imports = {}
+        elif depth == 1:
+            imports[name] = int(cumulative) / 1000
+
+    raise RuntimeError(f'{module} was not imported')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='api', help='Module to import')
+    parser.add_argument('--runs', type=int, default=5, help='Number of fresh interpreters to measure')
+    parser.add_argument('--top', type=int, default=10, help='Number of direct imports to list')
+    parser.add_argument('--max-ms', type=float, help='Exit with an error above this import time')
+    parser.add_argument('--save', action='store_true', help='Store the results under benchmarks/results')
+    args = parser.parse_args()
+
+    runs = [measure(args.module) for _ in range(args.runs)]
+    total_ms, imports = min(runs, key=lambda run: run[0])
+
+    print(f'import {args.module}: {total_ms:.1f} ms (best of {args.runs})')
+    for name, ms in sorted(imports.items(), key=lambda item: item[1], reverse=True)[:args.top]:
+        print(f'  {name:<30}{ms:>10.1f} ms')
+
+    if args.save:
+        path = save_results('import_time', {'module': args.module, 'total_ms': total_ms, 'imports': imports})
+        print(f'Saved results to {path}')
+
+    if args.max_ms is not None and total_ms > args.max_ms:
+        print(f'Import time {total_ms:.1f} ms is over the budget of {args.max_ms} ms')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,221 @@
+"""
+End-to-end load test of the API.
+
+Starts local stand-ins for SoilGrids and Open-Meteo (benchmarks.upstreams) and the API under
+gunicorn, with synthetic soil rasters and empty caches in a temporary directory, then sends
+requests for random locations in Kenya from concurrent clients. Reports throughput,
+p50/p95/p99 latency, the status codes and the peak memory of the server processes.
+
+Run from the repository root:
+
+    python -m benchmarks.load_test [--requests 500] [--concurrency 16] [--endpoint mix] [--save]
+
+Use --locations to send the requests for fewer distinct locations, so that some of them are
+served from the caches.
+"""
+import argparse
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.common import print_table, save_results, summarize
+from benchmarks.fixtures import KENYA_BOUNDS, make_soil_rasters, random_locations
+from benchmarks.upstreams import FakeUpstreams
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENDPOINTS = {
+    'crop': '/crop-recommendations',
+    'plant-time': '/plant-time-recommendations',
+}
+
+
+def start_server(directory, port, args, upstream_env):
+    """Start the API under gunicorn and wait until it answers."""
+    env = dict(os.environ)
+    env.update(upstream_env)
+    env.update({
+        'PORT': str(port),
+        'WEB_CONCURRENCY': str(args.workers),
+        'GUNICORN_THREADS': str(args.threads),
+        'SOIL_DATA_DIR': os.path.join(directory, 'data'),
+        'SOIL_SOURCE': args.soil_source,
+        'SOIL_CACHE_PATH': os.path.join(directory, 'soil_cache.sqlite'),
+        'CLIMATOLOGY_DIR': os.path.join(directory, 'climatology'),
+        'RESULT_CACHE_BACKEND': args.result_cache,
+        'RESULT_CACHE_PATH': os.path.join(directory, 'result_cache.sqlite'),
+        'UPSTREAM_CACHE_PATH': os.path.join(directory, 'upstream_cache.sqlite'),
+    })
+    log = open(os.path.join(directory, 'server.log'), 'w')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+                               '--bind', f'127.0.0.1:{port}', 'wsgi:app'],
+                              cwd=REPOSITORY_DIR, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f'The server exited with {server.returncode}, see {log.name}')
+        try:
+            if requests.get(f'http://127.0.0.1:{port}/crops', timeout=1).status_code == 200:
+                return server
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    stop_server(server)
+    raise RuntimeError('The server did not start in time')
+
+
+def stop_server(server):
+    server.send_signal(signal.SIGTERM)
+    try:
+        server.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+
+def server_peak_rss_mb(pid):
+    """Peak resident memory of the gunicorn master and each worker, in MB. Only available on Linux."""
+    peaks = {}
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            pids = [pid] + [int(child) for child in f.read().split()]
+        for process in pids:
+            with open(f'/proc/{process}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peaks[str(process)] = int(line.split()[1]) / 1024
+    except OSError:
+        return None
+    return {'total': sum(peaks.values()), 'per_process': peaks}
+
+
+def build_requests(args, crops):
+    locations = random_locations(args.locations or args.requests, seed=args.seed)
+    endpoints = list(ENDPOINTS) if args.endpoint == 'mix' else [args.endpoint]
+    planned = []
+    for i in range(args.requests):
+        longitude, latitude = locations[i % len(locations)]
+        endpoint = endpoints[i % len(endpoints)]
+        body = {'longitude': longitude, 'latitude': latitude}
+        if endpoint == 'plant-time':
+            body['crop'] = crops[i % len(crops)]
+        planned.append((endpoint, body))
+    return planned
+
+
+def misplaced_weather_queries(openmeteo_points, margin=0.5):
+    """
+    Get the Open-Meteo queries whose latitude or longitude is outside the area of the requests.
+
+    The requests all fall in Kenya, where no latitude is a valid longitude and the other way
+    round, so a query with its coordinates swapped always shows up here.
+    """
+    west, south, east, north = KENYA_BOUNDS
+    misplaced = []
+    for latitude, longitude in openmeteo_points:
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+        except ValueError:
+            misplaced.append((latitude, longitude))
+            continue
+        if not (south - margin <= latitude <= north + margin and west - margin <= longitude <= east + margin):
+            misplaced.append((latitude, longitude))
+    return misplaced
+
+
+def run_load(base_url, planned, concurrency):
+    """Send the planned requests from concurrent clients and return (endpoint, status, latency) for each."""
+    local = threading.local()
+
+    def send(request):
+        endpoint, body = request
+        session = getattr(local, 'session', None)
+        if session is None:
+            session = local.session = requests.Session()
+        start = time.perf_counter()
+        try:
+            status = session.post(base_url + ENDPOINTS[endpoint], json=body, timeout=120).status_code
+        except requests.RequestException:
+            status = 'error'
+        return endpoint, status, time.perf_counter() - start
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        return list(executor.map(send, planned))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=500, help='Number of requests to send')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('--locations', type=int, help='Number of distinct locations, defaults to one per request')
+    parser.add_argument('--endpoint', choices=[*ENDPOINTS, 'mix'], default='mix')
+    parser.add_argument('--workers', type=int, default=2, help='Gunicorn workers')
+    parser.add_argument('--threads', type=int, default=4, help='Threads per gunicorn worker')
+    parser.add_argument('--soil-source', choices=['api', 'local'], default='api',
+                        help="Get nitrogen and pH from the fake SoilGrids ('api') or the synthetic rasters")
+    parser.add_argument('--result-cache', choices=['memory', 'sqlite', 'none'], default='memory')
+    parser.add_argument('--soilgrids-latency-ms', type=float, default=300)
+    parser.add_argument('--openmeteo-latency-ms', type=float, default=150)
+    parser.add_argument('--fixtures', help='Directory with recorded upstream responses to replay')
+    parser.add_argument('--port', type=int, default=8095, help='Port for the API')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the random locations')
+    parser.add_argument('--save', action='store_true', help='Store the results under benchmarks/results')
+    args = parser.parse_args()
+
+    from crop_catalog import catalog
+    planned = build_requests(args, catalog.get_all_crops())
+
+    with tempfile.TemporaryDirectory() as directory, \
+            FakeUpstreams(soilgrids_latency=args.soilgrids_latency_ms / 1000,
+                          openmeteo_latency=args.openmeteo_latency_ms / 1000,
+                          fixtures_dir=args.fixtures) as upstreams:
+        make_soil_rasters(os.path.join(directory, 'data'))
+        server = start_server(directory, args.port, args, upstreams.env())
+        try:
+            start = time.perf_counter()
+            responses = run_load(f'http://127.0.0.1:{args.port}', planned, args.concurrency)
+            elapsed = time.perf_counter() - start
+            rss = server_peak_rss_mb(server.pid)
+        finally:
+            stop_server(server)
+
+    results = {'all': summarize([latency for _, _, latency in responses], elapsed)}
+    for endpoint in ENDPOINTS:
+        latencies = [latency for name, _, latency in responses if name == endpoint]
+        if latencies:
+            results[endpoint] = summarize(latencies, elapsed)
+    status_codes = Counter(str(status) for _, status, _ in responses)
+
+    print_table(results)
+    print('status codes: ' + ', '.join(f'{status}: {count}' for status, count in sorted(status_codes.items())))
+    print('upstream requests: ' + ', '.join(f'{name}: {count}' for name, count in sorted(upstreams.requests.items())))
+    if rss is not None:
+        print(f"server peak RSS: {rss['total']:.1f} MB over {len(rss['per_process'])} processes")
+
+    # Every weather lookup must be made at the latitude and longitude it was asked for
+    misplaced = misplaced_weather_queries(upstreams.openmeteo_points)
+    if misplaced:
+        print(f'{len(misplaced)} Open-Meteo queries outside the request area, e.g. latitude, longitude = '
+              f'{misplaced[0]}. Are latitude and longitude swapped?')
+
+    if args.save:
+        config = {name: value for name, value in vars(args).items() if name != 'save'}
+        path = save_results('load_test', {'config': config, 'results': results, 'status_codes': status_codes,
+                                          'upstream_requests': dict(upstreams.requests), 'server_peak_rss_mb': rss})
+        print(f'Saved results to {path}')
+
+    if misplaced:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+Micro-benchmarks for the steps of the request path.
+
+Times single calls of the raster lookup, the weather and rainfall aggregations, the
+planting window search and model inference on synthetic inputs, and reports throughput,
+p50/p95/p99 latency and the peak memory of the process.
+
+Run from the repository root:
+
+    python -m benchmarks.request_path [--calls 2000] [--save]
+"""
+import argparse
+import tempfile
+import time
+from datetime import date, timedelta
+
+import numpy as np
+
+from benchmarks.common import peak_rss_mb, print_table, save_results, summarize
+from benchmarks.fixtures import make_soil_rasters, random_locations
+
+
+def time_calls(function, inputs, setup=None):
+    """Call function once per input and return the latency of each call. setup prepares an input untimed."""
+    latencies = []
+    for value in inputs:
+        if setup is not None:
+            value = setup(value)
+        start = time.perf_counter()
+        function(value)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def benchmark_raster(directory, calls):
+    from tif_reader import get_value_at_point
+
+    raster_file = make_soil_rasters(directory)['potassium']
+    locations = random_locations(calls, seed=1)
+    # The first pass reads the blocks from disk, the second one is served from the block cache
+    cold = time_calls(lambda location: _read_or_none(get_value_at_point, raster_file, location), locations)
+    warm = time_calls(lambda location: _read_or_none(get_value_at_point, raster_file, location), locations)
+    return {'raster.get_value_at_point (cold)': cold, 'raster.get_value_at_point (warm)': warm}
+
+
+def _read_or_none(get_value_at_point, raster_file, location):
+    try:
+        return get_value_at_point(raster_file, *location)
+    except Exception:
+        return None
+
+
+def benchmark_planting_windows(calls):
+    from plant_time_predictor import find_best_planting_windows
+
+    rng = np.random.default_rng(2)
+    vectors = [rng.exponential(3, 365).astype(np.float32) for _ in range(calls)]
+    return {'plant_time.find_best_planting_windows': time_calls(
+        lambda average_rainfall: find_best_planting_windows(average_rainfall, window_size=120), vectors)}
+
+
+def benchmark_average_rainfall(calls):
+    from weather_service import calculate_average_rainfall
+
+    # Three years of daily rainfall laid out by year, like get_rainfall_history returns it
+    rng = np.random.default_rng(3)
+    history = {'first_year': 2021, 'rainfall': rng.exponential(3, (3, 365)).astype(np.float32)}
+    history['rainfall'][2, 59] = np.nan
+    return {'weather.calculate_average_rainfall': time_calls(
+        calculate_average_rainfall, [history] * calls)}
+
+
+def benchmark_average_weather(calls):
+    from weather_service import _get_average_weather_data
+
+    today = date.today()
+    rng = np.random.default_rng(4)
+    averages = [{
+        'years': [(today - timedelta(days=365 * year)).year for year in range(1, 4)],
+        'average_daily_relative_humidity': rng.uniform(40, 90, 3).astype(np.float32),
+        'average_daily_temperature': rng.uniform(15, 30, 3).astype(np.float32),
+        'sum_rainfall_for_duration': rng.uniform(50, 500, 3).astype(np.float32),
+    } for _ in range(calls)]
+    return {'weather._get_average_weather_data': time_calls(_get_average_weather_data, averages)}
+
+
+def benchmark_inference(calls):
+    from crop_model import top_k
+    from model_registry import registry
+
+    model = registry.get()
+    rng = np.random.default_rng(5)
+    low = np.array([0, 5, 5, 10, 15, 3.5, 20])
+    high = np.array([140, 145, 205, 40, 100, 10, 300])
+    rows = rng.uniform(low, high, (calls, len(low)))
+    return {'inference.predict_proba + top_k': time_calls(lambda row: top_k(model.predict_proba(row)), rows)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--calls', type=int, default=2000, help='Number of calls per benchmark')
+    parser.add_argument('--save', action='store_true', help='Store the results under benchmarks/results')
+    args = parser.parse_args()
+
+    latencies = {}
+    with tempfile.TemporaryDirectory() as directory:
+        latencies.update(benchmark_raster(directory, args.calls))
+    latencies.update(benchmark_planting_windows(args.calls))
+    latencies.update(benchmark_average_rainfall(args.calls))
+    latencies.update(benchmark_average_weather(args.calls))
+    latencies.update(benchmark_inference(args.calls))
+
+    results = {name: summarize(values) for name, values in latencies.items()}
+    print_table(results)
+    rss = peak_rss_mb()
+    print(f'peak RSS: {rss:.1f} MB')
+
+    if args.save:
+        path = save_results('request_path', {'calls': args.calls, 'peak_rss_mb': rss, 'results': results})
+        print(f'Saved results to {path}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+"""
+A local stand-in for the SoilGrids and Open-Meteo archive APIs, with configurable latency.
+
+Serves the responses built by benchmarks.fixtures, replaying recorded ones from --fixtures
+when they exist. Point the API at it with the environment variables it prints:
+
+    python -m benchmarks.upstreams [--port 8090] [--soilgrids-latency-ms 300] [--openmeteo-latency-ms 150]
+"""
+import argparse
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from benchmarks.fixtures import load_fixtures, openmeteo_response, soilgrids_response
+
+SOILGRIDS_PATH = '/soilgrids/v2.0/properties/query'
+ARCHIVE_PATH = '/v1/archive'
+
+
+class FakeUpstreams:
+    """
+    SoilGrids and Open-Meteo served from one local HTTP server, on a background thread.
+
+    Every response is delayed by the configured latency of its service, to mimic the time
+    spent on the network and in the real service. The (latitude, longitude) of every
+    Open-Meteo query is counted in `openmeteo_points`.
+    """
+
+    def __init__(self, port=0, soilgrids_latency=0.0, openmeteo_latency=0.0, fixtures_dir=None):
+        self.soilgrids_latency = soilgrids_latency
+        self.openmeteo_latency = openmeteo_latency
+        self.recorded_soilgrids, self.recorded_openmeteo = load_fixtures(fixtures_dir)
+        self.requests = Counter()
+        self.openmeteo_points = Counter()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+        self._server.daemon_threads = True
+        self._server.upstreams = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self._server.server_address[1]}'
+
+    def env(self):
+        """Get the environment variables that point the API at these upstreams."""
+        return {
+            'SOILGRIDS_URL': self.url + SOILGRIDS_PATH,
+            'OPENMETEO_ARCHIVE_URL': self.url + ARCHIVE_PATH,
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        upstreams = self.server.upstreams
+        url = urlsplit(self.path)
+        params = parse_qs(url.query)
+
+        if url.path == SOILGRIDS_PATH:
+            upstreams.requests['soilgrids'] += 1
+            time.sleep(upstreams.soilgrids_latency)
+            body = upstreams.recorded_soilgrids or soilgrids_response(float(params['lon'][0]), float(params['lat'][0]))
+            self._send(200, 'application/json', json.dumps(body).encode())
+        elif url.path == ARCHIVE_PATH:
+            upstreams.requests['openmeteo'] += 1
+            upstreams.openmeteo_points[(params.get('latitude', [''])[0], params.get('longitude', [''])[0])] += 1
+            time.sleep(upstreams.openmeteo_latency)
+            try:
+                body = openmeteo_response(params, upstreams.recorded_openmeteo)
+            except (KeyError, ValueError) as e:
+                # Open-Meteo reports bad parameters as JSON with a 400
+                self._send(400, 'application/json', json.dumps({'error': True, 'reason': str(e)}).encode())
+                return
+            self._send(200, 'application/octet-stream', body)
+        else:
+            self._send(404, 'application/json', b'{"error": true, "reason": "Not found"}')
+
+    def _send(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--soilgrids-latency-ms', type=float, default=300)
+    parser.add_argument('--openmeteo-latency-ms', type=float, default=150)
+    parser.add_argument('--fixtures', help='Directory with recorded responses to replay')
+    args = parser.parse_args()
+
+    upstreams = FakeUpstreams(args.port, args.soilgrids_latency_ms / 1000, args.openmeteo_latency_ms / 1000,
+                              args.fixtures)
+    for name, value in upstreams.env().items():
+        print(f'export {name}={value}')
+    try:
+        upstreams.start()._thread.join()
+    except KeyboardInterrupt:
+        upstreams.stop()
+
+
+if __name__ == '__main__':
+    main()
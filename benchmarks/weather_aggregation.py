@@ -0,0 +1,105 @@
+"""
+Micro-benchmark for the weather aggregation in weather_service.
+
+Compares the NumPy aggregation against the per-year pandas DataFrame code it replaced, on
+synthetic Open-Meteo arrays for three 91-day windows, checks that both give the same
+result and reports CPU time and peak memory allocated per call. The peak is the most
+memory traced by tracemalloc at any point of the call, so it counts the temporary arrays
+and objects the call creates and frees, not only what is still allocated when it returns.
+
+Run from the repository root, with pandas installed from requirements-training.txt:
+
+    python -m benchmarks.weather_aggregation
+"""
+import timeit
+import tracemalloc
+from datetime import date, timedelta
+
+import numpy as np
+import pandas as pd
+
+from weather_service import _aggregate_windows, _get_average_weather_data, _local_midnight
+
+START_DATE = date(2024, 10, 18)
+DURATION_DAYS = 90
+YEARS_BACK = 3
+REPEATS = 200
+
+
+def make_inputs():
+    windows = [
+        (START_DATE - timedelta(days=365*year), START_DATE + timedelta(days=DURATION_DAYS) - timedelta(days=365*year))
+        for year in range(1, YEARS_BACK + 1)
+    ]
+    request_start, request_end = windows[-1][0], windows[0][1]
+    first_hour = _local_midnight(request_start)
+    num_hours = (_local_midnight(request_end + timedelta(days=1)) - first_hour) // 3600
+    num_days = (request_end - request_start).days + 1
+
+    rng = np.random.default_rng(42)
+    hourly_time = first_hour + 3600 * np.arange(num_hours)
+    humidity = rng.uniform(30, 100, num_hours).astype(np.float32)
+    temperature = rng.uniform(10, 35, num_days).astype(np.float32)
+    rainfall = rng.exponential(3, num_days).astype(np.float32)
+    return windows, request_start, hourly_time, humidity, temperature, rainfall
+
+
+def numpy_aggregation(windows, request_start, hourly_time, humidity, temperature, rainfall):
+    hour_ranges = np.searchsorted(hourly_time, [
+        (_local_midnight(start), _local_midnight(end + timedelta(days=1))) for start, end in windows
+    ])
+    first_days = [(start - request_start).days for start, _ in windows]
+    window_days = DURATION_DAYS + 1
+    averages = dict(zip(
+        ['average_daily_relative_humidity', 'average_daily_temperature', 'sum_rainfall_for_duration'],
+        _aggregate_windows(hourly_time, humidity, temperature, rainfall, hour_ranges, first_days, window_days)
+    ))
+    averages['years'] = [start.year for start, _ in windows]
+    return _get_average_weather_data(averages)
+
+
+def pandas_aggregation(windows, request_start, hourly_time, humidity, temperature, rainfall):
+    # The DataFrame based code that was used before
+    sums = [0, 0, 0]
+    for start, end in windows:
+        hourly_window = (hourly_time >= _local_midnight(start)) & (hourly_time < _local_midnight(end + timedelta(days=1)))
+        hourly_dataframe = pd.DataFrame({
+            "date": pd.to_datetime(hourly_time[hourly_window], unit="s", utc=True),
+            "relative_humidity_2m": humidity[hourly_window]
+        })
+        first_day = (start - request_start).days
+        last_day = (end - request_start).days + 1
+        daily_dataframe = pd.DataFrame({
+            "temperature_2m_mean": temperature[first_day:last_day],
+            "rain_sum": rainfall[first_day:last_day]
+        })
+        hourly_dataframe.set_index('date', inplace=True)
+        hourly_dataframe_daily = hourly_dataframe.resample('D').mean()
+        sums[0] += hourly_dataframe_daily['relative_humidity_2m'].mean()
+        sums[1] += daily_dataframe['temperature_2m_mean'].mean()
+        sums[2] += daily_dataframe['rain_sum'].sum()
+    return tuple(total / len(windows) for total in sums)
+
+
+def measure(function, inputs):
+    seconds = min(timeit.repeat(lambda: function(*inputs), number=REPEATS, repeat=5)) / REPEATS
+
+    tracemalloc.start()
+    function(*inputs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return seconds, peak
+
+
+def main():
+    inputs = make_inputs()
+    assert numpy_aggregation(*inputs) == pandas_aggregation(*inputs), "Aggregations differ"
+
+    print(f"{'implementation':<16}{'time/call':>14}{'peak memory':>16}")
+    for name, function in [('pandas', pandas_aggregation), ('numpy', numpy_aggregation)]:
+        seconds, peak = measure(function, inputs)
+        print(f"{name:<16}{seconds * 1e6:>11.1f} us{peak / 1024:>13.1f} KB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+import math
+import os
+import sqlite3
+import threading
+from datetime import date
+
+import numpy as np
+
+CLIMATOLOGY_DIR = os.environ.get('CLIMATOLOGY_DIR', 'climatology')
+
+DAYS_PER_YEAR = 365
+
+# Rows are added to the data file in chunks of this many cells
+GROWTH_ROWS = 1024
+
+
+class ClimatologyStore:
+    """
+    Average daily rainfall for each day of the year, per weather grid point.
+
+    The vectors live in one float32 matrix file (one 365-element row per cell) that is
+    memory-mapped for reading, with a SQLite index mapping cell ids to rows. A cell is a
+    weather grid point, see weather_service.weather_grid_point, so its vector comes from
+    the rainfall fetched for that very point. Cells are added one at a time as they are
+    first requested, and a cell built in an earlier year is considered stale, since the
+    rainfall history it comes from moves forward every January.
+    """
+
+    def __init__(self, directory=CLIMATOLOGY_DIR):
+        self.directory = directory
+        self.data_path = os.path.join(directory, 'rainfall.f32')
+        self.index_path = os.path.join(directory, 'index.sqlite')
+        self._matrix = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def cell_for(self, grid_longitude, grid_latitude):
+        """Get the id of the cell of a weather grid point."""
+        return f'{grid_longitude},{grid_latitude}'
+
+    def get(self, cell, year=None):
+        """
+        Get the average rainfall vector of a cell.
+
+        Returns:
+        - ndarray: A read-only float32 array with one value per day of the year, or None if
+          the cell has not been built this year.
+        """
+        year = year or date.today().year
+        entry = self._connection().execute('SELECT row, year FROM cells WHERE cell = ?', (cell,)).fetchone()
+        if entry is None or entry[1] != year:
+            return None
+        return self._rows(entry[0] + 1)[entry[0]]
+
+    def put(self, cell, average_rainfall, year=None):
+        """Store the average rainfall vector of a cell, replacing any older one."""
+        year = year or date.today().year
+        average_rainfall = np.asarray(average_rainfall, dtype=np.float32)
+        if average_rainfall.shape != (DAYS_PER_YEAR,):
+            raise ValueError(f'Expected {DAYS_PER_YEAR} daily values, got {average_rainfall.shape}')
+
+        connection = self._connection()
+        # Take the write lock first so concurrent writers do not claim the same row
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            entry = connection.execute('SELECT row FROM cells WHERE cell = ?', (cell,)).fetchone()
+            if entry is None:
+                row = connection.execute('SELECT COALESCE(MAX(row) + 1, 0) FROM cells').fetchone()[0]
+            else:
+                row = entry[0]
+
+            # Write the data before the index points at it
+            self._grow(row + 1)
+            with open(self.data_path, 'r+b') as f:
+                f.seek(row * DAYS_PER_YEAR * 4)
+                f.write(average_rainfall.tobytes())
+
+            connection.execute('INSERT OR REPLACE INTO cells (cell, row, year) VALUES (?, ?, ?)', (cell, row, year))
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+
+    def stats(self):
+        count, current = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(year = ?), 0) FROM cells', (date.today().year,)).fetchone()
+        return {'cells': count, 'current_cells': current}
+
+    def _rows(self, rows_needed):
+        # Map the data file, remapping when another writer has grown it
+        matrix = self._matrix
+        if matrix is None or matrix.shape[0] < rows_needed:
+            with self._lock:
+                size = os.path.getsize(self.data_path) // (DAYS_PER_YEAR * 4)
+                matrix = np.memmap(self.data_path, dtype=np.float32, mode='r', shape=(size, DAYS_PER_YEAR))
+                self._matrix = matrix
+        return matrix
+
+    def _grow(self, rows_needed):
+        size = os.path.getsize(self.data_path) // (DAYS_PER_YEAR * 4)
+        if size < rows_needed:
+            rows = math.ceil(rows_needed / GROWTH_ROWS) * GROWTH_ROWS
+            with open(self.data_path, 'r+b') as f:
+                f.truncate(rows * DAYS_PER_YEAR * 4)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            os.makedirs(self.directory, exist_ok=True)
+            # Create the data file if it does not exist yet
+            open(self.data_path, 'ab').close()
+            connection = sqlite3.connect(self.index_path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cells (cell TEXT PRIMARY KEY, row INTEGER, year INTEGER)')
+            self._local.connection = connection
+        return connection
+
+
+store = ClimatologyStore()
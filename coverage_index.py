@@ -0,0 +1,148 @@
+import json
+import logging
+import math
+import os
+import threading
+
+import numpy as np
+
+# GeoJSON files with the areas the API supports, separated by commas, e.g. one per country
+COVERAGE_PATHS = [path for path in os.environ.get('COVERAGE_PATHS', 'kenya.geojson').split(',') if path]
+
+# Cell size of the rasterized coverage masks, in degrees
+COVERAGE_MASK_DEGREES = float(os.environ.get('COVERAGE_MASK_DEGREES', 0.01))
+
+# Mask cell states. Edge cells are crossed by the area's boundary and need an exact test
+OUTSIDE = 0
+INSIDE = 1
+EDGE = 2
+
+
+def load_area(geojson_path):
+    """Load the (Multi)Polygon geometries of a GeoJSON file as one Shapely geometry."""
+    import shapely  # Imported lazily to keep start-up fast
+
+    with open(geojson_path) as f:
+        geojson = json.load(f)
+    features = geojson['features'] if geojson.get('type') == 'FeatureCollection' else [geojson]
+    geometries = [shapely.geometry.shape(feature.get('geometry', feature)) for feature in features]
+    return shapely.union_all(geometries)
+
+
+class CoverageIndex:
+    """
+    Tells whether locations fall inside the supported areas, without any I/O.
+
+    Each area is rasterized once into a mask of `cell_degrees` cells marking whether a cell
+    is inside, outside or on the edge of the area. Most lookups are a bounds check and one
+    array read; only points in edge cells are tested against the exact, prepared geometry.
+    """
+
+    def __init__(self, paths=COVERAGE_PATHS, cell_degrees=COVERAGE_MASK_DEGREES):
+        self.paths = paths
+        self.cell_degrees = cell_degrees
+        self._areas = None
+        self._lock = threading.Lock()
+
+    def contains(self, longitude, latitude):
+        """Whether a location is inside one of the supported areas."""
+        areas = self._load()
+        if areas is None:
+            return True
+        for area in areas:
+            min_longitude, min_latitude, max_longitude, max_latitude = area['bounds']
+            if not (min_longitude <= longitude <= max_longitude and min_latitude <= latitude <= max_latitude):
+                continue
+            row = min(int((max_latitude - latitude) / self.cell_degrees), area['mask'].shape[0] - 1)
+            column = min(int((longitude - min_longitude) / self.cell_degrees), area['mask'].shape[1] - 1)
+            state = area['mask'][row, column]
+            if state == INSIDE:
+                return True
+            if state == EDGE:
+                import shapely
+                if shapely.contains_xy(area['geometry'], longitude, latitude):
+                    return True
+        return False
+
+    def contains_points(self, longitudes, latitudes):
+        """
+        Whether each of many locations is inside one of the supported areas.
+
+        Returns:
+        - ndarray: A boolean array with one value per location.
+        """
+        longitudes = np.asarray(longitudes, dtype=np.float64)
+        latitudes = np.asarray(latitudes, dtype=np.float64)
+        areas = self._load()
+        if areas is None:
+            return np.ones(longitudes.shape, dtype=bool)
+
+        import shapely
+
+        covered = np.zeros(longitudes.shape, dtype=bool)
+        for area in areas:
+            min_longitude, min_latitude, max_longitude, max_latitude = area['bounds']
+            candidates = np.flatnonzero(~covered & (longitudes >= min_longitude) & (longitudes <= max_longitude)
+                                        & (latitudes >= min_latitude) & (latitudes <= max_latitude))
+            rows = np.minimum(((max_latitude - latitudes[candidates]) / self.cell_degrees).astype(np.int64),
+                              area['mask'].shape[0] - 1)
+            columns = np.minimum(((longitudes[candidates] - min_longitude) / self.cell_degrees).astype(np.int64),
+                                 area['mask'].shape[1] - 1)
+            states = area['mask'][rows, columns]
+            covered[candidates[states == INSIDE]] = True
+            edge = candidates[states == EDGE]
+            covered[edge] = shapely.contains_xy(area['geometry'], longitudes[edge], latitudes[edge])
+        return covered
+
+    def union(self):
+        """Get all the supported areas as one Shapely geometry, or None if there are none."""
+        import shapely
+
+        areas = self._load()
+        return shapely.union_all([area['geometry'] for area in areas]) if areas else None
+
+    def load(self):
+        """Build the masks ahead of time so the first request does not pay for it."""
+        self._load()
+
+    def _load(self):
+        if self._areas is None:
+            with self._lock:
+                if self._areas is None:
+                    self._areas = self._build()
+        # An empty list means no coverage files were found, and every location is accepted
+        return self._areas or None
+
+    def _build(self):
+        import shapely
+
+        areas = []
+        for path in self.paths:
+            if not os.path.exists(path):
+                logging.warning(f'Coverage file {path} not found, it is not used to reject locations')
+                continue
+            geometry = load_area(path)
+            # Every polygon of a MultiPolygon gets its own mask, so far apart parts do not share one
+            for part in getattr(geometry, 'geoms', [geometry]):
+                shapely.prepare(part)
+                areas.append({'geometry': part, 'bounds': part.bounds, 'mask': self._rasterize(part)})
+        return areas
+
+    def _rasterize(self, geometry):
+        from rasterio.features import rasterize
+        from rasterio.transform import from_origin
+
+        min_longitude, min_latitude, max_longitude, max_latitude = geometry.bounds
+        width = max(1, math.ceil((max_longitude - min_longitude) / self.cell_degrees))
+        height = max(1, math.ceil((max_latitude - min_latitude) / self.cell_degrees))
+        transform = from_origin(min_longitude, max_latitude, self.cell_degrees, self.cell_degrees)
+
+        # Cells whose center is inside, then every cell the boundary passes through
+        mask = rasterize([(geometry, INSIDE)], out_shape=(height, width), transform=transform, dtype='uint8')
+        edges = rasterize([(geometry.boundary, EDGE)], out_shape=(height, width), transform=transform,
+                          all_touched=True, dtype='uint8')
+        mask[edges == EDGE] = EDGE
+        return mask
+
+
+index = CoverageIndex()
@@ -0,0 +1,115 @@
+import csv
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from errors import FileReadError, UnsupportedCropError
+
+CROPS_PATH = 'data/planting_durations.csv'
+
+# How often (in seconds) to stat the crops file for changes
+CROPS_CHECK_INTERVAL = float(os.environ.get('CROPS_CHECK_INTERVAL', 5))
+
+# Other names farmers use for the supported crops, by normalized name
+CROP_ALIASES = {
+    'corn': 'maize',
+    'paddy': 'rice',
+    'chickpeas': 'chickpea',
+    'gram': 'chickpea',
+    'kidneybean': 'kidneybeans',
+    'pigeonpea': 'pigeonpeas',
+    'mothbean': 'mothbeans',
+    'greengram': 'mungbean',
+    'mungbeans': 'mungbean',
+    'lentils': 'lentil',
+    'bananas': 'banana',
+    'mangoes': 'mango',
+    'grape': 'grapes',
+    'oranges': 'orange',
+    'apples': 'apple',
+}
+
+
+def normalize_crop_name(crop_name):
+    """Case-fold a crop name and drop spaces and punctuation, e.g. "Kidney Beans" -> "kidneybeans"."""
+    return ''.join(character for character in crop_name.casefold() if character.isalnum())
+
+
+class CropCatalog:
+    """
+    The supported crops and their planting durations, kept in memory.
+
+    The CSV is parsed once and re-read when its mtime changes (checked at most once every
+    `check_interval` seconds). Lookups are case-insensitive and accept aliases. The JSON
+    list of crops served by /crops is built at load time together with its ETag.
+    """
+
+    def __init__(self, path=CROPS_PATH, check_interval=CROPS_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = None
+        self._last_check = 0.0
+        # (durations by normalized name, crops in file order, JSON payload, ETag)
+        self._snapshot = None
+
+    def get_planting_duration(self, crop_name):
+        durations = self._load()[0]
+        name = normalize_crop_name(crop_name)
+        name = CROP_ALIASES.get(name, name)
+        if name not in durations:
+            raise UnsupportedCropError(f"The crop '{crop_name.lower()}' is not supported.")
+        return durations[name]
+
+    def get_all_crops(self):
+        return list(self._load()[1])
+
+    def get_durations(self):
+        """Get the planting duration of every crop, in file order."""
+        durations, crops = self._load()[:2]
+        return {crop: durations[normalize_crop_name(crop)] for crop in crops}
+
+    def get_payload(self):
+        """Get the crops as a JSON document, with its ETag."""
+        _, _, payload, etag = self._load()
+        return payload, etag
+
+    def _load(self):
+        if self._snapshot is None or time.monotonic() - self._last_check >= self.check_interval:
+            self._refresh()
+        # Everything is read from one snapshot so a concurrent reload cannot mix versions
+        return self._snapshot
+
+    def _refresh(self):
+        with self._lock:
+            if self._snapshot is not None and time.monotonic() - self._last_check < self.check_interval:
+                return
+            self._last_check = time.monotonic()
+
+            try:
+                mtime = os.path.getmtime(self.path)
+                if self._snapshot is not None and mtime == self._mtime:
+                    return
+
+                with open(self.path, newline='') as f:
+                    rows = list(csv.DictReader(f))
+                crops = [row['crop'] for row in rows]
+                durations = {normalize_crop_name(row['crop']): int(row['duration(days)']) for row in rows}
+            except Exception:
+                # Keep serving the last good version if there is one
+                if self._snapshot is not None:
+                    logging.exception(f"Failed to reload '{self.path}', keeping the previous crops")
+                    return
+                raise FileReadError(f"Failed to read the file '{self.path}'")
+
+            payload = json.dumps(crops).encode()
+            etag = hashlib.sha1(payload).hexdigest()
+
+            self._snapshot = (durations, crops, payload, etag)
+            self._mtime = mtime
+
+
+catalog = CropCatalog()
@@ -0,0 +1,150 @@
+"""
+NumPy inference for the crop prediction model.
+
+The model is a multinomial logistic regression, so scoring is a matrix product followed by a
+softmax. Serving it from its coefficients avoids importing scikit-learn and building a
+DataFrame for every request.
+
+Export a trained model and check it against scikit-learn with:
+
+    python -m crop_model model/CropPrediction.pkl model/CropPrediction.npz
+"""
+import argparse
+import io
+import sys
+
+import numpy as np
+
+FEATURES = ['N', 'P', 'K', 'temperature', 'humidity', 'ph', 'rainfall']
+
+# The exported probabilities may differ from scikit-learn's by rounding error only
+TOLERANCE = 1e-12
+
+
+class CropModel:
+    """
+    A multinomial logistic regression model, scored with NumPy.
+
+    Like the scikit-learn model it replaces, predict_proba takes one row of features per
+    location, in FEATURES order, and classes_ holds the crop of each probability column.
+    """
+
+    def __init__(self, coef, intercept, classes, feature_names=FEATURES):
+        self.coef = np.ascontiguousarray(coef, dtype=np.float64)
+        self.intercept = np.asarray(intercept, dtype=np.float64)
+        self.classes_ = np.asarray(classes)
+        self.feature_names = list(feature_names)
+        self.n_features_in_ = self.coef.shape[1]
+        # Transposed once so scoring is a single matrix product
+        self._weights = np.ascontiguousarray(self.coef.T)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        """Build a CropModel from a fitted scikit-learn LogisticRegression."""
+        if len(model.classes_) < 3 or model.coef_.shape[0] != len(model.classes_):
+            raise ValueError('Only multinomial models with three or more classes can be exported')
+        feature_names = getattr(model, 'feature_names_in_', FEATURES)
+        return cls(model.coef_, model.intercept_, model.classes_, feature_names)
+
+    @classmethod
+    def load(cls, path_or_bytes):
+        """Load a model saved with save, from a path or the file's bytes."""
+        source = io.BytesIO(path_or_bytes) if isinstance(path_or_bytes, bytes) else path_or_bytes
+        with np.load(source, allow_pickle=False) as data:
+            return cls(data['coef'], data['intercept'], data['classes'], data['feature_names'].tolist())
+
+    def save(self, path):
+        np.savez(path, coef=self.coef, intercept=self.intercept, classes=self.classes_.astype(str),
+                 feature_names=np.array(self.feature_names))
+
+    def predict_proba(self, features):
+        """
+        Get the probability of each crop.
+
+        A row gets the same probabilities alone or in a batch within floating-point tolerance,
+        not always bit for bit: the matrix product may sum in a different order for other
+        batch sizes.
+
+        Parameters:
+        - features (array-like): One row of features or a matrix with one row per location.
+
+        Returns:
+        - ndarray: The probabilities, with the shape of the input's rows by the classes.
+        """
+        features = np.asarray(features, dtype=np.float64)
+        if features.ndim == 1:
+            # Scored as a one-row matrix, the same path as a batch
+            return self.predict_proba(features[np.newaxis])[0]
+
+        scores = features @ self._weights + self.intercept
+        # Subtract the largest score before exponentiating so exp cannot overflow
+        scores -= scores.max(axis=-1, keepdims=True)
+        np.exp(scores, out=scores)
+        scores /= scores.sum(axis=-1, keepdims=True)
+        return scores
+
+    def verify(self, model, features):
+        """
+        Check that this model gives the same probabilities as a scikit-learn model.
+
+        Returns:
+        - float: The largest difference between the two, at most TOLERANCE.
+        """
+        expected = model.predict_proba(features)
+        difference = np.abs(self.predict_proba(np.asarray(features)) - expected).max()
+        if not difference <= TOLERANCE:
+            raise ValueError(f'The exported model differs from scikit-learn by up to {difference}')
+        return difference
+
+
+def top_k(probabilities, k=3):
+    """
+    Get the indexes of the k largest probabilities, largest first, for one row or each row of a matrix.
+
+    Only the k largest values are sorted, which is cheaper than sorting every class.
+    """
+    probabilities = np.asarray(probabilities)
+    k = min(k, probabilities.shape[-1])
+    candidates = np.argpartition(-probabilities, k - 1, axis=-1)[..., :k]
+    order = np.argsort(-np.take_along_axis(probabilities, candidates, axis=-1), axis=-1, kind='stable')
+    return np.take_along_axis(candidates, order, axis=-1)
+
+
+def export(model_path, output_path, data_path='data/Crop_recommendation.csv'):
+    """
+    Export a pickled scikit-learn model to an .npz file, checked against the training data.
+
+    Returns:
+    - float: The largest difference between the exported and the scikit-learn probabilities.
+    """
+    import pickle
+
+    import pandas as pd
+
+    with open(model_path, 'rb') as f:
+        model = pickle.load(f)
+    crop_model = CropModel.from_sklearn(model)
+
+    features = pd.read_csv(data_path)[crop_model.feature_names]
+    difference = crop_model.verify(model, features)
+    crop_model.save(output_path)
+    return difference
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('model', help='Pickled scikit-learn model')
+    parser.add_argument('output', help='Where to write the .npz file')
+    parser.add_argument('--data', default='data/Crop_recommendation.csv', help='Rows to check the export on')
+    args = parser.parse_args()
+
+    try:
+        difference = export(args.model, args.output, args.data)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
+    print(f'Exported {args.model} to {args.output}, largest difference from scikit-learn: {difference:.3g}')
+
+
+if __name__ == '__main__':
+    main()
@@ -15,4 +15,33 @@ class UnsupportedCropError(Exception):
         return f'{self.crop} -> {self.message}'
     
 class FileReadError(Exception):
-    """Exception raised when a file read operation fails."""
\ No newline at end of file
+    """Exception raised when a file read operation fails."""
+
+class UpstreamTimeoutError(Exception):
+    """Exception raised when a data source does not answer in time.
+
+    Attributes:
+        source -- name of the data source which timed out
+        timeout -- seconds the data source was given
+    """
+
+    def __init__(self, source, timeout):
+        self.source = source
+        self.timeout = timeout
+        super().__init__(f'{source} did not respond within {timeout} seconds')
+
+class UpstreamUnavailableError(Exception):
+    """Exception raised when calls to a failing data source are paused by its circuit breaker.
+
+    Attributes:
+        source -- name of the data source
+        retry_after -- seconds until the data source is tried again
+    """
+
+    def __init__(self, source, retry_after):
+        self.source = source
+        self.retry_after = retry_after
+        super().__init__(f'{source} is unavailable, retrying in {retry_after:.0f} seconds')
+
+class InvalidRegionError(ValueError):
+    """Exception raised when an export request has an unusable region, grid step or resume token."""
@@ -1,8 +1,33 @@
+import argparse
+import os
+
+import numpy as np
 import rasterio
+import rasterio.shutil
 from rasterio.mask import mask
+from rasterio.vrt import WarpedVRT
+from rasterio.enums import Resampling
 import geopandas as gpd
 
-def download_and_save_geotiff(name, link, geojson_path):
+# 0-30 cm nutrient aggregates for Africa at 250 m
+NUTRIENT_SOURCES = {
+    "kenya_phosphorus": "https://files.isric.org/public/af250m_nutrient/af250m_nutrient_p_m_agg30cm.tif",
+    "kenya_potassium": "https://files.isric.org/public/af250m_nutrient/af250m_nutrient_k_m_agg30cm.tif",
+}
+
+# SoilGrids layers are published per depth in the Homolosine projection
+SOILGRIDS_URL = "https://files.isric.org/soilgrids/latest/data/{property}/{property}_{depth}_mean.vrt"
+SOILGRIDS_DEPTHS = ["0-5cm", "5-15cm", "15-30cm"]
+SOILGRIDS_PROPERTIES = {
+    "kenya_nitrogen": "nitrogen",
+    "kenya_phh2o": "phh2o",
+}
+
+# Output resolution for the SoilGrids layers, roughly their native 250 m
+SOILGRIDS_RESOLUTION_DEGREES = 0.0025
+
+
+def download_and_save_geotiff(name, link, geojson_path, output_dir="."):
     # Read GeoJSON
     gdf = gpd.read_file(geojson_path)
 
@@ -20,14 +45,89 @@ def download_and_save_geotiff(name, link, geojson_path):
         })
 
         # Save the cropped GeoTIFF
-        with rasterio.open(f"{name}.tif", "w", **out_meta) as dest:
+        path = os.path.join(output_dir, f"{name}.tif")
+        with rasterio.open(path, "w", **out_meta) as dest:
             dest.write(out_image)
 
-    print(f"Cropped GeoTIFF saved as {name}.tif")
+    print(f"Cropped GeoTIFF saved as {path}")
+
+
+def build_soilgrids_mean_geotiff(name, property_name, geojson_path, output_dir="."):
+    """
+    Build a Cloud-Optimized GeoTIFF with the 0-30 cm mean of a SoilGrids property.
+
+    The three shallowest depth layers are reprojected to EPSG:4326, clipped to the
+    GeoJSON and averaged, the same way soil_service derives the value from the
+    SoilGrids REST API. Values are kept in SoilGrids' mapped units (e.g. pH*10), and
+    pixels with no data are written as NaN.
+
+    Parameters:
+    - name (str): Output file name without extension.
+    - property_name (str): SoilGrids property, e.g. "nitrogen" or "phh2o".
+    - geojson_path (str): Path to the GeoJSON with the area to keep.
+    - output_dir (str): Directory to write the GeoTIFF to.
+    """
+    gdf = gpd.read_file(geojson_path).to_crs("EPSG:4326")
+    west, south, east, north = gdf.total_bounds
+    width = int(np.ceil((east - west) / SOILGRIDS_RESOLUTION_DEGREES))
+    height = int(np.ceil((north - south) / SOILGRIDS_RESOLUTION_DEGREES))
+    transform = rasterio.transform.from_origin(west, north, SOILGRIDS_RESOLUTION_DEGREES, SOILGRIDS_RESOLUTION_DEGREES)
+
+    depth_values = []
+    for depth in SOILGRIDS_DEPTHS:
+        url = SOILGRIDS_URL.format(property=property_name, depth=depth)
+        with rasterio.open(url) as src:
+            with WarpedVRT(src, crs="EPSG:4326", transform=transform, width=width, height=height,
+                           resampling=Resampling.nearest) as vrt:
+                out_image, out_transform = mask(vrt, gdf.geometry, crop=True, filled=False)
+        depth_values.append(out_image[0].astype(np.float32))
+        print(f"Read {property_name} {depth}")
+
+    # A pixel with no data at any depth has no data in the mean
+    stacked = np.ma.stack(depth_values)
+    mean = np.where(np.ma.getmaskarray(stacked).any(axis=0), np.nan, stacked.filled(0).mean(axis=0))
+
+    out_meta = {
+        "driver": "GTiff",
+        "dtype": "float32",
+        "nodata": np.nan,
+        "count": 1,
+        "crs": "EPSG:4326",
+        "height": mean.shape[0],
+        "width": mean.shape[1],
+        "transform": out_transform,
+    }
+
+    # COG can only be created as a copy, so write a plain GeoTIFF first
+    path = os.path.join(output_dir, f"{name}.tif")
+    temporary_path = os.path.join(output_dir, f"{name}.tmp.tif")
+    with rasterio.open(temporary_path, "w", **out_meta) as dest:
+        dest.write(mean.astype(np.float32), 1)
+    rasterio.shutil.copy(temporary_path, path, driver="COG", compress="DEFLATE", predictor=3, blocksize=256)
+    os.remove(temporary_path)
+
+    print(f"Cloud-Optimized GeoTIFF saved as {path}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Prepare the local soil rasters for Kenya.")
+    parser.add_argument("--geojson", default="kenya.geojson", help="Area to clip the rasters to")
+    parser.add_argument("--output-dir", default="data", help="Directory to write the rasters to")
+    parser.add_argument("--only", nargs="+", choices=list(NUTRIENT_SOURCES) + list(SOILGRIDS_PROPERTIES),
+                        help="Only build these rasters")
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    # Download and save GeoTIFFs
+    for name, link in NUTRIENT_SOURCES.items():
+        if args.only is None or name in args.only:
+            download_and_save_geotiff(name, link, args.geojson, args.output_dir)
+
+    for name, property_name in SOILGRIDS_PROPERTIES.items():
+        if args.only is None or name in args.only:
+            build_soilgrids_mean_geotiff(name, property_name, args.geojson, args.output_dir)
 
-# Define paths to input files
-kenya_geojson_path = "kenya.geojson"  # Replace with the actual path to your Kenya GeoJSON file
 
-# Download and save GeoTIFFs
-download_and_save_geotiff("kenya_phosphorus", "https://files.isric.org/public/af250m_nutrient/af250m_nutrient_p_m_agg30cm.tif", kenya_geojson_path)
-download_and_save_geotiff("kenya_potassium", "https://files.isric.org/public/af250m_nutrient/af250m_nutrient_k_m_agg30cm.tif", kenya_geojson_path)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Regular longitude/latitude grids, used to snap locations to shared cache cells.
+
+A cell is identified by its column and row, counted in cells of `cell_degrees` from
+longitude 0 and latitude 0, as the string 'column:row'.
+"""
+import math
+
+import numpy as np
+
+
+def cell_for(longitude, latitude, cell_degrees):
+    """Get the id of the grid cell containing a location."""
+    return f'{math.floor(longitude / cell_degrees)}:{math.floor(latitude / cell_degrees)}'
+
+
+def cell_center(cell, cell_degrees):
+    """Get the (longitude, latitude) of the center of a grid cell."""
+    column, row = (int(part) for part in cell.split(':'))
+    return (column + 0.5) * cell_degrees, (row + 0.5) * cell_degrees
+
+
+def grid_extent(bounds, step):
+    """
+    Get the cells of size `step` degrees that cover a bounding box.
+
+    Parameters:
+    - bounds (tuple): (min_lon, min_lat, max_lon, max_lat).
+    - step (float): The cell size in degrees.
+
+    Returns:
+    - tuple: The column and row of the south-west cell, and the number of columns and rows.
+    """
+    min_longitude, min_latitude, max_longitude, max_latitude = bounds
+    first_column, first_row = math.floor(min_longitude / step), math.floor(min_latitude / step)
+    width = max(1, math.ceil(max_longitude / step) - first_column)
+    height = max(1, math.ceil(max_latitude / step) - first_row)
+    return first_column, first_row, width, height
+
+
+def cell_centers(first, count, step):
+    """Get the coordinates of the centers of `count` consecutive columns or rows, rounded to 6 decimals."""
+    return ((first + np.arange(count) + 0.5) * step).round(6)
+
+
+def iter_rows_inside(area, step, bounds=None, first_row=0):
+    """
+    Yield the cells of a grid whose centers are inside an area, one row at a time.
+
+    The grid covers `bounds`, by default the area's bounding box, and its rows are yielded
+    from south to north starting at row index `first_row`. Pass a prepared geometry, see
+    shapely.prepare, to make the containment tests fast.
+
+    Yields:
+    - tuple: The index of the row, the latitude of its centers, and the longitudes and
+      column indexes of its cells inside the area.
+    """
+    import shapely  # Imported lazily to keep start-up fast
+
+    first_column, first_grid_row, width, height = grid_extent(bounds or area.bounds, step)
+    longitudes = cell_centers(first_column, width, step)
+    latitudes = cell_centers(first_grid_row, height, step)
+    for row in range(first_row, height):
+        latitude = float(latitudes[row])
+        columns = np.flatnonzero(shapely.contains_xy(area, longitudes, np.full(width, latitude)))
+        yield row, latitude, longitudes[columns], columns
@@ -0,0 +1,32 @@
+# Gunicorn settings for serving wsgi:app. Every setting can be overridden with an
+# environment variable.
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8080)}"
+
+# One worker per core by default, each with a few threads for requests waiting on upstream I/O
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 4))
+
+# Load the app (model, crop catalog, rasters) once in the master and fork the workers from it.
+# SIGHUP then restarts the workers from the master's copy and reloads no code: deploy with a
+# USR2 + WINCH binary upgrade or a restart, see the README.
+preload_app = True
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 60))
+graceful_timeout = int(os.environ.get('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+
+# Recycle workers now and then, staggered so they do not all restart at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 1000))
+
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    # GDAL dataset handles cannot be shared between processes, so each worker reopens them
+    from tif_reader import sampler
+    sampler.reopen()
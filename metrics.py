@@ -0,0 +1,175 @@
+import contextvars
+import functools
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# Fraction of requests that are timed, 0 turns timing off
+METRICS_SAMPLE_RATE = float(os.environ.get('METRICS_SAMPLE_RATE', 1.0))
+
+# Upper bounds (in seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Whether the current request is timed, and the spans recorded for it
+_sampled = contextvars.ContextVar('sampled', default=METRICS_SAMPLE_RATE > 0)
+_timings = contextvars.ContextVar('timings', default=None)
+
+
+class Histogram:
+    """A Prometheus-style histogram with one series per label value."""
+
+    def __init__(self, name, description, label, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][i] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for label_value, series in sorted(self._series.items()):
+                labels = f'{self.label}="{label_value}"'
+                cumulative = 0
+                for bound, count in zip(self.buckets, series['counts']):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {series["count"]}')
+                lines.append(f'{self.name}_sum{{{labels}}} {series["sum"]}')
+                lines.append(f'{self.name}_count{{{labels}}} {series["count"]}')
+        return lines
+
+
+dependency_latency = Histogram('smartfarm_dependency_duration_seconds',
+                               'Time spent in each dependency of a request', 'dependency')
+request_latency = Histogram('smartfarm_request_duration_seconds',
+                            'Time spent handling each endpoint', 'endpoint')
+
+# (name, stats function) of each cache and upstream client reported on /metrics
+_cache_collectors = []
+_upstream_collectors = []
+
+
+@contextmanager
+def span(name):
+    """Time a block of code as the dependency `name`, if the current request is sampled."""
+    if not _sampled.get():
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start)
+
+
+def record_span(name, duration):
+    """Record `duration` seconds, measured by the caller, as the dependency `name`, if the current request is sampled."""
+    if not _sampled.get():
+        return
+    dependency_latency.observe(name, duration)
+    timings = _timings.get()
+    if timings is not None:
+        timings.append((name, duration))
+
+
+def timed(name):
+    """Decorator form of span."""
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_request():
+    """Decide whether the current request is timed and start collecting its spans."""
+    sampled = METRICS_SAMPLE_RATE >= 1 or random.random() < METRICS_SAMPLE_RATE
+    _sampled.set(sampled)
+    _timings.set([] if sampled else None)
+    return time.perf_counter() if sampled else None
+
+
+def finish_request(endpoint, start):
+    """
+    Record the request's total time.
+
+    Returns:
+    - str: The Server-Timing header value, or None if the request was not sampled.
+    """
+    if start is None:
+        return None
+
+    duration = time.perf_counter() - start
+    request_latency.observe(endpoint, duration)
+
+    # Spans of the same dependency (e.g. the two raster reads) are added up
+    totals = {}
+    for name, span_duration in _timings.get() or []:
+        totals[name] = totals.get(name, 0.0) + span_duration
+    entries = [f'{name};dur={span_duration * 1000:.1f}' for name, span_duration in totals.items()]
+    entries.append(f'total;dur={duration * 1000:.1f}')
+    return ', '.join(entries)
+
+
+def register_cache(name, stats):
+    """Report a cache's hits, misses and hit ratio on /metrics. stats returns a dict like SoilCache.stats()."""
+    _cache_collectors.append((name, stats))
+
+
+def register_upstream(name, stats):
+    """Report an upstream client's calls, failures and circuit state on /metrics. stats is UpstreamClient.stats."""
+    _upstream_collectors.append((name, stats))
+
+
+def render():
+    """Render all metrics in the Prometheus text format."""
+    lines = dependency_latency.render() + request_latency.render()
+
+    lines += ['# HELP smartfarm_cache_hits_total Cache hits', '# TYPE smartfarm_cache_hits_total counter']
+    cache_stats = []
+    for name, stats in _cache_collectors:
+        try:
+            cache_stats.append((name, stats()))
+        except Exception:
+            continue
+    lines += [f'smartfarm_cache_hits_total{{cache="{name}"}} {stats["hits"]}' for name, stats in cache_stats]
+    lines += ['# HELP smartfarm_cache_misses_total Cache misses', '# TYPE smartfarm_cache_misses_total counter']
+    lines += [f'smartfarm_cache_misses_total{{cache="{name}"}} {stats["misses"]}' for name, stats in cache_stats]
+    lines += ['# HELP smartfarm_cache_hit_ratio Share of lookups served from the cache',
+              '# TYPE smartfarm_cache_hit_ratio gauge']
+    lines += [f'smartfarm_cache_hit_ratio{{cache="{name}"}} {stats["hit_ratio"]}' for name, stats in cache_stats]
+
+    upstream_stats = [(name, stats()) for name, stats in _upstream_collectors]
+    for counter, description in [('calls', 'Calls made to the upstream'),
+                                 ('failures', 'Calls that failed after their retries'),
+                                 ('retries', 'Attempts retried'),
+                                 ('rejected', 'Calls rejected while the circuit was open')]:
+        lines += [f'# HELP smartfarm_upstream_{counter}_total {description}',
+                  f'# TYPE smartfarm_upstream_{counter}_total counter']
+        lines += [f'smartfarm_upstream_{counter}_total{{upstream="{name}"}} {stats[counter]}'
+                  for name, stats in upstream_stats]
+    lines += ['# HELP smartfarm_upstream_circuit_open Whether calls to the upstream are paused',
+              '# TYPE smartfarm_upstream_circuit_open gauge']
+    lines += [f'smartfarm_upstream_circuit_open{{upstream="{name}"}} {int(stats["state"] != "closed")}'
+              for name, stats in upstream_stats]
+
+    return '\n'.join(lines) + '\n'
@@ -110,3 +110,12 @@ directory = './model'
 filepath = os.path.join(directory, filename)
 
 pickle.dump(LogisticRegressionModel, open(filepath, 'wb'))
+
+# Export the coefficients for the API, which scores them with NumPy. The export is checked
+# against the sklearn model on the test set. Run this script from the repository root with
+# python -m model.model so crop_model can be imported.
+from crop_model import CropModel
+
+crop_model = CropModel.from_sklearn(LogisticRegressionModel)
+print("Largest difference from sklearn: ", crop_model.verify(LogisticRegressionModel, X_test))
+crop_model.save(os.path.join(directory, 'CropPrediction.npz'))
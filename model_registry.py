@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import os
+import pickle
+import sys
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+from crop_model import CropModel
+
+# The exported model (see crop_model.py), or a pickled scikit-learn model which is converted when loaded
+MODEL_PATH = os.environ.get('MODEL_PATH', 'model/CropPrediction.npz')
+
+# How often (in seconds) to stat the model file for changes
+MODEL_CHECK_INTERVAL = float(os.environ.get('MODEL_CHECK_INTERVAL', 5))
+
+
+class ModelRegistry:
+    """
+    Keeps the crop prediction model in memory and hot-reloads it when the file changes.
+
+    The model is loaded once and shared by every request. The file's mtime is checked at
+    most once every `check_interval` seconds; when it changes, the checksum decides whether
+    the model is actually reloaded. A new model is fully loaded before it replaces the old
+    one, so requests never see a half-loaded model.
+    """
+
+    def __init__(self, path, check_interval=MODEL_CHECK_INTERVAL):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._model = None
+        self._mtime = None
+        self._checksum = None
+        self._last_check = 0.0
+        self.load_time = None
+        self.memory_bytes = None
+        self.loaded_at = None
+
+    def get(self):
+        """Return the current model, loading or reloading it if needed."""
+        if self._model is None or time.monotonic() - self._last_check >= self.check_interval:
+            self._refresh()
+        return self._model
+
+    def warm_up(self):
+        """Load the model and run a dummy prediction so the first request pays no start-up cost."""
+        model = self.get()
+        model.predict_proba(np.zeros((1, model.n_features_in_)))
+        return self.stats()
+
+    def stats(self):
+        return {
+            'path': self.path,
+            'checksum': self._checksum,
+            'loaded_at': self.loaded_at,
+            'load_time_seconds': self.load_time,
+            'memory_bytes': self.memory_bytes,
+        }
+
+    def _refresh(self):
+        with self._lock:
+            # Another thread may have refreshed while we waited for the lock
+            if self._model is not None and time.monotonic() - self._last_check < self.check_interval:
+                return
+            self._last_check = time.monotonic()
+
+            try:
+                mtime = os.path.getmtime(self.path)
+                if self._model is not None and mtime == self._mtime:
+                    return
+
+                with open(self.path, 'rb') as f:
+                    raw = f.read()
+                checksum = hashlib.sha256(raw).hexdigest()
+                if self._model is not None and checksum == self._checksum:
+                    # File was touched but the content is unchanged
+                    self._mtime = mtime
+                    return
+
+                start = time.perf_counter()
+                model = _load_model(self.path, raw)
+                load_time = time.perf_counter() - start
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile, pickle.UnpicklingError):
+                # Keep serving the last good model if there is one, e.g. while a new one is being copied
+                if self._model is not None:
+                    logging.exception(f"Failed to reload '{self.path}', keeping the previous model")
+                    return
+                raise
+
+            # Swap everything in at once
+            self._model = model
+            self._mtime = mtime
+            self._checksum = checksum
+            self.load_time = load_time
+            self.memory_bytes = _estimate_memory(model)
+            self.loaded_at = time.time()
+
+            logging.info(f'Loaded model {self.path} ({checksum[:12]}) in {load_time * 1000:.1f} ms, '
+                         f'~{self.memory_bytes} bytes in memory')
+
+
+def _load_model(path, raw):
+    if path.endswith('.npz'):
+        return CropModel.load(raw)
+
+    # Needs scikit-learn, which the exported model does not
+    return CropModel.from_sklearn(pickle.loads(raw))
+
+
+def _estimate_memory(model):
+    # The fitted parameters are numpy arrays, which dominate the model's footprint
+    total = sys.getsizeof(model)
+    for value in vars(model).values():
+        if isinstance(value, np.ndarray):
+            total += value.nbytes
+        else:
+            total += sys.getsizeof(value)
+    return total
+
+
+registry = ModelRegistry(MODEL_PATH)
+
+
+def get_model():
+    return registry.get()
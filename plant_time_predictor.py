@@ -1,6 +1,7 @@
 from datetime import datetime, timedelta
-import pandas as pd
-from weather_service import get_rainfall_history
+import numpy as np
+from weather_service import calculate_average_rainfall, get_rainfall_history, weather_grid_point
+from climatology import store as climatology_store
 
 def recommend_plant_time_recommendations(longitude, latitude, planting_duration):
     """
@@ -15,58 +16,133 @@ def recommend_plant_time_recommendations(longitude, latitude, planting_duration)
         list: A list of recommended planting dates.
 
     """
-    # Get the rainfall history
-    rainfall_history = get_rainfall_history(longitude=longitude, latitude=latitude)
-
-    # Calculate the average rainfall
-    rainfall_prediction = calculate_average_rainfall(rainfall_history)
+    # Get the average rainfall for each day of the year
+    average_rainfall = get_average_rainfall(longitude=longitude, latitude=latitude)
 
     # Find the best planting windows
-    best_windows = find_best_planting_windows(rainfall_prediction, window_size=planting_duration)
+    best_windows = find_best_planting_windows(average_rainfall, window_size=planting_duration)
 
     # Get the recommendation dates
     recommended_dates = get_recommendation_dates(best_windows)
 
     return recommended_dates
 
-def calculate_average_rainfall(df):
-    # Convert the date to datetime and set it as the index
-    df['date'] = pd.to_datetime(df['date'])
-    df.set_index('date', inplace=True)
+def recommend_planting_calendar(longitude, latitude, planting_durations):
+    """
+    Get plant time recommendations for several crops at once.
+
+    The average rainfall is looked up once and the windows of every distinct duration are
+    found in one vectorized pass, so each extra crop costs almost nothing.
+
+    Args:
+        longitude (float): The longitude of the location.
+        latitude (float): The latitude of the location.
+        planting_durations (dict): The duration of the planting window of each crop.
+
+    Returns:
+        dict: The recommended planting dates of each crop.
+
+    """
+    average_rainfall = get_average_rainfall(longitude=longitude, latitude=latitude)
+
+    # Crops with the same duration share their windows
+    durations = sorted(set(planting_durations.values()))
+    best_windows = find_best_planting_windows_for_durations(average_rainfall, durations)
+    dates_by_duration = {duration: get_recommendation_dates(windows) for duration, windows in zip(durations, best_windows)}
+
+    return {crop: dates_by_duration[duration] for crop, duration in planting_durations.items()}
+
+def get_average_rainfall(longitude, latitude):
+    """
+    Get the average rainfall for each day of the year at a location.
+
+    The vector comes from the climatology store, which has one per weather grid point. If
+    the location's grid point has not been built this year, it is computed from the rainfall
+    history at the grid point and stored.
+
+    Args:
+        longitude (float): The longitude of the location.
+        latitude (float): The latitude of the location.
 
-    # Group by day of year and calculate the mean
-    avg_df = df.groupby(df.index.dayofyear).mean()
+    Returns:
+        ndarray: The average rainfall for days 1 to 365.
 
-    # Reset the index
-    avg_df.reset_index(inplace=True)
+    """
+    grid_longitude, grid_latitude = weather_grid_point(longitude, latitude)
+    cell = climatology_store.cell_for(grid_longitude, grid_latitude)
+    average_rainfall = climatology_store.get(cell)
 
-    # Explicitly set the column names
-    avg_df.columns = ['day_of_year', 'average_rainfall']
+    if average_rainfall is None:
+        rainfall_history = get_rainfall_history(longitude=grid_longitude, latitude=grid_latitude)
+        average_rainfall = calculate_average_rainfall(rainfall_history)
+        climatology_store.put(cell, average_rainfall)
 
-    return avg_df
+    return average_rainfall
 
-def find_best_planting_windows(df, window_size, num_windows=3, min_days_between=30):
-    # Calculate the rolling sum of rainfall
-    df['rolling_rainfall'] = df['average_rainfall'].rolling(window_size, min_periods=1).sum()
+def find_best_planting_windows(average_rainfall, window_size, num_windows=3, min_days_between=30):
+    """
+    Find the days of the year that end the rainiest windows of a given size.
 
-    # Initialize a list to store the best windows
-    best_windows = []
+    Args:
+        average_rainfall (array-like): The average rainfall for each day of the year, starting at day 1.
+        window_size (int): The size of the window in days.
+        num_windows (int): The number of windows to find.
+        min_days_between (int): The minimum number of days between two windows.
 
-    # While we need more windows
-    while len(best_windows) < num_windows:
-        # Find the maximum rolling sum
-        max_rainfall = df['rolling_rainfall'].max()
+    Returns:
+        list: The day of the year of each window, best first.
 
-        # Find the day of the year with this maximum rolling sum
-        best_day = df[df['rolling_rainfall'] == max_rainfall]['day_of_year'].values[0]
+    """
+    return find_best_planting_windows_for_durations(average_rainfall, [window_size], num_windows, min_days_between)[0]
 
-        # Convert best_day to a Python int before appending
-        best_windows.append(int(best_day))
+def find_best_planting_windows_for_durations(average_rainfall, window_sizes, num_windows=3, min_days_between=30):
+    """
+    Find the best planting windows for several window sizes in one vectorized pass.
+
+    The year is treated as circular, so windows can span December to January. The rolling
+    rainfall sum ending on each day comes from a prefix sum over two copies of the year, and
+    each window is picked with an argmax over the days not yet excluded. After a pick, the
+    days within window_size + min_days_between of it are excluded.
+
+    Args:
+        average_rainfall (array-like): The average rainfall for each day of the year, starting at day 1.
+        window_sizes (array-like): The window sizes in days.
+        num_windows (int): The number of windows to find for each size.
+        min_days_between (int): The minimum number of days between two windows.
+
+    Returns:
+        list: For each window size, the day of the year of each window, best first. There may be
+        fewer than num_windows days if the year runs out of room.
+
+    """
+    average_rainfall = np.asarray(average_rainfall, dtype=np.float64)
+    days_in_year = len(average_rainfall)
+    window_sizes = np.minimum(np.asarray(window_sizes, dtype=np.int64), days_in_year)
+
+    # Rolling sum of the window ending on each day, wrapping around the start of the year
+    prefix_sum = np.concatenate(([0.0], np.cumsum(np.tile(average_rainfall, 2))))
+    window_ends = days_in_year + 1 + np.arange(days_in_year)
+    rolling_rainfall = prefix_sum[window_ends] - prefix_sum[window_ends - window_sizes[:, np.newaxis]]
+
+    days = np.arange(days_in_year)
+    exclusion_distance = (window_sizes + min_days_between)[:, np.newaxis]
+    available = np.ones(rolling_rainfall.shape, dtype=bool)
+    best_windows = [[] for _ in window_sizes]
+
+    for _ in range(num_windows):
+        candidates = np.where(available, rolling_rainfall, -np.inf)
+        best_days = candidates.argmax(axis=1)
+        found = np.isfinite(candidates[np.arange(len(window_sizes)), best_days])
+        if not found.any():
+            break
+
+        for i in np.flatnonzero(found):
+            best_windows[i].append(int(best_days[i]) + 1)
 
         # Remove the window and the days around it from consideration
-        start_day = max(0, best_day - window_size - min_days_between)
-        end_day = min(365, best_day + window_size + min_days_between)
-        df = df[(df['day_of_year'] < start_day) | (df['day_of_year'] > end_day)]
+        distance = np.abs(days - best_days[:, np.newaxis])
+        distance = np.minimum(distance, days_in_year - distance)
+        available &= distance > exclusion_distance
 
     return best_windows
 
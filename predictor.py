@@ -1,19 +1,48 @@
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
-import pickle
-import pandas as pd
 
-from soil_service import get_soil_properties, LocationNotSupportedError
-from weather_service import get_estimated_weather_conditions
-from plant_time_predictor import recommend_plant_time_recommendations
-from utils import get_planting_duration
-from errors import UnsupportedCropError
+from coverage_index import index as coverage_index
+from soil_service import get_soil_properties_batch, get_nitrogen_and_ph, get_phosphorus_and_potassium, combine_soil_properties, LocationNotSupportedError
+from weather_service import get_estimated_weather_conditions, weather_grid_point
+from plant_time_predictor import recommend_plant_time_recommendations, recommend_planting_calendar
+from utils import get_planting_duration, get_planting_durations
+from errors import UnsupportedCropError, UpstreamTimeoutError
+from model_registry import get_model
+from crop_model import FEATURES, top_k
+from metrics import record_span, span
+from upstream import call_all, deadline
+
+# Shared pool for the I/O legs of a request, bounded so a burst of requests cannot
+# open an unbounded number of upstream connections
+PIPELINE_WORKERS = int(os.environ.get('PIPELINE_WORKERS', 16))
+_executor = ThreadPoolExecutor(max_workers=PIPELINE_WORKERS, thread_name_prefix='pipeline')
+
+# Seconds each leg may take, counted from the start of the request
+NITROGEN_AND_PH_TIMEOUT = float(os.environ.get('NITROGEN_AND_PH_TIMEOUT', 15))
+PHOSPHORUS_AND_POTASSIUM_TIMEOUT = float(os.environ.get('PHOSPHORUS_AND_POTASSIUM_TIMEOUT', 5))
+WEATHER_TIMEOUT = float(os.environ.get('WEATHER_TIMEOUT', 30))
+
+# Seconds a batch may spend gathering data, below gunicorn's timeout so a cold batch
+# answers with per-location errors instead of getting its worker killed
+BATCH_TIMEOUT = float(os.environ.get('BATCH_TIMEOUT', 45))
+
+# Crops recommended with this confidence (in percent) or less are left out
+MIN_CONFIDENCE = 20
 
 def get_crop_recommendations(longitude, latitude):
-    try:
-        soil_properties = get_soil_properties(longitude, latitude)
-    except LocationNotSupportedError as e:
-        raise e
-    estimated_weather_conditions = get_estimated_weather_conditions(longitude, latitude)
+    # Fetch the soil and weather data concurrently
+    legs = _run_concurrently({
+        'phosphorus_and_potassium': (get_phosphorus_and_potassium, PHOSPHORUS_AND_POTASSIUM_TIMEOUT),
+        'nitrogen_and_ph': (get_nitrogen_and_ph, NITROGEN_AND_PH_TIMEOUT),
+        'weather': (get_estimated_weather_conditions, WEATHER_TIMEOUT),
+    }, longitude, latitude, spans={'soil_properties': ('phosphorus_and_potassium', 'nitrogen_and_ph')})
+
+    soil_properties = combine_soil_properties(legs['nitrogen_and_ph'], legs['phosphorus_and_potassium'])
+    estimated_weather_conditions = legs['weather']
 
     data = {
        "N": soil_properties['nitrogen'],
@@ -25,27 +54,176 @@ def get_crop_recommendations(longitude, latitude):
         "rainfall": estimated_weather_conditions['rainfall']
     }
 
-    # Load the model
-    with open('model/CropPrediction.pkl', 'rb') as f:
-        model = pickle.load(f)
+    # Get the in-memory model
+    model = get_model()
 
-    # Prepare the data
-    input_data = pd.DataFrame([data], columns=['N', 'P', 'K', 'temperature', 'humidity', 'ph', 'rainfall'])
+    # Prepare the data, one value per feature in the model's order
+    input_data = np.array([data[feature] for feature in FEATURES], dtype=np.float64)
 
     # Get probabilities for each class
-    probabilities = model.predict_proba(input_data)[0]
+    with span('inference'):
+        probabilities = model.predict_proba(input_data)
 
-    # Get the top 3 predictions
-    top_three = np.argsort(probabilities)[-3:][::-1]
+    return _top_recommendations(probabilities, model.classes_)
+
+
+def get_batch_crop_recommendations(locations):
+    """
+    Get crop recommendations for many locations at once.
+
+    Soil features are gathered once per SoilGrids cell and weather once per weather grid
+    point, concurrently on the shared pool and within BATCH_TIMEOUT seconds, and the model
+    is run a single time on the stacked feature matrix.
+
+    Parameters:
+    - locations (list): A list of (longitude, latitude) pairs.
+
+    Returns:
+    - results (list): One entry per location, either {"recommendations": [...]} or
+      {"error": "..."}.
+    """
+    results = [None] * len(locations)
+
+    # Locations outside the supported areas are rejected before any data is gathered
+    covered = coverage_index.contains_points([longitude for longitude, _ in locations],
+                                             [latitude for _, latitude in locations])
+    covered_indexes = np.flatnonzero(covered).tolist()
+    for i in np.flatnonzero(~covered).tolist():
+        results[i] = {"error": "Location not supported"}
+
+    # Upstream calls are fanned out on the shared pool and all give up by the batch deadline
+    give_up_at = time.monotonic() + BATCH_TIMEOUT
+
+    soil_properties = {}
+    if covered_indexes:
+        soil_properties = dict(zip(covered_indexes, get_soil_properties_batch(
+            [locations[i][0] for i in covered_indexes], [locations[i][1] for i in covered_indexes],
+            executor=_executor, give_up_at=give_up_at)))
+
+    # Weather is fetched once per weather grid point, for a location of the grid point
+    location_grid_points = {}
+    weather_locations = {}
+    for i in covered_indexes:
+        longitude, latitude = locations[i]
+        soil = soil_properties[i]
+        if isinstance(soil, LocationNotSupportedError):
+            results[i] = {"error": "Location not supported"}
+            continue
+        if isinstance(soil, Exception):
+            logging.error(f'Failed to get soil properties for location {latitude}, {longitude}: {soil}')
+            results[i] = {"error": "Failed to get soil properties"}
+            continue
+
+        location_grid_points[i] = weather_grid_point(longitude, latitude)
+        weather_locations.setdefault(location_grid_points[i], (longitude, latitude))
+
+    weather_by_grid_point = dict(zip(weather_locations, call_all(
+        _executor, get_estimated_weather_conditions, weather_locations.values(), give_up_at, 'weather')))
 
-    # Get the class labels
-    class_labels = model.classes_
+    rows = []
+    row_indexes = []
+    for i, grid_point in location_grid_points.items():
+        weather = weather_by_grid_point[grid_point]
+        if isinstance(weather, Exception):
+            longitude, latitude = locations[i]
+            logging.error(f'Failed to get weather conditions for location {latitude}, {longitude}: {weather}')
+            results[i] = {"error": "Failed to get weather conditions"}
+            continue
+
+        soil = soil_properties[i]
+        rows.append([
+            soil['nitrogen'],
+            soil['phosphorus'],
+            soil['potassium'],
+            weather['temperature'],
+            weather['relative_humidity'],
+            soil['ph'],
+            weather['rainfall']
+        ])
+        row_indexes.append(i)
+
+    if rows:
+        model = get_model()
+        with span('inference'):
+            probabilities = model.predict_proba(np.array(rows, dtype=np.float64))
+        for i, row_probabilities in zip(row_indexes, probabilities):
+            results[i] = {"recommendations": _top_recommendations(row_probabilities, model.classes_)}
+
+    return results
+
+
+def _run_concurrently(legs, *args, spans=None):
+    """
+    Run independent I/O legs in parallel on the shared pool.
+
+    Parameters:
+    - legs (dict): Maps each leg's name to a (function, timeout) pair.
+    - args: Arguments passed to every function.
+    - spans (dict): Maps span names to the legs they time, from the start until the last
+      of them finishes.
+
+    Returns:
+    - results (dict): Each leg's result by name.
+
+    Raises:
+    - UpstreamTimeoutError: If a leg does not finish within its timeout.
+    - The first exception raised by a leg. Legs that have not started yet are cancelled.
+      Running legs cannot be interrupted, but their upstream calls give up at the leg's
+      timeout and their results are discarded.
+    """
+    start = time.monotonic()
+    # Each leg runs in a copy of the caller's context, so its timings are added to the request
+    futures = {
+        _executor.submit(contextvars.copy_context().run, _run_leg, start + timeout, function, *args): (name, timeout)
+        for name, (function, timeout) in legs.items()
+    }
+    open_spans = dict(spans or {})
+    finished = set()
+    results = {}
+    pending = set(futures)
+    try:
+        while pending:
+            next_deadline = min(start + futures[future][1] for future in pending)
+            done, pending = wait(pending, timeout=max(0, next_deadline - time.monotonic()), return_when=FIRST_COMPLETED)
+
+            # Spans end when their last leg finishes, whether it succeeded or not
+            finished.update(futures[future][0] for future in done)
+            for span_name, span_legs in list(open_spans.items()):
+                if finished.issuperset(span_legs):
+                    record_span(span_name, time.monotonic() - start)
+                    del open_spans[span_name]
+
+            for future in done:
+                # Raises the leg's exception, if any
+                results[futures[future][0]] = future.result()
+
+            for future in pending:
+                name, timeout = futures[future]
+                if time.monotonic() >= start + timeout:
+                    raise UpstreamTimeoutError(name, timeout)
+    except Exception:
+        for future in pending:
+            future.cancel()
+        raise
+
+    return results
+
+
+def _run_leg(give_up_at, function, *args):
+    # Upstream calls stop retrying once the leg has timed out, so they do not hold a worker for nothing
+    with deadline(give_up_at):
+        return function(*args)
+
+
+def _top_recommendations(probabilities, class_labels):
+    # Get the top 3 predictions
+    top_three = top_k(probabilities, 3)
 
     # Prepare the results
     results = []
     for i in top_three:
         confidence = round(probabilities[i] * 100)  # Convert to percentage and round off
-        if confidence > 20:
+        if confidence > MIN_CONFIDENCE:
             results.append({
                 "crop": class_labels[i],
                 "confidence": confidence
@@ -77,4 +255,26 @@ def get_plant_time_recommendations(longitude, latitude, crop_name):
     # Get the planting recommendations
     recommendations = recommend_plant_time_recommendations(longitude=longitude, latitude=latitude, planting_duration=planting_duration)
 
-    return recommendations
\ No newline at end of file
+    return recommendations
+
+def get_planting_calendar(longitude, latitude, crop_names=None):
+    """
+    Get plant time recommendations for several crops at a location in one pass.
+
+    Parameters:
+    - longitude (float): The longitude of the location.
+    - latitude (float): The latitude of the location.
+    - crop_names (list): The names of the crops, or None for every supported crop.
+
+    Returns:
+    - calendar (dict): The recommended plant time periods of each crop.
+
+    Raises:
+    - UnsupportedCropError: If one of the crops is not supported.
+    """
+    if crop_names is None:
+        planting_durations = get_planting_durations()
+    else:
+        planting_durations = {crop_name: get_planting_duration(crop_name) for crop_name in crop_names}
+
+    return recommend_planting_calendar(longitude=longitude, latitude=latitude, planting_durations=planting_durations)
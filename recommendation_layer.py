@@ -0,0 +1,288 @@
+"""
+Precomputed crop recommendations for a grid covering Kenya, one raster per planting month.
+
+The build runs the model over every pixel of the grid with each month's weather window
+and writes a GeoTIFF per month, with the indexes of the three most likely crops in bands
+1-3 and their confidence in percent in bands 4-6. The API answers crop recommendation
+requests with a single pixel read from the current month's raster, and only computes the
+recommendations for points the raster does not cover or when fresh ones are asked for.
+
+Build the rasters on the API host, with the API's environment, e.g. once a month:
+
+    python -m recommendation_layer --workers 4 --rate 5
+
+The rasters are replaced atomically and the API picks up new ones on its own.
+"""
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import numpy as np
+
+import grid
+from predictor import MIN_CONFIDENCE
+from tif_reader import sampler
+
+RECOMMENDATION_LAYER_DIR = os.environ.get('RECOMMENDATION_LAYER_DIR', 'recommendation_layer')
+
+# How often (in seconds) to stat a raster for changes
+RECOMMENDATION_LAYER_CHECK_INTERVAL = float(os.environ.get('RECOMMENDATION_LAYER_CHECK_INTERVAL', 60))
+
+TOP_CROPS = 3
+
+# Marks pixels without recommendations, in both the crop and the confidence bands
+NODATA = 255
+
+# Locations sent to get_soil_properties_batch at once while building
+SOIL_CHUNK_SIZE = 1000
+
+
+class RecommendationLayer:
+    """
+    Looks crop recommendations up in the precomputed rasters.
+
+    Pixels are read through the shared RasterSampler, so a lookup reads one cached block.
+    A raster's mtime is checked at most once every `check_interval` seconds, and a replaced
+    raster is reopened.
+    """
+
+    def __init__(self, directory=RECOMMENDATION_LAYER_DIR, check_interval=RECOMMENDATION_LAYER_CHECK_INTERVAL):
+        self.directory = directory
+        self.check_interval = check_interval
+        self._files = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, month):
+        return os.path.join(self.directory, raster_name(month))
+
+    def lookup(self, longitude, latitude, today=None):
+        """
+        Get the precomputed recommendations for a location in the current month.
+
+        Returns:
+        - list: The recommendations, like predictor.get_crop_recommendations returns them,
+          or None if the location is not covered.
+        """
+        path = self.path((today or date.today()).month)
+        values = None
+        try:
+            classes = self._classes(path)
+            if classes is not None:
+                values = sampler.sample(path, longitude, latitude, indexes=list(range(1, 2 * TOP_CROPS + 1)))
+        except IndexError:
+            pass
+        except Exception as e:
+            # The recommendations can always be computed instead, so a bad raster must not fail the request
+            logging.error(f'Failed to read the recommendations at {latitude}, {longitude} from {path}: {e}')
+
+        covered = values is not None and values[0] != NODATA
+        with self._lock:
+            if covered:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if not covered:
+            return None
+
+        crops, confidences = values[:TOP_CROPS], values[TOP_CROPS:]
+        return [{"crop": classes[crop], "confidence": int(confidence)}
+                for crop, confidence in zip(crops, confidences)
+                if crop != NODATA and confidence > MIN_CONFIDENCE]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+        }
+
+    def _classes(self, path):
+        # The crop names of a raster's class indexes, or None if there is no raster
+        now = time.monotonic()
+        entry = self._files.get(path)
+        if entry is not None and now - entry['checked_at'] < self.check_interval:
+            return entry['classes']
+
+        try:
+            mtime = os.stat(path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+
+        with self._lock:
+            if entry is None or entry['mtime'] != mtime:
+                sampler.forget(path)
+                classes = json.loads(sampler.tags(path)['classes']) if mtime is not None else None
+                entry = {'mtime': mtime, 'classes': classes}
+            entry['checked_at'] = now
+            self._files[path] = entry
+        return entry['classes']
+
+
+layer = RecommendationLayer()
+
+
+def raster_name(month):
+    return f'crop_recommendations_{month:02d}.tif'
+
+
+def planting_start(month, today=None):
+    """
+    Get the start of a month's planting window, the 15th of the month.
+
+    Each month is taken at its latest occurrence: this year once the month has started,
+    last year otherwise.
+    """
+    today = today or date.today()
+    return date(today.year if month <= today.month else today.year - 1, month, 15)
+
+
+def build(months, output_dir=RECOMMENDATION_LAYER_DIR, geojson_path='kenya.geojson', step=0.01, bbox=None,
+          workers=4, rate=5):
+    """
+    Build the rasters of the given months.
+
+    Soil properties are gathered once for every pixel inside the area and the weather once
+    per weather grid point and month, by a pool of `workers` threads making at most `rate`
+    calls per second to each upstream. Pixels whose data could not be gathered are left
+    empty, so the API computes their recommendations on request.
+    """
+    import shapely
+
+    from coverage_index import load_area
+    from crop_model import top_k
+    from model_registry import get_model
+    from soil_service import get_soil_properties_batch
+    from warm_cache import limit_upstream_rate
+    from weather_service import get_estimated_weather_conditions, weather_grid_point
+
+    area = load_area(geojson_path)
+    first_column, first_row, width, height = grid.grid_extent(bbox or area.bounds, step)
+
+    # Pixels inside the area, north-up: the first raster row is the northernmost one
+    shapely.prepare(area)
+    inside = np.zeros((height, width), dtype=bool)
+    for row, _, _, columns in grid.iter_rows_inside(area, step, bbox):
+        inside[height - 1 - row, columns] = True
+    pixels = np.flatnonzero(inside)
+    pixel_rows, pixel_columns = np.divmod(pixels, width)
+    point_longitudes = grid.cell_centers(first_column, width, step)[pixel_columns]
+    point_latitudes = grid.cell_centers(first_row, height, step)[height - 1 - pixel_rows]
+    print(f'{len(pixels)} pixels in a {width} x {height} grid')
+
+    limit_upstream_rate(rate)
+    executor = ThreadPoolExecutor(workers)
+
+    # Nitrogen, phosphorus, potassium and pH of every pixel, NaN where they are not available
+    soil = np.full((len(pixels), 4), np.nan)
+    chunks = range(0, len(pixels), SOIL_CHUNK_SIZE)
+    soil_chunks = executor.map(lambda first: get_soil_properties_batch(
+        point_longitudes[first:first + SOIL_CHUNK_SIZE], point_latitudes[first:first + SOIL_CHUNK_SIZE]), chunks)
+    for first, properties in zip(chunks, soil_chunks):
+        for i, values in enumerate(properties, first):
+            if isinstance(values, dict):
+                soil[i] = [values['nitrogen'], values['phosphorus'], values['potassium'], values['ph']]
+    has_soil = ~np.isnan(soil).any(axis=1)
+    print(f'Soil properties for {has_soil.sum()} pixels')
+
+    # Every pixel with soil data is mapped to its weather grid point
+    grid_points = [weather_grid_point(longitude, latitude)
+                   for longitude, latitude in zip(point_longitudes[has_soil], point_latitudes[has_soil])]
+    unique_points = sorted(set(grid_points))
+    grid_point_index = {point: i for i, point in enumerate(unique_points)}
+    point_weather_index = np.array([grid_point_index[point] for point in grid_points], dtype=np.int64)
+
+    model = get_model()
+    classes = [str(crop) for crop in model.classes_]
+    os.makedirs(output_dir, exist_ok=True)
+    try:
+        for month in months:
+            start_date = planting_start(month)
+
+            def weather_at(point):
+                try:
+                    conditions = get_estimated_weather_conditions(*point, start_date=start_date)
+                except Exception as e:
+                    logging.error(f'Failed to get weather conditions for {point} in month {month}: {e}')
+                    return [np.nan] * 3
+                return [conditions['temperature'], conditions['relative_humidity'], conditions['rainfall']]
+
+            weather = np.array(list(executor.map(weather_at, unique_points)), dtype=np.float64).reshape(-1, 3)
+            point_weather = weather[point_weather_index]
+
+            # Features in the model's order: N, P, K, temperature, humidity, ph, rainfall
+            nitrogen, phosphorus, potassium, ph = soil[has_soil].T
+            temperature, humidity, rainfall = point_weather.T
+            features = np.column_stack([nitrogen, phosphorus, potassium, temperature, humidity, ph, rainfall])
+            complete = ~np.isnan(features).any(axis=1)
+
+            bands = np.full((2 * TOP_CROPS, height * width), NODATA, dtype=np.uint8)
+            predicted_pixels = pixels[has_soil][complete]
+            probabilities = model.predict_proba(features[complete])
+            top = top_k(probabilities, TOP_CROPS)
+            confidences = np.rint(np.take_along_axis(probabilities, top, axis=1) * 100)
+            bands[:TOP_CROPS, predicted_pixels] = top.T
+            bands[TOP_CROPS:, predicted_pixels] = confidences.T
+
+            path = os.path.join(output_dir, raster_name(month))
+            _write_raster(path, bands.reshape(2 * TOP_CROPS, height, width), first_column * step,
+                          (first_row + height) * step, step, classes, start_date)
+            print(f'Month {month}: {complete.sum()} pixels with recommendations, written to {path}')
+    finally:
+        executor.shutdown()
+
+
+def _write_raster(path, bands, west, north, step, classes, start_date):
+    import rasterio
+    from rasterio.transform import from_origin
+
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'uint8',
+        'count': bands.shape[0],
+        'height': bands.shape[1],
+        'width': bands.shape[2],
+        'crs': 'EPSG:4326',
+        'transform': from_origin(west, north, step, step),
+        'nodata': NODATA,
+        'tiled': True,
+        'blockxsize': 256,
+        'blockysize': 256,
+        'compress': 'deflate',
+    }
+    # Written next to the old raster and moved over it, so the API never reads a partial file
+    temporary_path = f'{path}.tmp'
+    with rasterio.open(temporary_path, 'w', **profile) as dst:
+        dst.write(bands)
+        dst.update_tags(classes=json.dumps(classes), planting_start=start_date.isoformat(),
+                        built=date.today().isoformat())
+    os.replace(temporary_path, path)
+
+
+def main():
+    from result_cache import RESULT_CACHE_CELL_DEGREES
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--months', type=int, nargs='+', default=list(range(1, 13)), help='Months to build')
+    parser.add_argument('--output-dir', default=RECOMMENDATION_LAYER_DIR)
+    parser.add_argument('--geojson', default='kenya.geojson', help='Area to cover')
+    parser.add_argument('--step', type=float, default=RESULT_CACHE_CELL_DEGREES, help='Pixel size in degrees')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+                        help='Only cover the part of the area inside this box')
+    parser.add_argument('--workers', type=int, default=4, help='Number of concurrent upstream lookups')
+    parser.add_argument('--rate', type=float, default=5, help='Maximum calls per second to each upstream')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    build(args.months, args.output_dir, args.geojson, args.step, args.bbox, args.workers, args.rate)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+Recommendations for every cell of a grid over a region, produced as a stream.
+
+Cells are enumerated lazily, one grid row at a time, and processed in chunks of
+EXPORT_CHUNK_SIZE, so memory use does not grow with the size of the region. After each
+chunk a checkpoint with a resume token is produced; passing the token back continues the
+export after the last cell of that chunk.
+"""
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import os
+import threading
+
+import grid
+from coverage_index import load_area
+from errors import InvalidRegionError, UnsupportedCropError
+from predictor import get_batch_crop_recommendations, get_plant_time_recommendations
+from recommendation_layer import layer as recommendation_layer
+
+# Region exported when a request gives neither a bounding box nor a polygon
+EXPORT_AREA_PATH = os.environ.get('EXPORT_AREA_PATH', 'kenya.geojson')
+
+# Cells computed at once, the most the export holds in memory
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 200))
+
+# Smallest grid step in degrees, about the size of a result cache cell
+EXPORT_MIN_STEP = float(os.environ.get('EXPORT_MIN_STEP', 0.01))
+EXPORT_DEFAULT_STEP = 0.1
+
+_default_area = None
+_default_area_lock = threading.Lock()
+
+
+def parse_region(data):
+    """
+    Get the region and grid step of an export request.
+
+    Parameters:
+    - data (dict): The request body, with an optional 'bbox' ([min_lon, min_lat, max_lon,
+      max_lat]), 'polygon' (a GeoJSON Polygon or MultiPolygon) and 'step' in degrees.
+
+    Returns:
+    - tuple: The region as a prepared Shapely geometry, and the step.
+
+    Raises:
+    - InvalidRegionError: If the region or the step is not valid.
+    """
+    import shapely  # Imported lazily to keep start-up fast
+
+    step = data.get('step', EXPORT_DEFAULT_STEP)
+    if not isinstance(step, (int, float)) or isinstance(step, bool) or not EXPORT_MIN_STEP <= step <= 10:
+        raise InvalidRegionError(f'step must be a number of degrees between {EXPORT_MIN_STEP} and 10')
+
+    if 'polygon' in data:
+        try:
+            region = shapely.geometry.shape(data['polygon'])
+        except Exception:
+            raise InvalidRegionError('polygon must be a GeoJSON Polygon or MultiPolygon')
+        if region.geom_type not in ('Polygon', 'MultiPolygon') or not region.is_valid:
+            raise InvalidRegionError('polygon must be a valid GeoJSON Polygon or MultiPolygon')
+    elif 'bbox' in data:
+        bbox = data['bbox']
+        if not isinstance(bbox, list) or len(bbox) != 4 \
+                or not all(isinstance(value, (int, float)) and not isinstance(value, bool) for value in bbox):
+            raise InvalidRegionError('bbox must be [min_lon, min_lat, max_lon, max_lat]')
+        min_longitude, min_latitude, max_longitude, max_latitude = bbox
+        if not (-180 <= min_longitude < max_longitude <= 180 and -90 <= min_latitude < max_latitude <= 90):
+            raise InvalidRegionError('bbox must be [min_lon, min_lat, max_lon, max_lat] within valid coordinates')
+        region = shapely.box(*bbox)
+    else:
+        return _get_default_area(), step
+
+    shapely.prepare(region)
+    return region, step
+
+
+def query_digest(data):
+    """Identify the region and step of a request, so a resume token is only used with its own export."""
+    query = {name: data.get(name) for name in ('bbox', 'polygon', 'step')}
+    return hashlib.sha256(json.dumps(query, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def encode_resume_token(next_cell, digest):
+    return base64.urlsafe_b64encode(json.dumps({'next': next_cell, 'query': digest}).encode()).decode()
+
+
+def decode_resume_token(token, digest):
+    """
+    Get the index of the cell to resume from.
+
+    Raises:
+    - InvalidRegionError: If the token is malformed or belongs to another export.
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(token.encode()))
+        next_cell = int(state['next'])
+    except Exception:
+        raise InvalidRegionError('resume_token is not valid')
+    if state.get('query') != digest:
+        raise InvalidRegionError('resume_token belongs to an export of another region or step')
+    return next_cell
+
+
+def iter_cells(region, step, first_cell=0):
+    """
+    Yield (index, longitude, latitude) for the center of every grid cell inside the region.
+
+    Cells are numbered row by row from the region's south-west corner, the same way for
+    every call with the same region and step, and only one row is held at a time.
+    """
+    width = grid.grid_extent(region.bounds, step)[2]
+    for row, latitude, longitudes, columns in grid.iter_rows_inside(region, step, first_row=first_cell // width):
+        keep = columns >= first_cell - row * width
+        for column, longitude in zip(columns[keep].tolist(), longitudes[keep].tolist()):
+            yield row * width + column, longitude, latitude
+
+
+def export_recommendations(region, step, digest, first_cell=0):
+    """
+    Yield the recommendations for every cell of a region, chunk by chunk.
+
+    Each cell yields a record with its location and either its crop recommendations, each
+    with the planting windows of the crop, or an error. After each chunk a checkpoint
+    record with a resume token is yielded, and a final record marks the end of the export.
+    The next chunk is only computed once the records of the previous one have been consumed.
+    """
+    cells = iter_cells(region, step, first_cell)
+    exported = 0
+    while True:
+        chunk = list(itertools.islice(cells, EXPORT_CHUNK_SIZE))
+        if not chunk:
+            break
+        yield from _export_chunk(chunk)
+        exported += len(chunk)
+        yield {'checkpoint': {'resume_token': encode_resume_token(chunk[-1][0] + 1, digest), 'cells': exported}}
+    yield {'done': True, 'cells': exported}
+
+
+def _export_chunk(chunk):
+    # Answer from the precomputed recommendations where possible and compute the rest in one batch
+    recommendations = [recommendation_layer.lookup(longitude, latitude) for _, longitude, latitude in chunk]
+    missing = [i for i, result in enumerate(recommendations) if result is None]
+    computed = get_batch_crop_recommendations([chunk[i][1:] for i in missing]) if missing else []
+    results = [{'recommendations': result} if result is not None else None for result in recommendations]
+    for i, result in zip(missing, computed):
+        results[i] = result
+
+    for (_, longitude, latitude), result in zip(chunk, results):
+        record = {'longitude': longitude, 'latitude': latitude}
+        if 'error' in result:
+            record['error'] = result['error']
+            yield record
+            continue
+
+        record['recommendations'] = []
+        for recommendation in result['recommendations']:
+            recommendation = dict(recommendation)
+            try:
+                recommendation['planting_windows'] = get_plant_time_recommendations(longitude, latitude,
+                                                                                    recommendation['crop'])
+            except UnsupportedCropError:
+                # The model knows a few crops the catalog has no planting duration for
+                recommendation['planting_windows'] = None
+            except Exception as e:
+                logging.error(f'Failed to get planting windows for {recommendation["crop"]} at {latitude}, {longitude}: {e}')
+                recommendation['planting_windows'] = None
+            record['recommendations'].append(recommendation)
+        yield record
+
+
+def _get_default_area():
+    global _default_area
+    if _default_area is None:
+        with _default_area_lock:
+            if _default_area is None:
+                import shapely
+
+                area = load_area(EXPORT_AREA_PATH)
+                shapely.prepare(area)
+                _default_area = area
+    return _default_area
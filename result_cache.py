@@ -0,0 +1,177 @@
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import date
+
+import grid
+from sqlite_store import SQLiteStore
+
+# Which backend stores the results: 'memory' (per process), 'sqlite' (shared by all the
+# processes on a machine) or 'none' to turn the cache off
+RESULT_CACHE_BACKEND = os.environ.get('RESULT_CACHE_BACKEND', 'memory')
+RESULT_CACHE_PATH = os.environ.get('RESULT_CACHE_PATH', 'result_cache.sqlite')
+
+# Locations in the same cell of this size share their results, 0.01 degrees is about 1 km
+RESULT_CACHE_CELL_DEGREES = float(os.environ.get('RESULT_CACHE_CELL_DEGREES', 0.01))
+
+RESULT_CACHE_TTL = float(os.environ.get('RESULT_CACHE_TTL', 24 * 3600))
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 100_000))
+
+
+class MemoryBackend:
+    """In-process LRU store with per-entry expiry."""
+
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if time.time() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """
+    SQLite store shared by every worker process on the machine.
+
+    Values are pickled, so any result the API returns can be stored. The least recently
+    used entries are evicted once there are more than max_entries. Results of past days
+    are not read any more, so they go first.
+    """
+
+    def __init__(self, path=RESULT_CACHE_PATH, max_entries=RESULT_CACHE_MAX_ENTRIES):
+        self.store = SQLiteStore(path, max_entries=max_entries)
+
+    def get(self, key):
+        entry = self.store.get(key)
+        if entry is None or time.time() >= entry[1]:
+            return None
+        return pickle.loads(entry[0])
+
+    def set(self, key, value, ttl):
+        self.store.set(key, pickle.dumps(value), time.time() + ttl)
+
+    def __len__(self):
+        return len(self.store)
+
+
+class ResultCache:
+    """
+    Caches API results by snapped location and day.
+
+    Concurrent misses for the same key are coalesced: the first caller computes the result
+    and the others wait for it. Coalescing happens within a process; with a shared backend,
+    other processes pick the result up once it has been stored.
+    """
+
+    def __init__(self, backend, cell_degrees=RESULT_CACHE_CELL_DEGREES, ttl=RESULT_CACHE_TTL):
+        self.backend = backend
+        self.cell_degrees = cell_degrees
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def key(self, name, longitude, latitude, *parts):
+        """
+        Build the cache key for a result.
+
+        The location is snapped to the cache grid and today's date is part of the key, since
+        results depend on the weather around the current date.
+        """
+        cell = grid.cell_for(longitude, latitude, self.cell_degrees)
+        return ':'.join([name, cell, date.today().isoformat(), *map(str, parts)])
+
+    def get_or_compute(self, key, compute):
+        """Get a cached result, or compute and store it. Exceptions are not cached."""
+        if self.backend is None:
+            return compute()
+
+        value = self.backend.get(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = Future()
+                self._in_flight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            # The result is good even if it cannot be stored, e.g. while the database is locked
+            try:
+                self.backend.set(key, value, self.ttl)
+            except Exception:
+                logging.exception(f"Failed to store the result for '{key}'")
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def put(self, key, value):
+        """Store a result computed elsewhere, e.g. by the cache warming job."""
+        if self.backend is not None:
+            self.backend.set(key, value, self.ttl)
+
+    def stats(self):
+        total = self.hits + self.misses + self.coalesced
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'hit_ratio': (self.hits + self.coalesced) / total if total else 0.0,
+            'entries': len(self.backend) if self.backend is not None else 0,
+        }
+
+
+def _create_backend(name):
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'sqlite':
+        return SQLiteBackend()
+    if name == 'none':
+        return None
+    raise ValueError(f"Unknown result cache backend '{name}'")
+
+
+cache = ResultCache(_create_backend(RESULT_CACHE_BACKEND))
@@ -0,0 +1,127 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import grid
+from sqlite_store import SQLiteStore
+
+SOIL_CACHE_PATH = os.environ.get('SOIL_CACHE_PATH', 'soil_cache.sqlite')
+
+# SoilGrids has a 250 m resolution, which is roughly 0.0025 degrees at the equator
+SOIL_CACHE_CELL_DEGREES = float(os.environ.get('SOIL_CACHE_CELL_DEGREES', 0.0025))
+
+# Soil properties barely change, so entries live for 30 days by default
+SOIL_CACHE_TTL = float(os.environ.get('SOIL_CACHE_TTL', 30 * 24 * 3600))
+SOIL_CACHE_MAX_ENTRIES = int(os.environ.get('SOIL_CACHE_MAX_ENTRIES', 1_000_000))
+
+# Number of entries also kept in process memory in front of SQLite
+SOIL_CACHE_MEMORY_ENTRIES = int(os.environ.get('SOIL_CACHE_MEMORY_ENTRIES', 10_000))
+
+# Returned by SoilCache.get when there is no entry, since None is a valid cached value
+MISSING = object()
+
+
+class SoilCache:
+    """
+    Persistent cache of soil properties keyed by a snapped grid cell.
+
+    Locations are snapped to a regular grid matching the SoilGrids resolution, so nearby
+    farms share one entry. Entries are stored in a SQLiteStore (shared between processes)
+    with a TTL and an LRU bound on the number of rows, and the most recently used entries
+    are also kept in process memory.
+    """
+
+    def __init__(self, path=SOIL_CACHE_PATH, cell_degrees=SOIL_CACHE_CELL_DEGREES, ttl=SOIL_CACHE_TTL,
+                 max_entries=SOIL_CACHE_MAX_ENTRIES, memory_entries=SOIL_CACHE_MEMORY_ENTRIES):
+        self.cell_degrees = cell_degrees
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._store = SQLiteStore(path, max_entries=max_entries)
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cell_for(self, longitude, latitude):
+        """Get the id of the grid cell containing a location."""
+        return grid.cell_for(longitude, latitude, self.cell_degrees)
+
+    def cell_center(self, cell):
+        """Get the (longitude, latitude) of the center of a grid cell."""
+        return grid.cell_center(cell, self.cell_degrees)
+
+    def get(self, cell):
+        """Get the cached value for a cell, or MISSING if there is no fresh entry."""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(cell)
+            if entry is not None:
+                value, expires_at = entry
+                if now < expires_at:
+                    self._memory.move_to_end(cell)
+                    self.hits += 1
+                    return value
+                del self._memory[cell]
+
+        entry = self._store.get(cell)
+        if entry is None or now >= entry[1]:
+            with self._lock:
+                self.misses += 1
+            return MISSING
+
+        value = json.loads(entry[0])
+        self._remember(cell, value, entry[1])
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def get_stale(self, cell):
+        """Get the cached value for a cell even if it has expired, or MISSING if there is none."""
+        with self._lock:
+            entry = self._memory.get(cell)
+        if entry is None:
+            entry = self._store.get(cell)
+            if entry is None:
+                return MISSING
+            value = json.loads(entry[0])
+        else:
+            value = entry[0]
+
+        with self._lock:
+            self.stale_hits += 1
+        return value
+
+    def set(self, cell, value):
+        """Store a JSON-serializable value for a cell."""
+        expires_at = time.time() + self.ttl
+        self._store.set(cell, json.dumps(value).encode(), expires_at)
+        self._remember(cell, value, expires_at)
+
+    def stats(self):
+        total = self.hits + self.misses
+        entries = len(self._store)
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'stale_hits': self.stale_hits,
+            'entries': entries,
+            'memory_entries': len(self._memory),
+        }
+
+    def clear(self):
+        self._store.clear()
+        with self._lock:
+            self._memory.clear()
+
+    def _remember(self, cell, value, expires_at):
+        with self._lock:
+            self._memory[cell] = (value, expires_at)
+            self._memory.move_to_end(cell)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+cache = SoilCache()
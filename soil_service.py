@@ -1,37 +1,207 @@
+import logging
+import os
+import numpy as np
 import requests
-from tif_reader import get_value_at_point
+from tif_reader import get_values_at_point, get_values_at_points
+from soil_cache import cache as soil_cache, MISSING
+from metrics import timed
+from upstream import UpstreamClient, call_all
+from errors import UpstreamTimeoutError, UpstreamUnavailableError
+
+# Directory with the soil rasters
+SOIL_DATA_DIR = os.environ.get('SOIL_DATA_DIR', 'data')
+
+PHOSPHORUS_RASTER_FILE = os.path.join(SOIL_DATA_DIR, 'kenya_phosphorus.tif')
+POTASSIUM_RASTER_FILE = os.path.join(SOIL_DATA_DIR, 'kenya_potassium.tif')
+NITROGEN_RASTER_FILE = os.path.join(SOIL_DATA_DIR, 'kenya_nitrogen.tif')
+PHH2O_RASTER_FILE = os.path.join(SOIL_DATA_DIR, 'kenya_phh2o.tif')
+
+# Where nitrogen and pH come from: 'local' reads the rasters built by get_tifs.py, 'api'
+# queries the SoilGrids REST API and 'auto' uses the rasters when they exist.
+SOIL_SOURCE = os.environ.get('SOIL_SOURCE', 'auto')
+
+SOILGRIDS_URL = os.environ.get('SOILGRIDS_URL', 'https://dev-rest.isric.org/soilgrids/v2.0/properties/query')
+# Seconds for each attempt, and for a whole call including retries
+SOILGRIDS_TIMEOUT = float(os.environ.get('SOILGRIDS_TIMEOUT', 10))
+SOILGRIDS_DEADLINE = float(os.environ.get('SOILGRIDS_DEADLINE', 15))
+
+# Calls to SoilGrids in flight at once, per process
+SOILGRIDS_MAX_CONCURRENCY = int(os.environ.get('SOILGRIDS_MAX_CONCURRENCY', 8))
+
+# Reuse connections to SoilGrids between requests, and stop calling it while it is failing
+soilgrids = UpstreamClient('soilgrids', SOILGRIDS_TIMEOUT, SOILGRIDS_DEADLINE, SOILGRIDS_MAX_CONCURRENCY)
+
 class LocationNotSupportedError(Exception):
     """Raised when a location is not supported"""
     pass
 
+@timed('soil_properties')
 def get_soil_properties(longitude, latitude):
     # Get nitrogen and pH values 
-    nitrogen_and_ph = _get_nitrogen_and_ph(longitude, latitude)
+    nitrogen_and_ph = get_nitrogen_and_ph(longitude, latitude)
 
     # Get phosphorus and potassium values
-    phosphorus_raster_file = 'data/kenya_phosphorus.tif'
-    potassium_raster_file = 'data/kenya_potassium.tif'
+    phosphorus_and_potassium = get_phosphorus_and_potassium(longitude, latitude)
+
+    return combine_soil_properties(nitrogen_and_ph, phosphorus_and_potassium)
 
+def get_nitrogen_and_ph(longitude, latitude):
+    return _get_nitrogen_and_ph(longitude, latitude)
+
+def get_phosphorus_and_potassium(longitude, latitude):
     try:
-        phosphorus = get_value_at_point(phosphorus_raster_file, longitude, latitude)/100 # Divide by 100 to convert to ppm
-        potassium = get_value_at_point(potassium_raster_file, longitude, latitude)
+        phosphorus, potassium = get_values_at_point([PHOSPHORUS_RASTER_FILE, POTASSIUM_RASTER_FILE], longitude, latitude)
+        phosphorus = phosphorus/100 # Divide by 100 to convert to ppm
     except Exception:
         raise LocationNotSupportedError(f"Location with longitude {longitude} and latitude {latitude} is not supported")
 
+    # Pixels without data, e.g. on lakes, are not supported either
+    if np.isnan(phosphorus) or np.isnan(potassium):
+        raise LocationNotSupportedError(f"Location with longitude {longitude} and latitude {latitude} is not supported")
+
     return {
-        'nitrogen': nitrogen_and_ph['nitrogen'],
-        'ph': nitrogen_and_ph['phh2o']/10,  # Convert to pH as is received in pH*10
         'phosphorus': phosphorus,
         'potassium': potassium
     }
 
+def combine_soil_properties(nitrogen_and_ph, phosphorus_and_potassium):
+    return {
+        'nitrogen': nitrogen_and_ph['nitrogen'],
+        'ph': nitrogen_and_ph['phh2o']/10,  # Convert to pH as is received in pH*10
+        'phosphorus': phosphorus_and_potassium['phosphorus'],
+        'potassium': phosphorus_and_potassium['potassium']
+    }
+
+def get_soil_properties_batch(longitudes, latitudes, executor=None, give_up_at=None):
+    """
+    Get soil properties for many locations.
+
+    Phosphorus and potassium are sampled for all points in one vectorized raster pass,
+    and so are nitrogen and pH when they come from local rasters. Otherwise nitrogen and
+    pH are fetched once per SoilGrids cell, and only for points that are covered by the
+    rasters. Given an executor, the cells are fetched concurrently on it and the fetches
+    give up by `give_up_at` (a time.monotonic value).
+
+    Parameters:
+    - longitudes (list): The longitudes of the locations.
+    - latitudes (list): The latitudes of the locations.
+    - executor (Executor): Where to fetch nitrogen and pH, or None to fetch them one by one.
+    - give_up_at (float): When concurrent fetches give up, required with an executor.
+
+    Returns:
+    - list: One entry per location, either a soil properties dict or the exception
+      raised while getting it.
+    """
+    longitudes = np.asarray(longitudes, dtype=np.float64)
+    latitudes = np.asarray(latitudes, dtype=np.float64)
+
+    use_local_rasters = _use_local_rasters()
+    try:
+        phosphorus, phosphorus_found = get_values_at_points(PHOSPHORUS_RASTER_FILE, longitudes, latitudes)
+        potassium, potassium_found = get_values_at_points(POTASSIUM_RASTER_FILE, longitudes, latitudes)
+        supported = phosphorus_found & potassium_found & ~np.isnan(phosphorus) & ~np.isnan(potassium)
+
+        if use_local_rasters:
+            nitrogen, _ = get_values_at_points(NITROGEN_RASTER_FILE, longitudes, latitudes)
+            phh2o, _ = get_values_at_points(PHH2O_RASTER_FILE, longitudes, latitudes)
+            supported &= ~np.isnan(nitrogen) & ~np.isnan(phh2o)
+    except Exception as e:
+        # A raster that cannot be opened or read fails every location, reported like other soil errors
+        return [e] * len(longitudes)
+
+    nitrogen_and_ph_by_cell = {}
+    if not use_local_rasters:
+        # One fetch per SoilGrids cell, for a location of the cell
+        locations_by_cell = {}
+        for longitude, latitude in zip(longitudes[supported].tolist(), latitudes[supported].tolist()):
+            locations_by_cell.setdefault(soil_cache.cell_for(longitude, latitude), (longitude, latitude))
+        if executor is None:
+            for cell, location in locations_by_cell.items():
+                try:
+                    nitrogen_and_ph_by_cell[cell] = _get_nitrogen_and_ph(*location)
+                except Exception as e:
+                    nitrogen_and_ph_by_cell[cell] = e
+        else:
+            nitrogen_and_ph_by_cell = dict(zip(locations_by_cell, call_all(
+                executor, _get_nitrogen_and_ph, locations_by_cell.values(), give_up_at, 'nitrogen_and_ph')))
+
+    results = []
+    for i, (longitude, latitude) in enumerate(zip(longitudes.tolist(), latitudes.tolist())):
+        if not supported[i]:
+            results.append(LocationNotSupportedError(f"Location with longitude {longitude} and latitude {latitude} is not supported"))
+            continue
+
+        if use_local_rasters:
+            nitrogen_and_ph = {'nitrogen': float(nitrogen[i]), 'phh2o': float(phh2o[i])}
+        else:
+            nitrogen_and_ph = nitrogen_and_ph_by_cell[soil_cache.cell_for(longitude, latitude)]
+            if isinstance(nitrogen_and_ph, Exception):
+                results.append(nitrogen_and_ph)
+                continue
+
+        results.append({
+            'nitrogen': nitrogen_and_ph['nitrogen'],
+            'ph': nitrogen_and_ph['phh2o']/10,
+            'phosphorus': phosphorus[i]/100,
+            'potassium': potassium[i]
+        })
+
+    return results
+
+def _use_local_rasters():
+    if SOIL_SOURCE == 'auto':
+        return os.path.exists(NITROGEN_RASTER_FILE) and os.path.exists(PHH2O_RASTER_FILE)
+    return SOIL_SOURCE == 'local'
+
 def _get_nitrogen_and_ph(longitude, latitude):
-    response = _fetch_nitrogen_and_ph(longitude, latitude)
-    return _compute_mean_for_first_three_depths(response)
+    if _use_local_rasters():
+        return _read_nitrogen_and_ph(longitude, latitude)
+    return _get_nitrogen_and_ph_from_api(longitude, latitude)
+
+def _read_nitrogen_and_ph(longitude, latitude):
+    # The rasters hold the same 0-30 cm means that the API path computes
+    try:
+        nitrogen, phh2o = get_values_at_point([NITROGEN_RASTER_FILE, PHH2O_RASTER_FILE], longitude, latitude)
+    except IndexError:
+        raise LocationNotSupportedError(f"Location with longitude {longitude} and latitude {latitude} is not supported")
+
+    if np.isnan(nitrogen) or np.isnan(phh2o):
+        raise LocationNotSupportedError(f"Location with longitude {longitude} and latitude {latitude} is not supported")
+
+    return {'nitrogen': float(nitrogen), 'phh2o': float(phh2o)}
+
+def _get_nitrogen_and_ph_from_api(longitude, latitude):
+    # Nearby locations share the value of their SoilGrids cell, fetched at the cell center
+    cell = soil_cache.cell_for(longitude, latitude)
+    nitrogen_and_ph = soil_cache.get(cell)
+
+    if nitrogen_and_ph is MISSING:
+        cell_longitude, cell_latitude = soil_cache.cell_center(cell)
+        try:
+            response = _fetch_nitrogen_and_ph(cell_longitude, cell_latitude)
+        except LocationNotSupportedError:
+            # Remember unsupported cells too, stored as None
+            soil_cache.set(cell, None)
+            raise LocationNotSupportedError(f"Location with longitude {longitude} and latitude {latitude} is not supported")
+        except (UpstreamTimeoutError, UpstreamUnavailableError, requests.RequestException, ValueError) as e:
+            # Soil properties barely change, so an expired entry beats failing the request
+            nitrogen_and_ph = soil_cache.get_stale(cell)
+            if nitrogen_and_ph is MISSING:
+                raise
+            logging.warning(f'Serving expired soil properties for cell {cell}: {e}')
+        else:
+            nitrogen_and_ph = _compute_mean_for_first_three_depths(response)
+            soil_cache.set(cell, nitrogen_and_ph)
+
+    if nitrogen_and_ph is None:
+        raise LocationNotSupportedError(f"Location with longitude {longitude} and latitude {latitude} is not supported")
+
+    return nitrogen_and_ph
 
 
+@timed('soilgrids')
 def _fetch_nitrogen_and_ph(longitude, latitude):
-    url = f"https://dev-rest.isric.org/soilgrids/v2.0/properties/query?lon={longitude}&lat={latitude}&property=nitrogen&property=phh2o&value=mean"
+    url = f"{SOILGRIDS_URL}?lon={longitude}&lat={latitude}&property=nitrogen&property=phh2o&value=mean"
     headers = {
         'authority': 'dev-rest.isric.org',
         'accept': 'application/json, text/plain, */*',
@@ -40,7 +210,8 @@ def _fetch_nitrogen_and_ph(longitude, latitude):
         'origin': 'https://soilgrids.org',
         'referer': 'https://soilgrids.org/',
     }
-    response = requests.get(url, headers=headers)
+    response = soilgrids.get(url, headers=headers)
+    response.raise_for_status()
     response_json = response.json()
 
     # Check if all mean values are None
@@ -0,0 +1,92 @@
+import sqlite3
+import threading
+import time
+
+# Last access times are only written when they are older than this, to keep reads cheap
+TOUCH_RESOLUTION = 3600
+
+EVICTION_CHECK_INTERVAL = 100
+
+
+class SQLiteStore:
+    """
+    Key/value store in a SQLite file, shared by every process on the machine.
+
+    Values are bytes with an expiry time. Expired entries are kept, so callers can still
+    serve them when the source of the data is down, until they are evicted: once there are
+    more than `max_entries` entries or they take more than `max_bytes`, the least recently
+    used ones are deleted. The database runs in WAL mode so reads do not wait for writes.
+    """
+
+    def __init__(self, path, max_entries=None, max_bytes=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._writes = 0
+        self._local = threading.local()
+
+    def get(self, key):
+        """
+        Get an entry, expired or not.
+
+        Returns:
+        - tuple: The value and the Unix time it expires at, or None if there is no entry.
+        """
+        connection = self._connection()
+        row = connection.execute('SELECT value, expires_at, accessed_at FROM cache_entries WHERE key = ?',
+                                 (key,)).fetchone()
+        if row is None:
+            return None
+        now = time.time()
+        if now - row[2] > TOUCH_RESOLUTION:
+            connection.execute('UPDATE cache_entries SET accessed_at = ? WHERE key = ?', (now, key))
+            connection.commit()
+        return row[0], row[1]
+
+    def set(self, key, value, expires_at):
+        """Store a bytes value for a key, replacing any older one."""
+        connection = self._connection()
+        connection.execute('INSERT OR REPLACE INTO cache_entries (key, value, size, expires_at, accessed_at) '
+                           'VALUES (?, ?, ?, ?, ?)', (key, value, len(value), expires_at, time.time()))
+
+        # Counting the entries is not free, so the caps are only checked every EVICTION_CHECK_INTERVAL writes
+        self._writes += 1
+        if self._writes % EVICTION_CHECK_INTERVAL == 0:
+            if self.max_entries is not None:
+                evicted = connection.execute(
+                    'DELETE FROM cache_entries WHERE key IN (SELECT key FROM cache_entries '
+                    'ORDER BY accessed_at DESC, key LIMIT -1 OFFSET ?)', (self.max_entries,))
+                self.evictions += evicted.rowcount
+            if self.max_bytes is not None:
+                evicted = connection.execute(
+                    'DELETE FROM cache_entries WHERE key IN (SELECT key FROM (SELECT key, SUM(size) OVER '
+                    '(ORDER BY accessed_at DESC, key) AS total FROM cache_entries) WHERE total > ?)', (self.max_bytes,))
+                self.evictions += evicted.rowcount
+        connection.commit()
+
+    def clear(self):
+        connection = self._connection()
+        connection.execute('DELETE FROM cache_entries')
+        connection.commit()
+
+    def stats(self):
+        entries, size = self._connection().execute(
+            'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache_entries').fetchone()
+        return {'entries': entries, 'bytes': size, 'evictions': self.evictions}
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM cache_entries').fetchone()[0]
+
+    def _connection(self):
+        # SQLite connections cannot be shared between threads, so each thread gets its own
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS cache_entries ('
+                               'key TEXT PRIMARY KEY, value BLOB, size INTEGER, expires_at REAL, accessed_at REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS cache_entries_accessed_at ON cache_entries (accessed_at)')
+            connection.commit()
+            self._local.connection = connection
+        return connection
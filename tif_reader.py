@@ -1,14 +1,235 @@
-import rasterio
+import os
+import threading
+from collections import OrderedDict
 
-def get_value_at_point(raster_file, lon, lat):
-    # Open the raster file
-    with rasterio.open(raster_file) as src:
-        # Convert the point's coordinates to the raster's coordinate system
+import numpy as np
+
+from metrics import timed
+
+# Upper bound for the decoded raster blocks kept in memory
+BLOCK_CACHE_BYTES = int(os.environ.get('RASTER_BLOCK_CACHE_MB', 64)) * 1024 * 1024
+
+
+class RasterSampler:
+    """
+    Reads single pixels from GeoTIFFs without loading whole bands.
+
+    Dataset handles stay open between calls and only the internal block (tile or strip)
+    that contains a point is read. Decoded blocks are kept in a bounded LRU cache, so
+    nearby points are served from memory.
+
+    Each open raster is kept as a (handle, lock, generation) entry that callers take once
+    and use for the whole call. A forgotten raster gets a new generation, which is part of
+    the block keys, so blocks read from the old file are never served for the new one.
+    """
+
+    def __init__(self, cache_bytes=BLOCK_CACHE_BYTES):
+        self.cache_bytes = cache_bytes
+        self._datasets = {}
+        self._generations = {}
+        self._blocks = OrderedDict()
+        self._cached_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def sample(self, raster_file, lon, lat, indexes=1):
+        """
+        Get the value at a point.
+
+        Parameters:
+        - raster_file (str): Path to the raster.
+        - lon (float): Longitude of the point.
+        - lat (float): Latitude of the point.
+        - indexes (int or list): Band index, or a list of band indexes.
+
+        Returns:
+        - The pixel value, or a list of values when a list of bands is given.
+
+        Raises:
+        - IndexError: If the point falls outside the raster.
+        """
+        dataset = self._open(raster_file)
+        src = dataset[0]
         row, col = src.index(lon, lat)
-        
-        # Read the raster's values at the point's location
-        value = src.read(1)[row, col]
-        
-    return value
+        if not (0 <= row < src.height and 0 <= col < src.width):
+            raise IndexError(f"Point ({lon}, {lat}) is outside of raster {raster_file}")
+
+        if isinstance(indexes, int):
+            return self._read_pixel(raster_file, dataset, indexes, row, col)
+        return [self._read_pixel(raster_file, dataset, band, row, col) for band in indexes]
+
+    def sample_files(self, raster_files, lon, lat):
+        """Get the first band's value at a point for several rasters in one call."""
+        return [self.sample(raster_file, lon, lat) for raster_file in raster_files]
+
+    def sample_points(self, raster_file, lons, lats, band=1):
+        """
+        Get the values at many points in a single pass.
+
+        Points are grouped by the block they fall in, so each block is read at most once.
+
+        Parameters:
+        - raster_file (str): Path to the raster.
+        - lons (array-like): Longitudes of the points.
+        - lats (array-like): Latitudes of the points.
+        - band (int): Band index.
+
+        Returns:
+        - tuple: A float64 array of values (NaN outside the raster) and a boolean array
+          marking which points fall inside the raster.
+        """
+        dataset = self._open(raster_file)
+        src = dataset[0]
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        # Same as src.index, but on whole arrays
+        cols, rows = ~src.transform * (lons, lats)
+        rows = np.floor(rows).astype(np.int64)
+        cols = np.floor(cols).astype(np.int64)
+
+        inside = (rows >= 0) & (rows < src.height) & (cols >= 0) & (cols < src.width)
+        values = np.full(lons.shape, np.nan)
+
+        block_height, block_width = src.block_shapes[band - 1]
+        points = np.flatnonzero(inside)
+        block_rows = rows.ravel()[points] // block_height
+        block_cols = cols.ravel()[points] // block_width
+
+        # Sort the points by block so every block is visited once
+        order = np.lexsort((block_cols, block_rows))
+        points, block_rows, block_cols = points[order], block_rows[order], block_cols[order]
+        boundaries = np.flatnonzero((np.diff(block_rows) != 0) | (np.diff(block_cols) != 0)) + 1
+
+        flat_values = values.ravel()
+        for group in np.split(np.arange(len(points)), boundaries):
+            if len(group) == 0:
+                continue
+            block_row, block_col = int(block_rows[group[0]]), int(block_cols[group[0]])
+            block = self._get_block(raster_file, dataset, band, block_row, block_col)
+            group_points = points[group]
+            flat_values[group_points] = block[rows.ravel()[group_points] - block_row * block_height,
+                                              cols.ravel()[group_points] - block_col * block_width]
+        return values, inside
+
+    def open(self, raster_file):
+        """Open a raster ahead of time so the first request does not pay for it."""
+        self._open(raster_file)
+
+    def tags(self, raster_file):
+        """Get the dataset-level metadata tags of a raster."""
+        src, dataset_lock, _ = self._open(raster_file)
+        with dataset_lock:
+            return src.tags()
+
+    def forget(self, raster_file):
+        """
+        Drop a raster's handle and cached blocks, e.g. after the file has been replaced.
+
+        The next call opens the file again. Calls still reading from the old handle finish
+        with it, and it is closed once the last of them lets go of it.
+        """
+        with self._lock:
+            self._datasets.pop(raster_file, None)
+            self._generations[raster_file] = self._generations.get(raster_file, 0) + 1
+            for key in [key for key in self._blocks if key[0] == raster_file]:
+                self._cached_bytes -= self._blocks.pop(key).nbytes
+
+    def reopen(self):
+        """
+        Drop the dataset handles, keeping the cached blocks.
+
+        Used after forking: GDAL handles must not be shared between processes, while the
+        already decoded blocks can be shared copy-on-write. Datasets are opened again on use.
+        """
+        with self._lock:
+            for src, _, _ in self._datasets.values():
+                src.close()
+            self._datasets.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'blocks': len(self._blocks),
+            'bytes': self._cached_bytes,
+        }
+
+    def close(self):
+        """Close every open dataset and drop the block cache."""
+        with self._lock:
+            for src, _, _ in self._datasets.values():
+                src.close()
+            self._datasets.clear()
+            self._blocks.clear()
+            self._cached_bytes = 0
+
+    def _open(self, raster_file):
+        # The (handle, lock, generation) entry of a raster, opening it if needed
+        dataset = self._datasets.get(raster_file)
+        if dataset is None:
+            with self._lock:
+                dataset = self._datasets.get(raster_file)
+                if dataset is None:
+                    import rasterio  # Imported lazily to keep start-up fast
+                    dataset = (rasterio.open(raster_file), threading.Lock(), self._generations.get(raster_file, 0))
+                    self._datasets[raster_file] = dataset
+        return dataset
+
+    def _read_pixel(self, raster_file, dataset, band, row, col):
+        block_height, block_width = dataset[0].block_shapes[band - 1]
+        block_row, block_col = row // block_height, col // block_width
+        block = self._get_block(raster_file, dataset, band, block_row, block_col)
+        return block[row - block_row * block_height, col - block_col * block_width]
+
+    def _get_block(self, raster_file, dataset, band, block_row, block_col):
+        src, dataset_lock, generation = dataset
+        key = (raster_file, generation, band, block_row, block_col)
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is not None:
+                self._blocks.move_to_end(key)
+                self.hits += 1
+                return block
+            self.misses += 1
+
+        from rasterio.windows import Window
+
+        block_height, block_width = src.block_shapes[band - 1]
+        row_off, col_off = block_row * block_height, block_col * block_width
+        window = Window(col_off, row_off,
+                        min(block_width, src.width - col_off),
+                        min(block_height, src.height - row_off))
+
+        # Dataset handles are not safe to read from several threads at once
+        with dataset_lock:
+            block = src.read(band, window=window)
+
+        with self._lock:
+            if key not in self._blocks:
+                self._blocks[key] = block
+                self._cached_bytes += block.nbytes
+                while self._cached_bytes > self.cache_bytes and len(self._blocks) > 1:
+                    _, evicted = self._blocks.popitem(last=False)
+                    self._cached_bytes -= evicted.nbytes
+        return block
+
+
+sampler = RasterSampler()
+
+
+@timed('raster')
+def get_value_at_point(raster_file, lon, lat):
+    return sampler.sample(raster_file, lon, lat)
+
+
+@timed('raster')
+def get_values_at_point(raster_files, lon, lat):
+    return sampler.sample_files(raster_files, lon, lat)
 
 
+@timed('raster')
+def get_values_at_points(raster_file, lons, lats):
+    return sampler.sample_points(raster_file, lons, lats)
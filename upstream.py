@@ -0,0 +1,274 @@
+import contextvars
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import wait
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from errors import UpstreamTimeoutError, UpstreamUnavailableError
+
+# Attempts after the first one, and the base delay in seconds of the jittered exponential backoff
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))
+UPSTREAM_BACKOFF = float(os.environ.get('UPSTREAM_BACKOFF', 0.2))
+
+# Consecutive failures that open the circuit, and seconds before a trial call is let through
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', 5))
+BREAKER_RESET_TIMEOUT = float(os.environ.get('BREAKER_RESET_TIMEOUT', 30))
+
+# Responses that mean the upstream is struggling, worth retrying
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Time (on the time.monotonic clock) by which the current request needs its upstream calls done
+_deadline = contextvars.ContextVar('upstream_deadline', default=None)
+
+
+@contextmanager
+def deadline(at):
+    """Make the upstream calls in this block, retries included, give up by `at` (a time.monotonic value)."""
+    current = _deadline.get()
+    token = _deadline.set(at if current is None else min(at, current))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def call_all(executor, function, arguments, give_up_at, name):
+    """
+    Call a function once per tuple of arguments, concurrently on an executor.
+
+    Each call runs in a copy of the caller's context, so its timings are added to the
+    request, and its upstream calls give up by `give_up_at` (a time.monotonic value).
+
+    Returns:
+    - list: For each tuple of arguments, the result of the call or the exception it raised.
+      Calls that have not finished by `give_up_at` get an UpstreamTimeoutError named `name`
+      and are cancelled if they have not started yet.
+    """
+    timeout = max(0, give_up_at - time.monotonic())
+    futures = [executor.submit(contextvars.copy_context().run, _call_until, give_up_at, function, *args)
+               for args in arguments]
+    wait(futures, timeout=timeout)
+
+    results = []
+    for future in futures:
+        if future.done() and not future.cancelled():
+            error = future.exception()
+            results.append(future.result() if error is None else error)
+        else:
+            future.cancel()
+            results.append(UpstreamTimeoutError(name, round(timeout, 1)))
+    return results
+
+
+def _call_until(give_up_at, function, *args):
+    with deadline(give_up_at):
+        return function(*args)
+
+
+class RateLimiter:
+    """Spaces calls out so that at most `rate` start per second, after an initial burst of `burst` calls."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            # Take the token now, even if it has not been earned yet, and wait for it outside the lock
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Stops calling an upstream that keeps failing.
+
+    After `failure_threshold` consecutive failures the circuit opens and calls are rejected
+    straight away. After `reset_timeout` seconds one trial call is let through: if it
+    succeeds the circuit closes again, otherwise it stays open for another `reset_timeout`.
+    """
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            if self._opened_at is None:
+                return 'closed'
+            if time.monotonic() - self._opened_at >= self.reset_timeout:
+                return 'half-open'
+            return 'open'
+
+    def allow(self):
+        """Whether a call may go through now."""
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at >= self.reset_timeout and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def retry_after(self):
+        """Seconds until a trial call will be let through."""
+        with self._lock:
+            if self._opened_at is None:
+                return 0.0
+            return max(0.0, self._opened_at + self.reset_timeout - time.monotonic())
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_running or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._trial_running = False
+
+
+class UpstreamClient:
+    """
+    HTTP client for one upstream service, shared by every request to it.
+
+    Connections are kept alive and pooled. At most `max_concurrency` calls are in flight at
+    once, every attempt has a timeout and a call gives up once `call_deadline` seconds (or
+    the deadline of the current request, see deadline()) have passed. Failed attempts are
+    retried with jittered exponential backoff, and a circuit breaker rejects calls while the
+    upstream keeps failing. Set `limiter` to a RateLimiter to also limit the rate of
+    attempts.
+
+    The client can be used in place of a requests session, e.g. by openmeteo_requests.
+    """
+
+    def __init__(self, name, timeout, call_deadline, max_concurrency, session=None,
+                 retries=UPSTREAM_RETRIES, backoff=UPSTREAM_BACKOFF, breaker=None):
+        self.name = name
+        self.timeout = timeout
+        self.call_deadline = call_deadline
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker or CircuitBreaker()
+        self.limiter = None
+        self.session = session or requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._counts_lock = threading.Lock()
+        self.calls = 0
+        self.failures = 0
+        self.retried = 0
+        self.rejected = 0
+
+    def get(self, url, params=None, **kwargs):
+        """
+        Send a GET request.
+
+        Returns:
+        - Response: The upstream's response. Error responses are returned once the retries
+          are used up, so callers can still inspect them.
+
+        Raises:
+        - UpstreamUnavailableError: If the circuit is open.
+        - UpstreamTimeoutError: If the call's deadline passes.
+        - requests.RequestException: If the last attempt could not connect.
+        """
+        self._count('calls')
+        if not self.breaker.allow():
+            self._count('rejected')
+            raise UpstreamUnavailableError(self.name, self.breaker.retry_after())
+
+        start = time.monotonic()
+        give_up_at = start + self.call_deadline
+        request_deadline = _deadline.get()
+        if request_deadline is not None:
+            give_up_at = min(give_up_at, request_deadline)
+        budget = round(give_up_at - start, 1)
+
+        attempt = 0
+        while True:
+            try:
+                response = self._attempt(url, params, kwargs, give_up_at, budget)
+                if response.status_code not in RETRY_STATUSES:
+                    self.breaker.record_success()
+                    return response
+                failure = None
+            except UpstreamTimeoutError:
+                self._failed()
+                raise
+            except requests.RequestException as e:
+                response, failure = None, e
+            except Exception:
+                self._failed()
+                raise
+
+            # Wait before retrying, unless the retry could not finish in time anyway
+            delay = random.uniform(0, self.backoff * 2 ** attempt)
+            if attempt >= self.retries or time.monotonic() + delay >= give_up_at:
+                self._failed()
+                if failure is not None:
+                    raise failure
+                return response
+
+            attempt += 1
+            self._count('retried')
+            logging.warning(f'{self.name} call failed ({failure or response.status_code}), retry {attempt} '
+                            f'in {delay:.2f} s')
+            time.sleep(delay)
+
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'failures': self.failures,
+            'retries': self.retried,
+            'rejected': self.rejected,
+            'state': self.breaker.state,
+        }
+
+    def _attempt(self, url, params, kwargs, give_up_at, budget):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        remaining = give_up_at - time.monotonic()
+        if remaining <= 0 or not self._slots.acquire(timeout=remaining):
+            raise UpstreamTimeoutError(self.name, budget)
+        try:
+            timeout = min(self.timeout, give_up_at - time.monotonic())
+            return self.session.get(url, params=params, timeout=max(timeout, 0.001), **kwargs)
+        except requests.Timeout:
+            raise UpstreamTimeoutError(self.name, budget)
+        finally:
+            self._slots.release()
+
+    def _failed(self):
+        self._count('failures')
+        self.breaker.record_failure()
+        if self.breaker.state != 'closed':
+            logging.error(f'Circuit for {self.name} is open, calls are paused for {self.breaker.reset_timeout} s')
+
+    def _count(self, counter):
+        with self._counts_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
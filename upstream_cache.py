@@ -0,0 +1,289 @@
+"""
+Cache tier for data fetched from upstream services.
+
+Entries are parsed NumPy arrays stored in a compact binary format: a short header with
+the dtype, shape and offset of each array and any scalar metadata, followed by the raw
+array bytes. Decoding does not copy the arrays, so a hit costs a backend read and no
+parsing. Each process keeps the most recently used entries in memory, in front of one of
+these shared backends:
+
+- 'memory': nothing shared, only the in-process tier.
+- 'sqlite': a SQLite file in WAL mode shared by the processes on a machine, with LRU
+  eviction once its entries exceed a size cap.
+- 'redis': a Redis-compatible store shared by several machines, which evicts by its own
+  maxmemory policy. Needs the redis package, or any client with the same get/set API.
+- 'none': no caching at all.
+
+Expired entries are kept until they are evicted, so they can still be served while the
+upstream is unavailable.
+"""
+import json
+import logging
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from sqlite_store import SQLiteStore
+
+# Which backend stores the entries, see above
+UPSTREAM_CACHE_BACKEND = os.environ.get('UPSTREAM_CACHE_BACKEND', 'sqlite')
+UPSTREAM_CACHE_PATH = os.environ.get('UPSTREAM_CACHE_PATH', 'upstream_cache.sqlite')
+UPSTREAM_CACHE_REDIS_URL = os.environ.get('UPSTREAM_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+# Seconds to wait for Redis before treating a read as a miss or giving up on a write
+UPSTREAM_CACHE_REDIS_TIMEOUT = float(os.environ.get('UPSTREAM_CACHE_REDIS_TIMEOUT', 0.5))
+
+# Archived weather does not change, entries are only refreshed after this many seconds
+UPSTREAM_CACHE_TTL = float(os.environ.get('UPSTREAM_CACHE_TTL', 90 * 24 * 3600))
+
+# Size caps of the shared backend and of the in-process tier of each process
+UPSTREAM_CACHE_MAX_MB = float(os.environ.get('UPSTREAM_CACHE_MAX_MB', 1024))
+UPSTREAM_CACHE_MEMORY_MB = float(os.environ.get('UPSTREAM_CACHE_MEMORY_MB', 32))
+
+# How long Redis keeps an entry after it expires, so it can still be served while the upstream is down
+REDIS_STALE_SECONDS = 7 * 24 * 3600
+
+MAGIC = b'UPC1'
+
+
+def encode(arrays, metadata, expires_at):
+    """
+    Encode arrays and metadata into the binary entry format.
+
+    Parameters:
+    - arrays (dict): NumPy arrays by name.
+    - metadata (dict): JSON-serializable values stored alongside the arrays.
+    - expires_at (float): Unix time after which the entry is stale.
+
+    Returns:
+    - bytes: The magic, the length of the JSON header, the header and the array bytes.
+    """
+    header = {'expires_at': expires_at, 'metadata': metadata, 'arrays': []}
+    buffers = []
+    offset = 0
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        header['arrays'].append({'name': name, 'dtype': array.dtype.str, 'shape': array.shape, 'offset': offset})
+        data = array.tobytes()
+        # Every array is padded to a multiple of 8 bytes, so the next one is aligned for use in place
+        padding = -len(data) % 8
+        buffers += [data, b'\0' * padding]
+        offset += len(data) + padding
+    header = json.dumps(header, separators=(',', ':')).encode()
+    header += b' ' * (-(len(MAGIC) + 4 + len(header)) % 8)
+    return MAGIC + struct.pack('<I', len(header)) + header + b''.join(buffers)
+
+
+def decode(blob):
+    """
+    Decode an entry made by encode.
+
+    Returns:
+    - tuple: The read-only arrays by name (views on the blob), the metadata and the expiry time.
+    """
+    if blob[:len(MAGIC)] != MAGIC:
+        raise ValueError('Not an upstream cache entry')
+    header_length = struct.unpack_from('<I', blob, len(MAGIC))[0]
+    data_offset = len(MAGIC) + 4 + header_length
+    header = json.loads(bytes(blob[len(MAGIC) + 4:data_offset]))
+    arrays = {}
+    for entry in header['arrays']:
+        dtype = np.dtype(entry['dtype'])
+        count = int(np.prod(entry['shape'], dtype=np.int64))
+        arrays[entry['name']] = np.frombuffer(blob, dtype=dtype, count=count,
+                                              offset=data_offset + entry['offset']).reshape(entry['shape'])
+    return arrays, header['metadata'], header['expires_at']
+
+
+class SQLiteBackend:
+    """SQLite store shared by every worker process on the machine, capped at max_bytes."""
+
+    def __init__(self, path=UPSTREAM_CACHE_PATH, max_bytes=UPSTREAM_CACHE_MAX_MB * 1024 * 1024):
+        self.store = SQLiteStore(path, max_bytes=max_bytes)
+
+    def get(self, key):
+        entry = self.store.get(key)
+        return entry[0] if entry is not None else None
+
+    def set(self, key, blob, expires_at):
+        self.store.set(key, blob, expires_at)
+
+    def stats(self):
+        return self.store.stats()
+
+
+class RedisBackend:
+    """
+    Redis-compatible store shared by several machines.
+
+    Size and eviction are left to the server, e.g. maxmemory with the allkeys-lru policy.
+    Pass `client` to use any client with redis-py's get, set and dbsize methods, such as a
+    local fake. The cache is optional, so while the server cannot be reached reads are
+    misses and writes are dropped.
+    """
+
+    def __init__(self, url=UPSTREAM_CACHE_REDIS_URL, client=None, prefix='upstream:', stale_for=REDIS_STALE_SECONDS,
+                 timeout=UPSTREAM_CACHE_REDIS_TIMEOUT):
+        if client is None:
+            import redis  # Optional, only needed for this backend
+            client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self.client = client
+        self.prefix = prefix
+        self.stale_for = stale_for
+        self.errors = 0
+        self._errors = _redis_errors()
+
+    def get(self, key):
+        try:
+            return self.client.get(self.prefix + key)
+        except self._errors as e:
+            self._failed('read', key, e)
+            return None
+
+    def set(self, key, blob, expires_at):
+        try:
+            self.client.set(self.prefix + key, blob, ex=max(1, int(expires_at - time.time() + self.stale_for)))
+        except self._errors as e:
+            self._failed('write', key, e)
+
+    def stats(self):
+        try:
+            entries = self.client.dbsize()
+        except self._errors:
+            entries = None
+        return {'entries': entries, 'bytes': 0, 'evictions': 0, 'errors': self.errors}
+
+    def _failed(self, operation, key, error):
+        self.errors += 1
+        logging.warning(f"Upstream cache {operation} of '{key}' failed, skipping the cache: {error}")
+
+
+def _redis_errors():
+    # Connection errors and timeouts, as raised by redis-py and by other clients' sockets
+    try:
+        import redis
+    except ImportError:
+        return (OSError,)
+    return (redis.RedisError, OSError)
+
+
+class UpstreamCache:
+    """
+    Caches parsed upstream responses, see the module docstring.
+
+    The in-process tier holds decoded entries for the hottest keys, up to `memory_bytes`;
+    misses go to the shared backend, if there is one, whose entries are decoded without
+    copying. With no backend and no memory the cache is off.
+    """
+
+    def __init__(self, backend, ttl=UPSTREAM_CACHE_TTL, memory_bytes=UPSTREAM_CACHE_MEMORY_MB * 1024 * 1024):
+        self.backend = backend
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self._memory = OrderedDict()
+        self._memory_bytes_used = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, allow_stale=False):
+        """
+        Get an entry.
+
+        Returns:
+        - tuple: The arrays by name and the metadata, or None if there is no entry, or only
+          an expired one and allow_stale is not set.
+        """
+        entry = self._lookup(key)
+        if entry is not None and (allow_stale or time.time() < entry[2]):
+            with self._lock:
+                if allow_stale:
+                    self.stale_hits += 1
+                else:
+                    self.hits += 1
+            return entry[0], entry[1]
+
+        if not allow_stale:
+            with self._lock:
+                self.misses += 1
+        return None
+
+    def set(self, key, arrays, metadata=None):
+        """Store arrays by name, and optional JSON-serializable metadata, for a key."""
+        expires_at = time.time() + self.ttl
+        blob = encode(arrays, metadata or {}, expires_at)
+        if self.backend is not None:
+            self.backend.set(key, blob, expires_at)
+        self._remember(key, decode(blob), len(blob))
+
+    def stats(self):
+        total = self.hits + self.misses
+        stats = {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'stale_hits': self.stale_hits,
+            'memory_entries': len(self._memory),
+            'memory_bytes': self._memory_bytes_used,
+            'memory_evictions': self.evictions,
+        }
+        if self.backend is not None:
+            stats.update(self.backend.stats())
+        return stats
+
+    def _lookup(self, key):
+        # The decoded entry from memory, else from the shared backend, or None. An expired entry
+        # in memory is looked up in the backend too, where another process may have refreshed it
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                self._memory.move_to_end(key)
+                if time.time() < cached[0][2]:
+                    return cached[0]
+        remembered = cached[0] if cached is not None else None
+        if self.backend is None:
+            return remembered
+
+        blob = self.backend.get(key)
+        if blob is None:
+            return remembered
+        entry = decode(blob)
+        if remembered is not None and entry[2] <= remembered[2]:
+            return remembered
+        self._remember(key, entry, len(blob))
+        return entry
+
+    def _remember(self, key, entry, size):
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            old = self._memory.pop(key, None)
+            if old is not None:
+                self._memory_bytes_used -= old[1]
+            self._memory[key] = (entry, size)
+            self._memory_bytes_used += size
+            while self._memory_bytes_used > self.memory_bytes:
+                _, (_, evicted_size) = self._memory.popitem(last=False)
+                self._memory_bytes_used -= evicted_size
+                self.evictions += 1
+
+
+def _create_cache(name):
+    if name == 'memory':
+        return UpstreamCache(None)
+    if name == 'sqlite':
+        return UpstreamCache(SQLiteBackend())
+    if name == 'redis':
+        return UpstreamCache(RedisBackend())
+    if name == 'none':
+        return UpstreamCache(None, memory_bytes=0)
+    raise ValueError(f"Unknown upstream cache backend '{name}'")
+
+
+cache = _create_cache(UPSTREAM_CACHE_BACKEND)
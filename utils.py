@@ -1,5 +1,4 @@
-import pandas as pd
-from errors import FileReadError, UnsupportedCropError
+from crop_catalog import catalog
 
 def convert_ppm_to_ppa(ppm, depth_cm, bulk_density=1.6):
     """
@@ -55,22 +54,12 @@ def calculate_extractable_nutrients(ppm_P, ppm_K, depth_cm, bulk_density=1.6):
 
 
 def get_planting_duration(crop_name):
-    crop_name = crop_name.lower()
-    
-    # Read the planting duration csv
-    planting_durations = pd.read_csv('data/planting_durations.csv')
-    
-    if crop_name not in planting_durations['crop'].values:
-        raise UnsupportedCropError(f"The crop '{crop_name}' is not supported.")
-    
-    return planting_durations[planting_durations['crop'] == crop_name]['duration(days)'].values[0]
-
+    return catalog.get_planting_duration(crop_name)
 
 
 def get_all_crops():
-    try:
-        # Read the planting duration csv
-        planting_durations = pd.read_csv('data/planting_durations.csv')
-    except Exception as e:
-        raise FileReadError("Failed to read the file 'data/planting_durations.csv'")
-    return planting_durations['crop'].values.tolist()
\ No newline at end of file
+    return catalog.get_all_crops()
+
+
+def get_planting_durations():
+    return catalog.get_durations()
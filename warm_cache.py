@@ -0,0 +1,206 @@
+"""
+Warm the API's caches for a grid of locations covering Kenya.
+
+The area in the GeoJSON is tiled into a grid, by default one point per result cache cell.
+Points are processed in work units, one per weather grid point, by a bounded pool of
+workers. For each unit the soil properties, the Open-Meteo weather and the rainfall
+climatology are fetched into the caches the API reads (soil_cache, the upstream cache
+and the climatology store), and the crop recommendations of every point are
+computed and stored in the result cache, so that requests in steady state are answered
+without calling SoilGrids or Open-Meteo.
+
+Run it on the API host with the same environment as the API, with RESULT_CACHE_BACKEND=sqlite
+so the recommendations are shared with the API's workers, e.g. once a day:
+
+    RESULT_CACHE_BACKEND=sqlite python warm_cache.py --workers 4 --rate 5
+
+Completed units are recorded in a state file, so an interrupted run picks up where it
+stopped when started again on the same day.
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import date
+
+import numpy as np
+
+import grid
+import soil_service
+import weather_service
+from coverage_index import load_area
+from plant_time_predictor import get_average_rainfall
+from predictor import get_batch_crop_recommendations
+from result_cache import SQLiteBackend, cache as result_cache
+from upstream import RateLimiter
+from weather_service import weather_grid_point
+
+# Seconds between progress reports
+PROGRESS_INTERVAL = 10
+
+
+def build_grid(area, step, bbox=None):
+    """
+    Get the centers of the grid cells of size `step` degrees inside an area.
+
+    Returns:
+    - ndarray: The (longitude, latitude) of each point, one row per point.
+    """
+    import shapely
+
+    shapely.prepare(area)
+    rows = [np.column_stack([longitudes, np.full(len(longitudes), latitude)])
+            for _, latitude, longitudes, _ in grid.iter_rows_inside(area, step, bbox)]
+    return np.concatenate(rows) if rows else np.empty((0, 2))
+
+
+def group_by_weather_grid_point(points):
+    """Split the points into work units, one per weather grid point, keyed by 'longitude,latitude'."""
+    units = defaultdict(list)
+    for longitude, latitude in points.tolist():
+        grid_longitude, grid_latitude = weather_grid_point(longitude, latitude)
+        units[f'{grid_longitude},{grid_latitude}'].append((longitude, latitude))
+    return dict(sorted(units.items()))
+
+
+def warm_unit(points, store_results=True):
+    """
+    Warm the caches for the points of one work unit.
+
+    Returns:
+    - tuple: The number of points with stored recommendations, the number of points outside
+      the soil data and the number of points that failed.
+    """
+    # The climatology is kept per weather grid point, which is the unit's own
+    longitude, latitude = points[0]
+    get_average_rainfall(longitude, latitude)
+
+    stored = unsupported = failed = 0
+    for (longitude, latitude), result in zip(points, get_batch_crop_recommendations(points)):
+        if 'recommendations' in result:
+            if store_results:
+                result_cache.put(result_cache.key('crop-recommendations', longitude, latitude),
+                                 result['recommendations'])
+            stored += 1
+        elif result['error'] == 'Location not supported':
+            unsupported += 1
+        else:
+            failed += 1
+    return stored, unsupported, failed
+
+
+def load_done_units(state_path, today):
+    """Get the units that were completed today according to the state file."""
+    if not os.path.exists(state_path):
+        return set()
+    with open(state_path) as f:
+        return {unit for day, _, unit in (line.strip().partition(' ') for line in f) if day == today}
+
+
+def limit_upstream_rate(rate):
+    """Start at most `rate` calls per second to each of SoilGrids and Open-Meteo."""
+    soil_service.soilgrids.limiter = RateLimiter(rate)
+    weather_service.get_upstream().limiter = RateLimiter(rate)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--geojson', default='kenya.geojson', help='Area to cover')
+    parser.add_argument('--step', type=float, default=result_cache.cell_degrees,
+                        help='Grid step in degrees, defaults to the result cache cell size')
+    parser.add_argument('--bbox', type=float, nargs=4, metavar=('MIN_LON', 'MIN_LAT', 'MAX_LON', 'MAX_LAT'),
+                        help='Only warm the part of the area inside this box')
+    parser.add_argument('--workers', type=int, default=4, help='Number of units processed at once')
+    parser.add_argument('--rate', type=float, default=5, help='Maximum calls per second to each upstream')
+    parser.add_argument('--state', default='warm_cache.state', help='File recording the completed units')
+    parser.add_argument('--no-results', action='store_true',
+                        help='Only warm the soil, weather and climatology caches')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    store_results = not args.no_results
+    if store_results and not isinstance(result_cache.backend, SQLiteBackend):
+        print(f"RESULT_CACHE_BACKEND is '{os.environ.get('RESULT_CACHE_BACKEND', 'memory')}', the recommendations "
+              f"will not be seen by the API. Set RESULT_CACHE_BACKEND=sqlite or use --no-results.")
+        sys.exit(1)
+
+    points = build_grid(load_area(args.geojson), args.step, args.bbox)
+    units = group_by_weather_grid_point(points)
+    today = date.today().isoformat()
+    done = load_done_units(args.state, today)
+    pending = [unit for unit in units if unit not in done]
+    print(f'{len(points)} points in {len(units)} units, {len(units) - len(pending)} already done today')
+    if not pending:
+        return
+
+    limit_upstream_rate(args.rate)
+
+    totals = {'stored': 0, 'unsupported': 0, 'failed': 0, 'failed_units': 0}
+    completed = 0
+    start = last_report = time.monotonic()
+
+    def report():
+        elapsed = time.monotonic() - start
+        rate = completed / elapsed if elapsed else 0.0
+        eta = (len(pending) - completed) / rate / 60 if rate else float('nan')
+        print(f"{completed}/{len(pending)} units, {totals['stored']} points stored, "
+              f"{totals['unsupported']} not supported, {totals['failed']} failed, "
+              f'{rate:.2f} units/s, ETA {eta:.1f} min', flush=True)
+
+    executor = ThreadPoolExecutor(args.workers)
+    remaining = iter(pending)
+    futures = {}
+    try:
+        # Only a few units are queued ahead of the workers, so an interrupt does not leave a long queue
+        while True:
+            while len(futures) < args.workers * 2:
+                unit = next(remaining, None)
+                if unit is None:
+                    break
+                futures[executor.submit(warm_unit, units[unit], store_results)] = unit
+            if not futures:
+                break
+
+            finished, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in finished:
+                unit = futures.pop(future)
+                completed += 1
+                try:
+                    stored, unsupported, failed = future.result()
+                except Exception as e:
+                    logging.error(f'Failed to warm unit {unit}: {e}')
+                    totals['failed_units'] += 1
+                    continue
+                totals['stored'] += stored
+                totals['unsupported'] += unsupported
+                totals['failed'] += failed
+                if failed:
+                    totals['failed_units'] += 1
+                    continue
+                # Units with failed points are not recorded, so the next run retries them
+                with open(args.state, 'a') as f:
+                    f.write(f'{today} {unit}\n')
+
+            if time.monotonic() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.monotonic()
+                report()
+    except KeyboardInterrupt:
+        print('Interrupted, waiting for the running units to finish. Run again to resume.')
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+        sys.exit(130)
+    executor.shutdown()
+
+    report()
+    if totals['failed_units']:
+        print(f"{totals['failed_units']} units had failures, run again to retry them")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,42 @@
-import openmeteo_requests
-import requests_cache
-import pandas as pd
-from retry_requests import retry
+import json
+import logging
+import os
+import threading
+import numpy as np
 from datetime import timedelta
-from datetime import date
+from datetime import date, datetime, time
+from zoneinfo import ZoneInfo
+
+from climatology import DAYS_PER_YEAR
+from metrics import timed
+from upstream import UpstreamClient
+from upstream_cache import cache as upstream_cache
+from errors import UpstreamTimeoutError, UpstreamUnavailableError
+
+ARCHIVE_URL = os.environ.get('OPENMETEO_ARCHIVE_URL', "https://archive-api.open-meteo.com/v1/archive")
+WEATHER_TIMEZONE = "Africa/Cairo"
+
+# The archive data comes from ERA5-Land, on a 0.1 degree grid. Locations are snapped to the
+# nearest grid point so that nearby requests share one cached response, 0 turns this off.
+WEATHER_GRID_DEGREES = float(os.environ.get('WEATHER_GRID_DEGREES', 0.1))
+
+# Seconds for each attempt, and for a whole call including retries
+OPENMETEO_TIMEOUT = float(os.environ.get('OPENMETEO_TIMEOUT', 20))
+OPENMETEO_DEADLINE = float(os.environ.get('OPENMETEO_DEADLINE', 30))
+
+# Calls to Open-Meteo in flight at once, per process
+OPENMETEO_MAX_CONCURRENCY = int(os.environ.get('OPENMETEO_MAX_CONCURRENCY', 8))
+
+_openmeteo = None
+_upstream = None
+_openmeteo_lock = threading.Lock()
 
 def get_estimated_weather_conditions(longitude, latitude, duration_months=3, start_date=None):
+    longitude, latitude = weather_grid_point(longitude, latitude)
+
     # Call the get_weather_data function with the given parameters
-    averages = _get_weather_data(longitude, latitude, duration_months, start_date)
+    averages = _get_weather_data(latitude=latitude, longitude=longitude, duration_months=duration_months,
+                                 start_date=start_date)
     
     # Call the get_average_weather_data function with the averages data
     overall_averages = _get_average_weather_data(averages)
@@ -18,133 +47,260 @@ def get_estimated_weather_conditions(longitude, latitude, duration_months=3, sta
         'rainfall': overall_averages[2]
     }
 
-def _get_weather_data(latitude, longitude, duration_months, start_date=None):
-    cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
+def weather_grid_point(longitude, latitude):
+    """Get the (longitude, latitude) of the weather grid point nearest to a location."""
+    if WEATHER_GRID_DEGREES <= 0:
+        return longitude, latitude
+    return (round(round(longitude / WEATHER_GRID_DEGREES) * WEATHER_GRID_DEGREES, 6),
+            round(round(latitude / WEATHER_GRID_DEGREES) * WEATHER_GRID_DEGREES, 6))
 
+@timed('weather')
+def _get_weather_data(latitude, longitude, duration_months, start_date=None):
     # If no start date is provided, use the current date
     if start_date is None:
         start_date = date.today()
 
     # Calculate the end date based on the duration
     end_date = start_date + timedelta(days=30*duration_months)
-    
-    # Initialize a dictionary to store the averages for each year
-    averages = {}
 
     years_back = 3
-    current_year = 1
-
-    # Loop over the last 3 years
-    while current_year <= years_back:
-        # Calculate the start and end date for the current year
-        start_date_year = start_date - timedelta(days=365*current_year)
-        end_date_year = end_date - timedelta(days=365*current_year)
-        
-        current_year += 1
-        
-        # Define the parameters for the API request
-        params = {
-            "latitude": latitude,
-            "longitude": longitude,
-            "start_date": start_date_year.strftime('%Y-%m-%d'),
-            "end_date": end_date_year.strftime('%Y-%m-%d'),
-            "hourly": "relative_humidity_2m",
-            "daily": ["temperature_2m_mean", "rain_sum"],
-            "timezone": "Africa/Cairo"
-        }
-		
-        # Make the API request
-        url = "https://archive-api.open-meteo.com/v1/archive"
-        responses = openmeteo.weather_api(url, params=params)
-
-        # Process the first location
-        response = responses[0]
-
-        # Process hourly data
-        hourly = response.Hourly()
-        hourly_relative_humidity_2m = hourly.Variables(0).ValuesAsNumpy()
-
-        hourly_data = {"date": pd.date_range(
-            start=pd.to_datetime(hourly.Time(), unit="s", utc=True),
-            end=pd.to_datetime(hourly.TimeEnd(), unit="s", utc=True),
-            freq=pd.Timedelta(seconds=hourly.Interval()),
-            inclusive="left"
-        )}
-        hourly_data["relative_humidity_2m"] = hourly_relative_humidity_2m
-
-        hourly_dataframe = pd.DataFrame(data=hourly_data)
-
-        # Process daily data
-        daily = response.Daily()
-        daily_temperature_2m_mean = daily.Variables(0).ValuesAsNumpy()
-        daily_rainfall_sum = daily.Variables(1).ValuesAsNumpy()
-
-        daily_data = {"date": pd.date_range(
-            start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-            end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-            freq=pd.Timedelta(seconds=daily.Interval()),
-            inclusive="left"
-        )}
-        daily_data["temperature_2m_mean"] = daily_temperature_2m_mean
-        daily_data["rain_sum"] = daily_rainfall_sum
-
-        daily_dataframe = pd.DataFrame(data=daily_data)
-
-        # Resample hourly data to daily data and calculate the mean
-        hourly_dataframe.set_index('date', inplace=True)
-        hourly_dataframe_daily = hourly_dataframe.resample('D').mean()
-
-        # Calculate the averages for the current year
-        average_daily_relative_humidity = hourly_dataframe_daily['relative_humidity_2m'].mean()
-        average_daily_temperature = daily_dataframe['temperature_2m_mean'].mean()
-        sum_rainfall_for_duration = daily_dataframe['rain_sum'].sum()
-        
-
-        # Store the averages in the dictionary
-        averages[start_date_year.year] = {
-            'average_daily_relative_humidity': average_daily_relative_humidity,
-            'average_daily_temperature': average_daily_temperature,
-            'sum_rainfall_for_duration': sum_rainfall_for_duration
-        }
-
-    return averages
+
+    # The same window in each of the last 3 years
+    windows = [
+        (start_date - timedelta(days=365*year), end_date - timedelta(days=365*year))
+        for year in range(1, years_back + 1)
+    ]
+
+    # Fetch all the years in one request and slice the windows out locally
+    request_start = windows[-1][0]
+    request_end = windows[0][1]
+    params = {
+        "latitude": latitude,
+        "longitude": longitude,
+        "start_date": request_start.strftime('%Y-%m-%d'),
+        "end_date": request_end.strftime('%Y-%m-%d'),
+        "hourly": "relative_humidity_2m",
+        "daily": ["temperature_2m_mean", "rain_sum"],
+        "timezone": WEATHER_TIMEZONE
+    }
+    arrays, metadata = _cached_weather_api('weather', params, _parse_weather_data)
+    hourly_relative_humidity_2m = arrays['relative_humidity_2m']
+    hourly_time = metadata['hourly_time'] + metadata['hourly_interval'] * np.arange(len(hourly_relative_humidity_2m))
+    daily_temperature_2m_mean = arrays['temperature_2m_mean']
+    daily_rainfall_sum = arrays['rain_sum']
+
+    # Hours whose local date falls in each window
+    hour_ranges = np.searchsorted(hourly_time, [
+        (_local_midnight(start_date_year), _local_midnight(end_date_year + timedelta(days=1)))
+        for start_date_year, end_date_year in windows
+    ])
+
+    # Days of each window, one value per local day
+    first_days = [(start_date_year - request_start).days for start_date_year, _ in windows]
+    window_days = (end_date - start_date).days + 1
+
+    humidity, temperature, rainfall = _aggregate_windows(
+        hourly_time, hourly_relative_humidity_2m, daily_temperature_2m_mean, daily_rainfall_sum,
+        hour_ranges, first_days, window_days
+    )
+
+    # The averages for each year, one array element per window
+    return {
+        'years': [start_date_year.year for start_date_year, _ in windows],
+        'average_daily_relative_humidity': humidity,
+        'average_daily_temperature': temperature,
+        'sum_rainfall_for_duration': rainfall
+    }
+
+def _parse_weather_data(response):
+    hourly = response.Hourly()
+    daily = response.Daily()
+    arrays = {
+        'relative_humidity_2m': hourly.Variables(0).ValuesAsNumpy(),
+        'temperature_2m_mean': daily.Variables(0).ValuesAsNumpy(),
+        'rain_sum': daily.Variables(1).ValuesAsNumpy(),
+    }
+    return arrays, {'hourly_time': hourly.Time(), 'hourly_interval': hourly.Interval()}
+
+def _aggregate_windows(hourly_time, hourly_relative_humidity_2m, daily_temperature_2m_mean, daily_rainfall_sum,
+                       hour_ranges, first_days, window_days):
+    """
+    Reduce the raw Open-Meteo series to one set of averages per window, for all windows at once.
+
+    Humidity is averaged per UTC day and then over the days, like a pandas resample('D').mean()
+    followed by mean(). Like pandas, NaN values are skipped.
+
+    Parameters:
+    - hourly_time (ndarray): Unix timestamps of the hourly values.
+    - hourly_relative_humidity_2m (ndarray): Hourly relative humidity.
+    - daily_temperature_2m_mean (ndarray): Daily mean temperature.
+    - daily_rainfall_sum (ndarray): Daily rainfall.
+    - hour_ranges (ndarray): (first, end) indexes of each window's hours.
+    - first_days (list): Index of the first day of each window.
+    - window_days (int): Number of days in every window.
+
+    Returns:
+    - tuple: Arrays with the average daily relative humidity, average daily temperature and
+      rainfall sum of each window.
+    """
+    num_windows = len(first_days)
+
+    # Every window has the same number of days, so the daily values form a windows x days matrix
+    day_index = np.asarray(first_days)[:, np.newaxis] + np.arange(window_days)
+    temperature = _nanmean(daily_temperature_2m_mean[day_index])
+    rainfall = _nansum(daily_rainfall_sum[day_index])
+
+    # Hourly humidity as a UTC days x hours matrix, then daily humidity as a windows x days matrix
+    hourly_humidity, day_window = _group_hours_by_utc_day(hourly_time, hourly_relative_humidity_2m, hour_ranges)
+    daily_humidity = _kahan_nanmean(hourly_humidity)
+    humidity = _nanmean(_group_matrix(daily_humidity, day_window, num_windows))
+
+    return humidity, temperature, rainfall
+
+def _group_hours_by_utc_day(hourly_time, hourly_values, hour_ranges):
+    # Group consecutive hours of the same UTC day and get the window of every day. The windows
+    # are contiguous, so they are copied from slices instead of through index arrays, and the
+    # hour-sized temporaries are kept few and small: they are most of the memory used per request.
+    utc_day = np.concatenate([hourly_time[first:end] for first, end in hour_ranges])
+    utc_day //= 86400
+    day_start = np.empty(len(utc_day), dtype=bool)
+    day_start[:1] = True
+    np.not_equal(utc_day[1:], utc_day[:-1], out=day_start[1:])
+    del utc_day
+
+    day_group = np.cumsum(day_start, dtype=np.int32)
+    day_group -= 1
+    first_hours = np.flatnonzero(day_start)
+    window_ends = np.cumsum([end - first for first, end in hour_ranges])
+    day_window = np.searchsorted(window_ends, first_hours, side='right')
+
+    values = np.concatenate([hourly_values[first:end] for first, end in hour_ranges])
+    return _group_matrix(values, day_group, len(first_hours)), day_window
+
+def _group_matrix(values, groups, num_groups):
+    # Lay out values sorted by group as a groups x members matrix, padding short groups with NaN.
+    # The matrix is filled through a mask of its members, runs of True for the values of each
+    # group then of False for its padding, which needs no value-sized index arrays.
+    sizes = np.diff(np.searchsorted(groups, np.arange(num_groups + 1, dtype=groups.dtype)))
+    width = sizes.max(initial=0)
+    matrix = np.full((num_groups, width), np.nan, dtype=values.dtype)
+    members = np.repeat(np.tile([True, False], num_groups), np.column_stack([sizes, width - sizes]).ravel())
+    matrix.ravel()[members] = values
+    return matrix
+
+# The reductions below use the same arithmetic and precision as pandas' skipna mean and sum and
+# its resample mean, so the results match the DataFrame based implementation exactly.
+def _nanmean(values):
+    has_value = ~np.isnan(values)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(has_value, values, 0).sum(axis=1, dtype=values.dtype) / has_value.sum(axis=1).astype(values.dtype)
+
+def _nansum(values):
+    return np.where(np.isnan(values), 0, values).sum(axis=1, dtype=values.dtype)
+
+def _kahan_nanmean(values):
+    # Compensated row sums, computed a column at a time for all rows at once
+    total = np.zeros(values.shape[0], dtype=values.dtype)
+    compensation = np.zeros(values.shape[0], dtype=values.dtype)
+    count = np.zeros(values.shape[0], dtype=values.dtype)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for column in values.T:
+            has_value = ~np.isnan(column)
+            y = column - compensation
+            t = total + y
+            compensation = np.where(has_value, t - total - y, compensation)
+            total = np.where(has_value, t, total)
+            count += has_value
+        return total / count
+
+def _local_midnight(day):
+    # Unix timestamp of the start of a day in the weather timezone
+    return int(datetime.combine(day, time(), tzinfo=ZoneInfo(WEATHER_TIMEZONE)).timestamp())
+
+def _get_openmeteo_client():
+    # Build the client once and reuse its session for every request
+    global _openmeteo, _upstream
+    if _openmeteo is None:
+        with _openmeteo_lock:
+            if _openmeteo is None:
+                import openmeteo_requests  # Imported lazily to keep start-up fast
+
+                # Retries, timeouts and the circuit breaker come from the upstream client
+                _upstream = UpstreamClient('openmeteo', OPENMETEO_TIMEOUT, OPENMETEO_DEADLINE,
+                                           OPENMETEO_MAX_CONCURRENCY)
+                _openmeteo = openmeteo_requests.Client(session=_upstream)
+    return _openmeteo
+
+def get_upstream():
+    """Get the client that calls Open-Meteo, creating it if needed."""
+    _get_openmeteo_client()
+    return _upstream
+
+def get_upstream_stats():
+    return get_upstream().stats()
+
+def _weather_api(params):
+    openmeteo = _get_openmeteo_client()
+    try:
+        return openmeteo.weather_api(ARCHIVE_URL, params=params)
+    except Exception as e:
+        # The Open-Meteo client wraps every error, unwrap ours so callers can tell timeouts and outages apart
+        if isinstance(e.__cause__, (UpstreamTimeoutError, UpstreamUnavailableError)):
+            raise e.__cause__ from None
+        raise
+
+def _cached_weather_api(name, params, parse):
+    """
+    Get the parsed Open-Meteo response for a query, from the upstream cache when possible.
+
+    Parameters:
+    - name (str): What the response is parsed into, so that each layout has its own entries.
+    - params (dict): The query parameters.
+    - parse (function): Turns the response into a dict of arrays and a dict of metadata.
+
+    Returns:
+    - tuple: The arrays and the metadata.
+    """
+    key = f'openmeteo:{name}:' + json.dumps(params, sort_keys=True, separators=(',', ':'))
+    entry = upstream_cache.get(key)
+    if entry is not None:
+        return entry
+
+    try:
+        response = _weather_api(params)[0]
+    except Exception as e:
+        # Archived weather does not change, so an expired entry beats failing the request
+        entry = upstream_cache.get(key, allow_stale=True)
+        if entry is None:
+            raise
+        logging.warning(f'Serving an expired Open-Meteo response: {e}')
+        return entry
+
+    arrays, metadata = parse(response)
+    upstream_cache.set(key, arrays, metadata)
+    return arrays, metadata
 
 def _get_average_weather_data(averages):
-    # Initialize variables to store the sum of each parameter
-    sum_relative_humidity = 0
-    sum_temperature = 0
-    sum_rainfall = 0
-        
-    # Loop over the years in the averages dictionary
-    for year in averages:
-        # Get the average values for the current year
-        year_data = averages[year]
-        average_relative_humidity = year_data['average_daily_relative_humidity']
-        average_temperature = year_data['average_daily_temperature']
-        average_rainfall = year_data['sum_rainfall_for_duration']
-            
-        # Add the averages to the sum variables
-        sum_relative_humidity += average_relative_humidity
-        sum_temperature += average_temperature
-        sum_rainfall += average_rainfall
-        
-    # Calculate the overall averages
-    num_years = len(averages)
-    overall_average_relative_humidity = sum_relative_humidity / num_years
-    overall_average_temperature = sum_temperature / num_years
-    overall_average_rainfall = sum_rainfall / num_years
-        
+    # Average each parameter over the years
+    num_years = len(averages['years'])
+    overall_average_relative_humidity = averages['average_daily_relative_humidity'].sum() / num_years
+    overall_average_temperature = averages['average_daily_temperature'].sum() / num_years
+    overall_average_rainfall = averages['sum_rainfall_for_duration'].sum() / num_years
+
     # Return the overall averages
     return overall_average_relative_humidity, overall_average_temperature, overall_average_rainfall
 
 # Get three last years rainfall history
+@timed('rainfall_history')
 def get_rainfall_history(longitude, latitude, duration_in_years=3):
-    cache_session = requests_cache.CachedSession('.cache', expire_after=-1)
-    retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-    openmeteo = openmeteo_requests.Client(session=retry_session)
-    
+    """
+    Get the daily rainfall of the last years at a location, one row per year.
+
+    Returns:
+    - dict: 'first_year', the year of the first row, and 'rainfall', a read-only float32
+      array of shape (years, DAYS_PER_YEAR) indexed by day of the year. Days without a
+      value, February 29th included, are NaN.
+    """
     # End should be the previous year 31st December and start should be duration of years before that but 1st January
     end_date = date.today().replace(month=1, day=1)
     
@@ -152,33 +308,67 @@ def get_rainfall_history(longitude, latitude, duration_in_years=3):
     start_date = start_date.replace(month=1, day=2)
     
     
-    url = "https://archive-api.open-meteo.com/v1/archive"
-    
     params = {
 	"latitude": latitude,
 	"longitude": longitude,
 	"start_date": start_date.strftime('%Y-%m-%d'),
 	"end_date": end_date.strftime('%Y-%m-%d'),
 	"daily": "rain_sum",
-	"timezone": "Africa/Cairo"
+	"timezone": WEATHER_TIMEZONE
     }
     
-    responses = openmeteo.weather_api(url, params=params)
-    
-    response = responses[0]
-    
+    # The history is cached already laid out by year, so a hit is used as it is
+    arrays, metadata = _cached_weather_api('rainfall_history', params, _parse_rainfall_history)
+    return {'first_year': metadata['first_year'], 'rainfall': arrays['rainfall']}
+
+def _parse_rainfall_history(response):
     # Process daily data. The order of variables needs to be the same as requested.
     daily = response.Daily()
     daily_rain_sum = daily.Variables(0).ValuesAsNumpy()
+    days = (daily.Time() + daily.Interval() * np.arange(len(daily_rain_sum))) // 86400
+    first_year, rainfall = _rainfall_by_year(days.astype('datetime64[D]'), daily_rain_sum)
+    return {'rainfall': rainfall}, {'first_year': first_year}
+
+def calculate_average_rainfall(rainfall_history):
+    """
+    Average the rainfall history over the years, for each day of the year.
+
+    The mean is taken with the same compensated float32 arithmetic as the pandas groupby
+    mean it replaces, skipping missing values.
+
+    Parameters:
+    - rainfall_history (dict): The rainfall history, as returned by get_rainfall_history.
+
+    Returns:
+    - ndarray: The float32 average rainfall for days 1 to 365, 0 for days without any value.
+    """
+    average_rainfall = _kahan_nanmean(rainfall_history['rainfall'].T)
+    return np.where(np.isnan(average_rainfall), 0, average_rainfall).astype(np.float32)
+
+def _rainfall_by_year(days, daily_rain_sum):
+    """
+    Lay daily rainfall out as a years x DAYS_PER_YEAR float32 matrix.
+
+    Each value goes to the row of its year and the column of its day of the year, with days
+    dated in UTC like the DataFrame version did. February 29th is left out, so that column
+    is NaN in leap years, and so is the 366th day.
+
+    Parameters:
+    - days (ndarray): The datetime64[D] date of each value.
+    - daily_rain_sum (ndarray): Daily rainfall.
+
+    Returns:
+    - tuple: The year of the first row, and the matrix with NaN for days without a value.
+    """
+    years = days.astype('datetime64[Y]')
+    months = days.astype('datetime64[M]')
+    day_of_year = (days - years).astype(np.int64)
+    february_29th = ((months - years).astype(np.int64) == 1) & ((days - months).astype(np.int64) == 28)
+    keep = (day_of_year < DAYS_PER_YEAR) & ~february_29th
 
-    daily_data = {"date": pd.date_range(
-        start = pd.to_datetime(daily.Time(), unit = "s", utc = True),
-        end = pd.to_datetime(daily.TimeEnd(), unit = "s", utc = True),
-        freq = pd.Timedelta(seconds = daily.Interval()),
-        inclusive = "left"
-    )}
-    daily_data["rain_sum"] = daily_rain_sum
-
-    daily_dataframe = pd.DataFrame(data=daily_data)
-    daily_dataframe = daily_dataframe[~((daily_dataframe.date.dt.month == 2) & (daily_dataframe.date.dt.day == 29))]
-    return daily_dataframe
\ No newline at end of file
+    year_numbers = years.astype(np.int64) + 1970
+    first_year = int(year_numbers.min(initial=date.today().year))
+    rainfall = np.full((int(year_numbers.max(initial=first_year)) - first_year + 1, DAYS_PER_YEAR), np.nan,
+                       dtype=np.float32)
+    rainfall[year_numbers[keep] - first_year, day_of_year[keep]] = daily_rain_sum[keep]
+    return first_year, rainfall
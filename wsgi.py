@@ -0,0 +1,32 @@
+"""
+Production entry point, served with gunicorn:
+
+    gunicorn --config gunicorn.conf.py wsgi:app
+
+Everything the workers need is loaded here, before gunicorn forks them, so they share
+one copy of it and no worker pays for it on its first request.
+"""
+import logging
+import os
+
+from api import app
+from coverage_index import index as coverage_index
+from crop_catalog import catalog
+from model_registry import registry
+from soil_service import PHOSPHORUS_RASTER_FILE, POTASSIUM_RASTER_FILE, NITROGEN_RASTER_FILE, PHH2O_RASTER_FILE
+from tif_reader import sampler
+
+
+def preload():
+    registry.warm_up()
+    catalog.get_all_crops()
+    coverage_index.load()
+
+    for raster_file in [PHOSPHORUS_RASTER_FILE, POTASSIUM_RASTER_FILE, NITROGEN_RASTER_FILE, PHH2O_RASTER_FILE]:
+        if os.path.exists(raster_file):
+            sampler.open(raster_file)
+
+    logging.info('Preloaded the model, crop catalog, coverage index and rasters')
+
+
+preload()